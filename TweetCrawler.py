@@ -2,19 +2,50 @@ import argparse
 import configparser
 import csv
 import getpass
+import json
 import logging
 import os
+import signal
 import sys
+import threading
+from contextlib import nullcontext
 from concurrent.futures import ThreadPoolExecutor,ProcessPoolExecutor
-from itertools import repeat
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+from multiprocessing.util import Finalize
 
-import pandas as pd
-import psycopg2
 import tweepy
-from bs4 import BeautifulSoup
+from tweepy.parsers import JSONParser
+
+from ratelimit import RateLimitScheduler, SchedulerManager, api_host, call_api
+from seen_ids import DEFAULT_CAPACITY, SeenIds, get_seen_ids, set_seen_ids
+from crawl_state import get_state
+from bloom import BloomFilter
+from handle_source import MIN_BYTES_PER_HANDLE, iter_handles, submit_bounded
+from job_queue import Heartbeat, JobQueue, claim_jobs, finish_job, node_id
+from metrics import DEFAULT_METRICS_PORT, get_metrics, serve_metrics, start_metrics_push
+from search_windows import DEFAULT_SEARCH_WINDOWS, crawl_windows, plan_windows
+from pipeline import DEFAULT_PIPELINE, CrawlPipeline, log_handle_crawled, save_checkpoint
+from storage import PARQUET_ROW_GROUP_SIZE, open_sink, pg_get_conn
 
 INDIA_ID_YAHOO = "23424848"
-PICKLE_FILE_CRAWLED_DATA = "./crawled.txt"
+# seconds between two polls of trends_place in daemon mode
+DEFAULT_TRENDING_INTERVAL = 900
+# failed crawls in a row after which a trending query is no longer crawled again
+MAX_QUERY_FAILURES = 3
+DEFAULT_CONCURRENCY = 100
+# table of the README schema, used when the database is only given on the command line
+DEFAULT_TABLENAME = "tweet_articles_tweepy"
+CONFIG_FILE = "./tweet.ini"
+# options of get_conf_user that tweet.ini can't override, passing any of them skips it
+CLI_ONLY_OPTIONS = ('authcsv', 'dbname', 'dbuser')
+# handles submitted to the process pool ahead of the workers, per worker
+SUBMIT_WINDOW_PER_WORKER = 4
+# seconds of the newest crawled tweets a snowball expansion leaves to the next one, see get_expansion_watermark
+EXPANSION_SETTLE = 60
+API_LIST = None
+PIPELINE = None
+PIPELINE_PID = None
 
 
 def get_credentials(authfile):
@@ -34,58 +65,28 @@ def get_credentials(authfile):
         sys.exit("Exiting Fatal Error")
 
 
-def pg_get_conn(database, user, password, host, port):
-    """Get Postgres connection for fakenews
-
-    Returns:
-        Connection object : returns Post gres connection object
-
-    Args:
-        database (str, optional): Name of database
-        user (str, optional): Name of User
-        password (str, optional): Password of user
-        :param host:
-        :type host:
-    """
-    try:
-        conn = psycopg2.connect(database=database,
-                                user=user, password=password, host=host, port=port)
-        conn.autocommit = True
-        return conn
-    except psycopg2.DatabaseError as e:
-        logging.error("Problem Connecting to database:  " + str(e))
-
-
-def insert_into_postgres(posts, conn, tablename, curr_id):
-    cur = conn.cursor()
-    successful_records = len(posts)
-    for item in posts:
-        keys = list(item.keys())
-        values = [item[x] for x in keys]
-        try:
-            cur.execute('insert into {}(%s) values %s;'.format(tablename),
-                        (psycopg2.extensions.AsIs(','.join(keys)), tuple(values)))
-        except psycopg2.DatabaseError as e:
-            successful_records -= 1
-    cur.close()
-    return len(posts) - successful_records
-
-
-def init_twitterAPI(dct):
+def init_twitterAPI(dct, wait_on_rate_limit=True, parser=None):
     consumer_key = dct['consumer_key']
     consumer_secret = dct['consumer_secret']
     access_token = dct['access_token']
     access_token_secret = dct['access_token_secret']
     auth = tweepy.OAuthHandler(consumer_key, consumer_secret)
     auth.set_access_token(access_token, access_token_secret)
-    api = tweepy.auth.API(auth, wait_on_rate_limit=True, retry_count=3, retry_errors=[104])
+    api = tweepy.auth.API(auth, wait_on_rate_limit=wait_on_rate_limit, retry_count=3, retry_errors=[104],
+                          parser=parser, host=api_host())
     return api
 
 
-def mark_handle_crawled(curr_id):
-    with open(PICKLE_FILE_CRAWLED_DATA, 'a') as f:
-        f.write(curr_id + '\n')
-    return
+def get_api_list(auth_list):
+    """API objects for every credential, created once per worker process. Rate limits are handled by the shared
+    scheduler so tweepy must not sleep on its own, and responses are returned as raw JSON for normalize_tweet
+    instead of being turned into tweepy models first."""
+    global API_LIST
+    if API_LIST is None:
+        API_LIST = [init_twitterAPI(x, wait_on_rate_limit=False, parser=JSONParser())
+                    for x in auth_list]
+    return API_LIST
+
 
 def set_log_file():
     process_number = int(os.getpid()) - int(PARENT_PROCESS_PID)
@@ -94,134 +95,204 @@ def set_log_file():
     file_handler = logging.FileHandler(filename=logfile, mode="a", encoding="utf-8")
     logger.addHandler(file_handler)
     logger.setLevel("INFO")
+
+
+def init_worker(seen_ids=None, metrics_registry=None):
+    """Initializer of the worker processes"""
+    # handlers inherited through fork would write to the log file of the parent
+    logging.getLogger().handlers = []
+    set_log_file()
+    set_seen_ids(seen_ids)
+    if metrics_registry is not None:
+        start_metrics_push(metrics_registry)
     
     
  
 
-def crawl_twitter(combined_id_auth_tup, db_credentials, output_folder, tablename, search=False):
-    try:
-        set_log_file()
-        posts = []
-        curr_id, api = combined_id_auth_tup
-        last_id_pagination = -1
-        if db_credentials:
-            conn = pg_get_conn(db_credentials["dbname"], db_credentials["dbuser"],
-                               db_credentials["dbpass"], db_credentials["dbhost"],
-                               db_credentials["dbport"])
+def get_pipeline(sink, db_credentials, output_folder, tablename, pipeline_conf, search, job_worker=None):
+    """Pipeline of the current worker process, created on first use and drained when the process exits. On a node
+    of a distributed crawl (job_worker set) the jobs are released once their tweets are written."""
+    global PIPELINE, PIPELINE_PID
+    if PIPELINE is None or PIPELINE_PID != os.getpid():
+        if job_worker:
+            on_handle_done = partial(finish_job, db_credentials=db_credentials, worker=job_worker, search=search)
         else:
-            conn = None
-        logging.info("Crawling handle " + curr_id)
-        counter = 0
-        failed_tweets = 0
+            on_handle_done = partial(log_handle_crawled, search=search)
+        pipeline_conf = dict(pipeline_conf)
+        store = open_sink(sink, db_credentials, output_folder, tablename, pipeline_conf.pop('row_group_size', None))
+        PIPELINE = CrawlPipeline(store, on_handle_done, **pipeline_conf,
+                                 on_checkpoint=partial(save_checkpoint, search=search), seen=get_seen_ids())
+        PIPELINE_PID = os.getpid()
+        Finalize(PIPELINE, PIPELINE.close, exitpriority=10)
+    return PIPELINE
+
+
+def crawl_twitter(curr_id, auth_list, scheduler, db_credentials, output_folder, tablename, search=False,
+                  pipeline_conf=DEFAULT_PIPELINE, sink=None, backfill=False, job_worker=None,
+                  search_windows=DEFAULT_SEARCH_WINDOWS):
+    pipeline = get_pipeline(sink, db_credentials, output_folder, tablename, pipeline_conf, search, job_worker)
+    completed = False
+    try:
+        api_list = get_api_list(auth_list)
+        # only fetch tweets newer than the last crawl unless a full backfill was asked for, and resume below the
+        # last written page if the previous crawl of this handle was interrupted
+        since_id, last_id_pagination = get_state().start(curr_id, search, backfill)
+        logging.info("Crawling handle " + curr_id + (" since " + str(since_id) if since_id else "") +
+                     (" resuming below " + str(last_id_pagination) if last_id_pagination else ""))
+        first_page = True
         while True:
             if search:
-                cursor = api.search(q=curr_id, summary=False, tweet_mode="extended",
-                                    count=100, include_entities=True, max_id=str(last_id_pagination - 1))
+                cursor = call_api(scheduler, api_list, 'search', q=curr_id, summary=False, tweet_mode="extended",
+                                  count=100, include_entities=True, max_id=last_id_pagination, since_id=since_id)
             else:
-                cursor = api.user_timeline(id=curr_id, summary=False, tweet_mode="extended", count=100,
-                                           include_entities=True, max_id=str(last_id_pagination - 1))
-            try:
-                if cursor:
-                    for post in cursor:
-                        try:
-                            dc = {}
-                            curr_post = post._json
-                            dc['tweet_from'] = curr_post['user']['screen_name']
-                            dc['created_at'] = curr_post['created_at']
-                            ent_status_dct = curr_post.get("entities", False)
-                            if ent_status_dct:
-                                dc['hashtags'] = [x['text'] for x in curr_post['entities']['hashtags']]
-                                dc['urls'] = [x['expanded_url'] for x in curr_post['entities']['urls']]
-                                dc['user_mentions_id'] = [x['id'] for x in curr_post['entities']['user_mentions']]
-                                if 'media' in ent_status_dct:
-                                    dc['media'] = [x['media_url_https'] for x in curr_post['entities']['media']]
-                                dc['user_mentions_name'] = [x['screen_name'] for x in
-                                                            curr_post['entities']['user_mentions']]
-                            origin_raw_html = BeautifulSoup(curr_post['source'], 'html.parser').a
-                            dc['origin_device'] = origin_raw_html.string if origin_raw_html else None
-                            dc['favorite_count'] = curr_post['favorite_count']
-                            dc['text'] = curr_post['full_text']
-                            dc['id'] = curr_post['id']
-                            dc['in_reply_to_screen_name'] = curr_post['in_reply_to_screen_name']
-                            dc['in_reply_to_user_id'] = curr_post['in_reply_to_user_id']
-                            dc['in_reply_to_status_id'] = curr_post['in_reply_to_status_id']
-                            dc['retweet_count'] = curr_post['retweet_count']
-                            rt_status_dct = curr_post.get('retweeted_status', False)
-                            #         adding retweet information because it is important.
-                            if rt_status_dct:
-                                dc['retweeted_status_text'] = curr_post['retweeted_status']['full_text']
-                                dc['retweeted_status_url'] = [x['expanded_url'] for x in
-                                                              curr_post['retweeted_status']['entities']['urls']]
-                                dc['retweeted_status_id'] = curr_post['retweeted_status']['id']
-                                dc['retweeted_status_user_name'] = curr_post['retweeted_status']['user']['name']
-                                dc['retweeted_status_user_handle'] = curr_post['retweeted_status']['user'][
-                                    'screen_name']
-                            posts.append(dc)
-                            counter += 1
-                            if counter % 50 == 0:
-                                if conn:
-                                    failed_tweets += insert_into_postgres(posts, conn, tablename, curr_id)
-                                else:
-                                    write_to_csv(output_folder, curr_id, posts)
-                                last_id_pagination = int(posts[-1]['id'])
-                                posts = []
-                        except Exception as e:
-                            counter -= 1
-                            continue
-                else:
-                    break
-            except Exception as e:
-                logging.error("Can't crawl tweet, possibly parser error: " + str(curr_id) + " exception: " + str(e))
-        if conn:
-            failed_tweets += insert_into_postgres(posts, conn, tablename, curr_id)
-        else:
-            write_to_csv(output_folder, curr_id, posts)
-        mark_handle_crawled(curr_id)
-        logging.critical("{} Handle crawled: Total tweets inserted successfully:{}, tweets failed:{} ".format(curr_id,
-                                                                                                              counter - failed_tweets,
-                                                                                                              failed_tweets))
+                cursor = call_api(scheduler, api_list, 'user_timeline', id=curr_id, summary=False,
+                                  tweet_mode="extended", count=100, include_entities=True,
+                                  max_id=last_id_pagination, since_id=since_id)
+            page = cursor['statuses'] if search else cursor
+            if not page:
+                break
+            pipeline.submit_page(curr_id, page)
+            last_id_pagination = page[-1]['id'] - 1
+            windows = plan_windows(page, since_id, search_windows) if search and first_page else []
+            if windows:
+                logging.info("Splitting search " + curr_id + " into {} windows".format(len(windows)))
+                crawl_windows(partial(crawl_search_window, curr_id, api_list, scheduler, pipeline, search_windows),
+                              windows, search_windows)
+                break
+            first_page = False
+        completed = True
     except tweepy.error.TweepError as e:
         logging.error("Can't crawl ID, error in Cursor" + str(curr_id) + " exception: " + str(e))
+    finally:
+        pipeline.finish_handle(curr_id, completed)
     return
 
 
-def write_to_csv(output_folder, curr_id, posts):
-    if not os.path.exists(output_folder):
-        os.mkdir(output_folder)
-    csv_file = os.path.join(output_folder, curr_id + ".csv")
-    df = pd.DataFrame(posts)
-    df.to_csv(csv_file, mode='a', header=False)
+def crawl_search_window(curr_id, api_list, scheduler, pipeline, search_windows, window):
+    """Page through the (since_id, max_id] window of a split search, or return the windows the rest of it is split
+    into after its first page. Its pages arrive out of order with the other windows, so they don't move the resume
+    cursor: an interrupted search resumes below its first page."""
+    since_id, max_id = window
+    first_page = True
+    while True:
+        cursor = call_api(scheduler, api_list, 'search', q=curr_id, summary=False, tweet_mode="extended", count=100,
+                          include_entities=True, max_id=max_id, since_id=since_id)
+        page = cursor['statuses']
+        if not page:
+            return []
+        pipeline.submit_page(curr_id, page, cursor=False)
+        max_id = page[-1]['id'] - 1
+        if first_page:
+            windows = plan_windows(page, since_id, search_windows)
+            if windows:
+                return windows
+            first_page = False
 
 
 def get_queue(file):
+    """Lazy iterator over the distinct handles of file"""
     try:
-        q = []
-        with open(file) as f:
-            for line in f:
-                q.append(line)
-        return q
+        return iter_handles(file)
     except FileNotFoundError as e:
         logging.error("Problem reading handles file: " + str(e))
         sys.exit("Exiting Fatal Error")
 
 
-def init_crawler(no_of_threads, auth_list, db_credentials, handles_file, target_folder, trending):
-    list_of_handles = get_queue(handles_file) if not trending else get_trending_handles(auth_list)
-    combined_tuple_handle_auth = []
-    counter = 0
-    api_list = [init_twitterAPI(x) for x in auth_list]
-    for handle in list_of_handles:
-        combined_tuple_handle_auth.append((handle, api_list[counter % len(auth_list)]))
-        counter += 1
-    chunk_size = 1
-    executor = ProcessPoolExecutor(max_workers=int(no_of_threads))
-    logging.getLogger().handlers = []
-    with executor:
-        executor.map(crawl_twitter, combined_tuple_handle_auth, repeat(db_credentials), repeat(target_folder),
-                     repeat(db_credentials['tablename']), repeat(trending), chunksize=chunk_size)
+def init_crawler(no_of_threads, auth_list, db_credentials, handles_file, target_folder, trending, engine="process",
+                 concurrency=DEFAULT_CONCURRENCY, pipeline_conf=DEFAULT_PIPELINE, sink=None, backfill=False,
+                 distributed=False, dedup_capacity=DEFAULT_CAPACITY, metrics_port=DEFAULT_METRICS_PORT,
+                 woeids=(INDIA_ID_YAHOO,), daemon=False, trending_interval=DEFAULT_TRENDING_INTERVAL,
+                 search_windows=DEFAULT_SEARCH_WINDOWS):
+    job_worker = None
+    if distributed:
+        # handles come from the jobs table instead of the handles file or the trending topics
+        JobQueue(db_credentials).create_table()
+        job_worker = node_id()
+    # before the scheduler manager and the workers are forked, so that they keep running until the daemon stops
+    stop = stop_on_signals() if daemon else None
+    with SchedulerManager() as manager, Heartbeat(db_credentials, job_worker) if distributed else nullcontext():
+        scheduler = manager.RateLimitScheduler(len(auth_list))
+        metrics_registry = manager.MetricsRegistry()
+        metrics_server = start_metrics(metrics_registry, metrics_port)
+        metrics_pusher = start_metrics_push(metrics_registry)
+        if distributed:
+            list_of_handles = claim_jobs(db_credentials, job_worker, search=trending)
+        elif daemon:
+            list_of_handles = None
+        else:
+            list_of_handles = get_queue(handles_file) if not trending else get_trending_handles(auth_list, scheduler,
+                                                                                                woeids)
+        tablename = db_credentials['tablename'] if db_credentials else None
+        seen_ids = seed_seen_ids(dedup_capacity, sink, db_credentials, target_folder, tablename)
+        if daemon:
+            run_trending_daemon(no_of_threads, auth_list, scheduler, db_credentials, target_folder, tablename,
+                                pipeline_conf, sink, backfill, (seen_ids, metrics_registry), stop, woeids,
+                                trending_interval, search_windows)
+            logging.getLogger().handlers = []
+        elif engine == "async":
+            from async_crawler import run_async_crawler
+            logging.getLogger().handlers = []
+            # every process streams its own shard of the handles file (or claims its own jobs) instead of
+            # receiving a slice of a list
+            run_async_crawler(no_of_threads, concurrency, auth_list, scheduler,
+                              list_of_handles if trending else None, db_credentials, target_folder, tablename,
+                              search=trending, pipeline_conf=pipeline_conf, sink=sink, backfill=backfill,
+                              initializer=init_worker, initargs=(seen_ids, metrics_registry),
+                              handles_file=handles_file if not trending else None, job_worker=job_worker,
+                              search_windows=search_windows)
+        else:
+            executor = ProcessPoolExecutor(max_workers=int(no_of_threads), initializer=init_worker,
+                                           initargs=(seen_ids, metrics_registry))
+            logging.getLogger().handlers = []
+            with executor:
+                submit_bounded(executor, crawl_twitter, list_of_handles, auth_list, scheduler, db_credentials,
+                               target_folder, tablename, trending, pipeline_conf, sink, backfill, job_worker,
+                               search_windows, window=int(no_of_threads) * SUBMIT_WINDOW_PER_WORKER)
+        set_log_file()
+        if seen_ids is not None:
+            logging.critical("Skipped {} tweets crawled before".format(seen_ids.skipped))
+        for credential, waited in enumerate(scheduler.wait_report()):
+            logging.critical("Credential {} waited {:.0f}s on rate limits".format(credential, waited))
+        metrics_pusher.close()
+        logging.critical("Metrics summary of the crawl " + json.dumps(metrics_registry.summary(), sort_keys=True))
+        if metrics_server is not None:
+            metrics_server.shutdown()
     return
 
 
+def start_metrics(metrics_registry, port):
+    """Serve the metrics of every process on port (0 turns it off) and count the handles of the state store"""
+    metrics = get_metrics()
+    for status in ("pending", "in_progress", "done", "failed"):
+        metrics.gauge_fn('tweetcrawler_crawl_state_handles', partial(_state_count, status), status=status)
+    if not port:
+        return None
+    try:
+        return serve_metrics(metrics_registry, port)
+    except OSError as e:
+        logging.error("Can't serve metrics on port {}: {}".format(port, e))
+        return None
+
+
+def _state_count(status):
+    return get_state().counts().get(status, 0)
+
+
+def seed_seen_ids(capacity, sink, db_credentials, output_folder, tablename):
+    """Tweet id filter shared by the workers, seeded with the ids already in the sink. None when disabled with a
+    capacity of 0 or when stored tweets are updated on conflict, as that needs the duplicates."""
+    if not capacity or (db_credentials and db_credentials.get('on_conflict') == "update"):
+        return None
+    seen_ids = SeenIds(capacity)
+    store = open_sink(sink, db_credentials, output_folder, tablename)
+    try:
+        seeded = seen_ids.seed(store.existing_ids(seen_ids.capacity // 2))
+    finally:
+        store.close()
+    logging.info("Seeded the tweet id filter with {} ids".format(seeded))
+    return seen_ids
+
+
 def get_user_input(input_type):
     if type == "twitterauth":
         auth_dct = {'consumer_key': getpass.getpass(prompt="Enter the consumer key obtained from twitter"),
@@ -234,7 +305,7 @@ def get_user_input(input_type):
 def get_conf_file():
     configuration = {}
     config = configparser.ConfigParser()
-    config.read('./tweet.ini')
+    config.read(CONFIG_FILE)
     sections = config.sections()
     if 'Database' in sections:
         section = "Database"
@@ -243,7 +314,17 @@ def get_conf_file():
                                            'dbpass': config.get(section, 'dbpass'),
                                            'dbhost': config.get(section, 'dbhost'),
                                            'dbport': config.get(section, 'dbport'),
-                                           'tablename': config.get(section, 'tablename')}
+                                           'tablename': config.get(section, 'tablename'),
+                                           'on_conflict': config.get(section, 'OnConflict',
+                                                                     fallback="nothing").strip('"'),
+                                           'pool_size': config.get(section, 'PoolSize', fallback="4").strip('"'),
+                                           'top_n': int(config.get(section, 'ExpandTopN', fallback="0").strip('"'))
+                                           or None,
+                                           'jobs_table': config.get(section, 'JobsTable',
+                                                                    fallback="crawl_jobs").strip('"'),
+                                           'lease': config.get(section, 'LeaseSeconds', fallback="300").strip('"'),
+                                           'max_attempts': config.get(section, 'MaxAttempts',
+                                                                      fallback="3").strip('"')}
     else:
         configuration['db_credentials'] = None
     if 'Twitter' in sections:
@@ -258,121 +339,362 @@ def get_conf_file():
         section = "System"
         configuration["threads"] = config.get(section, "Threads")
         configuration["target_folder"] = config.get(section, "CSVFolder")
+        configuration["engine"] = config.get(section, "Engine", fallback="process").strip('"')
+        configuration["sink"] = config.get(section, "Sink", fallback="").strip('"') or None
+        configuration["backfill"] = config.get(section, "Backfill", fallback="false").strip('"').lower() == "true"
+        configuration["metrics_port"] = int(config.get(section, "MetricsPort",
+                                                       fallback=str(DEFAULT_METRICS_PORT)).strip('"'))
+        configuration["dedup_capacity"] = int(config.get(section, "DedupCapacity",
+                                                         fallback=str(DEFAULT_CAPACITY)).strip('"'))
+        configuration["concurrency"] = int(config.get(section, "Concurrency",
+                                                      fallback=str(DEFAULT_CONCURRENCY)).strip('"'))
+        configuration["search_windows"] = int(config.get(section, "SearchWindows",
+                                                         fallback=str(DEFAULT_SEARCH_WINDOWS)).strip('"'))
+        configuration["woeids"] = parse_woeids(config.get(section, "TrendingWoeids", fallback=INDIA_ID_YAHOO))
+        configuration["trending_interval"] = float(config.get(section, "TrendingInterval",
+                                                              fallback=str(DEFAULT_TRENDING_INTERVAL)).strip('"'))
+        configuration["pipeline"] = {'normalizers': int(config.get(section, "Normalizers", fallback="1").strip('"')),
+                                     'writers': int(config.get(section, "Writers", fallback="1").strip('"')),
+                                     'flush_size': int(config.get(section, "FlushSize", fallback="500").strip('"')),
+                                     'flush_interval': float(config.get(section, "FlushInterval",
+                                                                        fallback="5").strip('"')),
+                                     'queue_size': int(config.get(section, "QueueSize", fallback="64").strip('"')),
+                                     # handed to the sink, see get_pipeline
+                                     'row_group_size': int(config.get(section, "ParquetRowGroupSize",
+                                                                      fallback=str(PARQUET_ROW_GROUP_SIZE)).strip('"'))}
     return configuration
 
 
-def get_next_level_handles(database, user, password, host, port, rt=True):
-    with pg_get_conn(database, user, password, host, port) as conn:
-        cur = conn.cursor()
-        if rt:
-            cur.execute("""Select retweeted_status_user_handle from tweet_articles_tweepy""")
-        else:
-            cur.execute("""Select * from tweet_articles_tweepy""")
-        ans = cur.fetchall()
-    lse = set(x[0].replace("{", "").replace("}", "") for x in ans) if not rt else set(x[0] for x in ans)
-    ans_handles = []
-    if not rt:
-        for x in lse:
-            for y in x.split(","):
-                if y != '':
-                    ans_handles.append(y)
+def parse_woeids(value):
+    """Comma separated Yahoo WOEIDs of the places whose trends are crawled"""
+    return tuple(woeid.strip() for woeid in value.strip('"').split(',') if woeid.strip())
+
+
+def get_next_level_handles(database, user, password, host, port, rt=True, tablename=DEFAULT_TABLENAME,
+                           since=None, until=None, top_n=None):
+    """Handles retweeted (or mentioned when rt is False) in the tweets ingested with since < crawled_at <= until, most
+    frequent first and capped to the top_n when set. The handles are counted by Postgres and streamed through a server
+    side cursor, the table is never loaded into memory."""
+    if rt:
+        handles = "lower(retweeted_status_user_handle)"
     else:
-        ans_handles = list(lse)
-    return ans_handles
-
-
-def write_next_handles(new_handles, path_old_file):
-    old_handles = set()
-    with open(path_old_file) as o_handles:
-        for o_handle in o_handles:
-            if o_handle.startswith('@'):
-                o_handle = o_handle.replace('@', '')
-            old_handles.add(o_handle)
-    new_handles = set(new_handles)
-    next_level_handles = new_handles.difference(old_handles)
+        # lists are stored as array literals, screen names never need quoting in them
+        handles = "lower(unnest(string_to_array(trim(both '{}' from user_mentions_name), ',')))"
+    query = ("select handle, count(*) as frequency from (select {} as handle from {} where crawled_at > %s and "
+             "crawled_at <= %s) as mentions where handle <> '' group by handle order by frequency desc, handle "
+             "limit %s".format(handles, tablename))
+    # a psycopg2 connection used as a context manager only ends the transaction, it is closed here
+    conn = pg_get_conn(database, user, password, host, port)
+    try:
+        # server side cursors only live inside a transaction
+        conn.autocommit = False
+        with conn.cursor(name="next_level_handles") as cur:
+            cur.itersize = 10000
+            cur.execute(query, (since or '-infinity', until or 'infinity', top_n))
+            for handle, _ in cur:
+                yield handle
+    finally:
+        conn.close()
+
+
+def write_next_handles(new_handles, path_old_file, top_n=None):
+    """Replace the handles file with the first top_n new handles not in it, appending the old ones to the .bk file.
+    Both files are streamed and the new file only replaces the old one once it is complete."""
+    old_handles = get_queue(path_old_file)
+    seen = BloomFilter(os.path.getsize(path_old_file) // MIN_BYTES_PER_HANDLE + 1, 1e-5)
     with open(path_old_file + ".bk", 'a') as f:
         for item in old_handles:
+            seen.add(item)
             f.write("%s\n" % item)
-    with open(path_old_file, 'w') as f:
-        for item in next_level_handles:
-            f.write("%s\n" % item)
+    written = 0
+    with open(path_old_file + ".tmp", 'w') as f:
+        for item in new_handles:
+            if top_n and written >= top_n:
+                break
+            if item not in seen:
+                f.write("%s\n" % item)
+                written += 1
+    os.replace(path_old_file + ".tmp", path_old_file)
+    logging.info("Wrote {} next level handles to {}".format(written, path_old_file))
     return
 
 
+def get_expansion_watermark(db_credentials):
+    """(since, until) ingestion times of the tweets a snowball expansion uses: since is where the previous expansion
+    stopped and until the newest crawled_at of the table. Tweet ids follow posting time, not the time a tweet was
+    crawled, so backfills and new handles would land below an id watermark. A write still open carries its start
+    time, so the last EXPANSION_SETTLE seconds are left to the next expansion."""
+    with pg_get_conn(db_credentials['dbname'], db_credentials['dbuser'], db_credentials['dbpass'],
+                     db_credentials['dbhost'], db_credentials['dbport']) as conn:
+        with conn.cursor() as cur:
+            cur.execute("create table if not exists snowball_expansions (tablename text primary key, "
+                        "crawled_until timestamptz not null, expanded_at timestamptz not null default now())")
+            cur.execute("select crawled_until from snowball_expansions where tablename = %s",
+                        (db_credentials['tablename'],))
+            row = cur.fetchone()
+            since = row[0] if row else None
+            cur.execute("select max(crawled_at) from {} where crawled_at <= now() - make_interval(secs => %s)"
+                        .format(db_credentials['tablename']), (EXPANSION_SETTLE,))
+            until = cur.fetchone()[0]
+    conn.close()
+    return since, until
+
+
+def save_expansion_watermark(db_credentials, until):
+    with pg_get_conn(db_credentials['dbname'], db_credentials['dbuser'], db_credentials['dbpass'],
+                     db_credentials['dbhost'], db_credentials['dbport']) as conn:
+        with conn.cursor() as cur:
+            cur.execute("insert into snowball_expansions (tablename, crawled_until) values (%s, %s) "
+                        "on conflict (tablename) do update set crawled_until = excluded.crawled_until, "
+                        "expanded_at = now()", (db_credentials['tablename'], until))
+    conn.close()
+
+
 def repopulate_handles(conf):
-    handles = get_next_level_handles(conf['db_credentials']['dbname'], conf['db_credentials']['dbuser'],
-                                     conf['db_credentials']['dbpass'], conf['db_credentials']['dbhost'],
-                                     conf['db_credentials']['dbport'])
-    write_next_handles(handles, conf['handles'])
+    db_credentials = conf['db_credentials']
+    since, until = get_expansion_watermark(db_credentials)
+    if until is None or (since is not None and until <= since):
+        sys.exit("No tweets crawled since the last expansion")
+    logging.info("Expanding handles from tweets crawled after {} until {}".format(since, until))
+    handles = get_next_level_handles(db_credentials['dbname'], db_credentials['dbuser'], db_credentials['dbpass'],
+                                     db_credentials['dbhost'], db_credentials['dbport'],
+                                     tablename=db_credentials['tablename'], since=since, until=until)
+    # the cap applies to the handles that are actually new, so it is left to write_next_handles
+    write_next_handles(handles, conf['handles'], db_credentials.get('top_n'))
+    save_expansion_watermark(db_credentials, until)
     return
 
 
-def get_uncrawled_handles(trending_topics):
-    current_queries = [trend['name'] for trend in trending_topics[0]['trends']]
-    try:
-        crawled_queries = []
-        with open(PICKLE_FILE_CRAWLED_DATA, 'r', encoding="utf-8") as f:
-            for line in f:
-                crawled_queries.append(line.strip())
-        queries_to_crawl = list(set(current_queries).difference(set(crawled_queries)))
-        if len(queries_to_crawl) <= 0:
-            sys.exit("No new queries to crawl, exiting")
-        logging.info("Crawling {} new trending handles".format(len(queries_to_crawl)))
-        return queries_to_crawl
-    except (OSError, IOError, FileNotFoundError) as e:
-        open(PICKLE_FILE_CRAWLED_DATA, 'a').close()
-        return current_queries
-
-
-def get_trending_handles(auth_dict):
-    api = init_twitterAPI(auth_dict[0])
-    trending_topics = api.trends_place(INDIA_ID_YAHOO)
-    trending_topics = get_uncrawled_handles(trending_topics)
-    return trending_topics
+def enqueue_jobs(conf):
+    """Queue the handles file, or the current trending queries, in the jobs table for the nodes of a distributed
+    crawl"""
+    if not conf['db_credentials']:
+        sys.exit("A distributed crawl needs the [Database] section or --dbname and --dbuser")
+    jobs = JobQueue(conf['db_credentials'])
+    jobs.create_table()
+    if conf['trending']:
+        names = get_trending_handles(conf['authcsv'], RateLimitScheduler(len(conf['authcsv'])),
+                                     conf.get('woeids', (INDIA_ID_YAHOO,)))
+    else:
+        names = get_queue(conf['handles'])
+    logging.critical("Queued {} jobs in {}".format(jobs.enqueue(names, search=conf['trending']), jobs.table))
+    return
+
+
+def get_uncrawled_handles(current_queries, exclude=(), max_failures=MAX_QUERY_FAILURES):
+    """Queries of current_queries that were never crawled to the end and are not in exclude. Queries whose last
+    max_failures crawls failed are given up on, a query failing the same way every time would otherwise take a worker
+    on every poll of the daemon."""
+    state = get_state()
+    crawled_queries = state.crawled(current_queries, search=True)
+    failing = state.failing(current_queries, max_failures, search=True) if max_failures else set()
+    if failing:
+        logging.warning("Not retrying {} queries that failed {} times in a row: {}".format(
+            len(failing), max_failures, ", ".join(sorted(failing))))
+    return [query for query in current_queries
+            if query not in crawled_queries and query not in failing and query not in exclude]
+
+
+def get_trending_queries(auth_dict, scheduler, woeids=(INDIA_ID_YAHOO,)):
+    """Trending queries of every WOEID, mapped to the first WOEID they trend in"""
+    queries = {}
+    for woeid in woeids:
+        trending_topics = call_api(scheduler, get_api_list(auth_dict), 'trends_place', id=woeid)
+        for trend in trending_topics[0]['trends']:
+            queries.setdefault(trend['name'], woeid)
+    return queries
+
+
+def get_trending_handles(auth_dict, scheduler, woeids=(INDIA_ID_YAHOO,)):
+    queries_to_crawl = get_uncrawled_handles(list(get_trending_queries(auth_dict, scheduler, woeids)))
+    if len(queries_to_crawl) <= 0:
+        sys.exit("No new queries to crawl, exiting")
+    logging.info("Crawling {} new trending handles".format(len(queries_to_crawl)))
+    return queries_to_crawl
+
+
+def stop_on_signals():
+    """Event set on SIGTERM or SIGINT instead of exiting. Processes forked afterwards inherit the handlers, so
+    `pkill -f` or Ctrl-C hitting every process of the crawler only stops the polling of the daemon."""
+    stop = threading.Event()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(sig, lambda signum, frame: stop.set())
+    return stop
+
+
+def run_trending_daemon(no_of_threads, auth_list, scheduler, db_credentials, target_folder, tablename, pipeline_conf,
+                        sink, backfill, initargs, stop, woeids=(INDIA_ID_YAHOO,), interval=DEFAULT_TRENDING_INTERVAL,
+                        search_windows=DEFAULT_SEARCH_WINDOWS):
+    """Poll the trends of woeids every interval seconds and crawl the queries not crawled yet on one long lived
+    process pool until stop is set. Queries being crawled then finish, the ones still waiting are dropped and
+    picked up by the next run.
+    """
+    new_pool = partial(ProcessPoolExecutor, max_workers=int(no_of_threads), initializer=init_worker,
+                       initargs=initargs)
+    executor = new_pool()
+    metrics = get_metrics()
+    state = get_state()
+    in_flight = {}
+    while not stop.is_set():
+        finished = [query for query, future in in_flight.items() if future.done()]
+        # a query is only released once its tweets are written, or the next poll would crawl it again
+        still_writing = state.in_progress(finished, search=True)
+        for query in finished:
+            error = in_flight[query].exception()
+            if error is not None:
+                logging.error("Crawl of trending query " + query + " failed: " + str(error))
+            elif query in still_writing:
+                continue
+            del in_flight[query]
+        try:
+            current = get_trending_queries(auth_list, scheduler, woeids)
+        except Exception as e:
+            logging.error("Can't fetch trending topics: " + str(e))
+            current = {}
+        new_queries = get_uncrawled_handles(list(current), exclude=in_flight)
+        for query in new_queries:
+            try:
+                future = executor.submit(crawl_twitter, query, auth_list, scheduler, db_credentials, target_folder,
+                                         tablename, True, pipeline_conf, sink, backfill, None, search_windows)
+            except BrokenProcessPool:
+                logging.error("A worker process died, starting a new process pool")
+                executor.shutdown(wait=False)
+                executor = new_pool()
+                future = executor.submit(crawl_twitter, query, auth_list, scheduler, db_credentials, target_folder,
+                                         tablename, True, pipeline_conf, sink, backfill, None, search_windows)
+            in_flight[query] = future
+            metrics.inc('tweetcrawler_trending_queries_total', woeid=current[query])
+        logging.info("{} trending queries, {} new, {} in flight".format(len(current), len(new_queries),
+                                                                        len(in_flight)))
+        stop.wait(interval)
+    logging.critical("Stopping, letting the running trending queries finish")
+    # queries still waiting for a worker are dropped, the next run picks them up again
+    for future in in_flight.values():
+        future.cancel()
+    executor.shutdown(wait=True)
+    return
 
 
 def get_conf_user():
-    configuration = {}
     parser = argparse.ArgumentParser(description="Multi-Threaded crawler for crawling Twitter")
     parser.add_argument("--authcsv", default=None,
                         help="The path to the csv file containing authorization tokens for twitter")
     parser.add_argument("--dbname", default=None, help="Postgres database in which to enter the crawled data")
     parser.add_argument("--dbuser", default=None, help="User name for the Postgres database ")
-    parser.add_argument("--threads", default=1, help="Number of threads to use for crawling")
-    parser.add_argument("--handles", default='./handles.txt',
-                        help="Path to file containing the handles(each on newline) to crawl")
-    parser.add_argument("--folder", default='./tweets/',
-                        help="Path to folder where tweets CSV file would be dumped")
+    parser.add_argument("--threads", default=None, help="Number of threads to use for crawling")
+    parser.add_argument("--handles", default=None,
+                        help="Path to file containing the handles(each on newline) to crawl, ./handles.txt by default")
+    parser.add_argument("--folder", default=None,
+                        help="Path to folder where tweets CSV file would be dumped, ./tweets/ by default")
+    parser.add_argument("--engine", default=None, choices=["process", "async"],
+                        help="process: one handle per worker process, async: many handles per process over asyncio")
+    parser.add_argument("--concurrency", default=None, type=int,
+                        help="Number of handles crawled concurrently by each process of the async engine")
+    parser.add_argument("--sink", default=None, choices=["postgres", "csv", "parquet", "sqlite"],
+                        help="Where to write tweets, defaults to postgres when a database is set and csv otherwise")
+    parser.add_argument("--backfill", default=False, action="store_true",
+                        help="Crawl whole timelines again instead of only the tweets newer than the last crawl")
+    parser.add_argument("--dedup-capacity", default=None, type=int,
+                        help="Tweet ids remembered to drop tweets crawled before, 0 turns it off")
+    parser.add_argument("--metrics-port", default=None, type=int,
+                        help="Port of the local Prometheus metrics endpoint, 0 turns it off")
+    parser.add_argument("--enqueue", default=False, action="store_true",
+                        help="Queue the handles (or trending queries) in the jobs table of the database and exit")
+    parser.add_argument("--distributed", default=False, action="store_true",
+                        help="Crawl the jobs queued in the database, start one such node per machine")
+    parser.add_argument("--top-n", default=None, type=int,
+                        help="With -r keep only the N handles retweeted most often since the last expansion")
     parser.add_argument("-r", default=None,
                         help="Populate the handles file, pass anything as value", action='store_true')
     parser.add_argument("-trending", default=False, help="Crawl tweets for currently trending hashtags",
                         action="store_true")
+    parser.add_argument("--daemon", default=False, action="store_true",
+                        help="With -trending keep running, crawling new trending queries every --interval seconds")
+    parser.add_argument("--woeids", default=None,
+                        help="Comma separated Yahoo WOEIDs whose trends to crawl, defaults to India")
+    parser.add_argument("--search-windows", default=None, type=int,
+                        help="Id windows of a high volume search crawled at once, 1 turns splitting off")
+    parser.add_argument("--interval", default=None, type=float,
+                        help="Seconds between two polls of the trending topics in daemon mode")
     args = parser.parse_args()
-    if len(sys.argv) <= 3:
-        conf = get_conf_file()
-        if args.r:
-            repopulate_handles(conf)
-            sys.exit("Reset the handles file successfully")
-        if args.trending:
-            conf['trending'] = True
-            logging.info("Crawling trending tweets")
-        else:
-            conf['trending'] = False
-        return conf
-    configuration["threads"] = args.threads
-    configuration["target_folder"] = args.folder
-    if not args.handles:
-        parser.error("No handles file specified !")
+    if args.daemon and not args.trending:
+        parser.error("--daemon needs -trending")
+    if args.daemon and args.distributed:
+        parser.error("--daemon can't be combined with --distributed, enqueue the trending queries instead")
+    # tweet.ini is read unless the credentials are passed on the command line, the other options override it
+    if any(getattr(args, option) is not None for option in CLI_ONLY_OPTIONS) or not os.path.exists(CONFIG_FILE):
+        conf = get_conf_args(parser, args)
     else:
-        configuration['handles'] = args.handles
+        conf = get_conf_file()
+        if args.threads:
+            conf['threads'] = args.threads
+        if args.handles:
+            conf['handles'] = args.handles
+        if args.folder:
+            conf['target_folder'] = args.folder
+    if args.r:
+        if not conf['db_credentials']:
+            parser.error("-r needs the [Database] section or --dbname and --dbuser")
+        if args.top_n:
+            conf['db_credentials']['top_n'] = args.top_n
+        repopulate_handles(conf)
+        sys.exit("Reset the handles file successfully")
+    conf['trending'] = args.trending
+    if args.trending:
+        logging.info("Crawling trending tweets")
+    if args.engine:
+        conf['engine'] = args.engine
+    if args.concurrency:
+        conf['concurrency'] = args.concurrency
+    if args.sink:
+        conf['sink'] = args.sink
+    conf['backfill'] = args.backfill or conf.get('backfill', False)
+    conf['distributed'] = args.distributed
+    if args.dedup_capacity is not None:
+        conf['dedup_capacity'] = args.dedup_capacity
+    if args.metrics_port is not None:
+        conf['metrics_port'] = args.metrics_port
+    conf['daemon'] = args.daemon
+    if args.search_windows is not None:
+        conf['search_windows'] = args.search_windows
+    if args.woeids:
+        conf['woeids'] = parse_woeids(args.woeids)
+    if args.interval:
+        conf['trending_interval'] = args.interval
+    if args.enqueue:
+        enqueue_jobs(conf)
+        sys.exit("Queued the jobs successfully")
+    if args.distributed and not conf['db_credentials']:
+        parser.error("--distributed needs the [Database] section or --dbname and --dbuser")
+    return conf
+
+
+def get_conf_args(parser, args):
+    """Configuration of a run without tweet.ini, from the command line and the defaults"""
+    configuration = {"threads": args.threads or 1,
+                     "target_folder": args.folder or './tweets/',
+                     "handles": args.handles or './handles.txt',
+                     "engine": "process",
+                     "concurrency": DEFAULT_CONCURRENCY,
+                     "sink": None,
+                     "backfill": False,
+                     "dedup_capacity": DEFAULT_CAPACITY,
+                     "metrics_port": DEFAULT_METRICS_PORT,
+                     "search_windows": DEFAULT_SEARCH_WINDOWS,
+                     "woeids": (INDIA_ID_YAHOO,),
+                     "trending_interval": DEFAULT_TRENDING_INTERVAL}
     if bool(args.dbname) ^ bool(args.dbuser):  # check if only one of db parameter is set. Used XOR
         parser.error("Both --dbname and --dbuser should be set, you've set only one of them")
     if args.dbname:
         configuration['db_credentials'] = {'dbname': args.dbname, 'dbuser': args.dbuser, 'dbpass': getpass.getpass(
-            prompt="Please enter password for the user of the postgres database ")}
+            prompt="Please enter password for the user of the postgres database "), 'dbhost': None, 'dbport': None,
+                                           'tablename': DEFAULT_TABLENAME}
     else:
         configuration['db_credentials'] = None
-    if not args.authcsv:
+    if args.r:
+        # a snowball expansion only reads the database
+        configuration['authcsv'] = None
+    elif not args.authcsv:
         auth_dct = get_user_input('twitterauth')
         configuration['authcsv'] = [auth_dct]
     else:
@@ -388,7 +710,19 @@ if __name__ == "__main__":
                  db_credentials=configuration['db_credentials'],
                  handles_file=configuration['handles'],
                  target_folder=configuration["target_folder"],
-                 trending=configuration['trending'])
+                 trending=configuration['trending'],
+                 engine=configuration.get('engine', "process"),
+                 concurrency=configuration.get('concurrency', DEFAULT_CONCURRENCY),
+                 pipeline_conf=configuration.get('pipeline', DEFAULT_PIPELINE),
+                 sink=configuration.get('sink'),
+                 backfill=configuration.get('backfill', False),
+                 distributed=configuration.get('distributed', False),
+                 dedup_capacity=configuration.get('dedup_capacity', DEFAULT_CAPACITY),
+                 metrics_port=configuration.get('metrics_port', DEFAULT_METRICS_PORT),
+                 woeids=configuration.get('woeids', (INDIA_ID_YAHOO,)),
+                 daemon=configuration.get('daemon', False),
+                 trending_interval=configuration.get('trending_interval', DEFAULT_TRENDING_INTERVAL),
+                 search_windows=configuration.get('search_windows', DEFAULT_SEARCH_WINDOWS))
 
 # TODO: reading from csv files for auth credentials can also be optimized using pandas
 # TODO: check for robust handling of in memory data. Can be a problem in case of large crawls.
@@ -0,0 +1,235 @@
+"""Asyncio crawl engine
+
+Instead of one process per handle blocking on every HTTP call, each worker process runs an event loop that keeps
+many timeline/search paginations in flight over a pooled aiohttp session. Pages go through the same
+fetch -> normalize -> sink pipeline used by the process engine. Credentials are leased per request from the shared
+rate limit scheduler.
+"""
+import asyncio
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from urllib.parse import urlencode
+
+import aiohttp
+from oauthlib.oauth1 import Client as OAuth1Client
+
+from crawl_state import get_state
+from handle_source import shard_handles
+from job_queue import claim_jobs, finish_job
+from pipeline import DEFAULT_PIPELINE, CrawlPipeline, log_handle_crawled, save_checkpoint
+from metrics import get_metrics
+from ratelimit import api_host, update_from_headers
+from search_windows import DEFAULT_SEARCH_WINDOWS, plan_windows
+from seen_ids import get_seen_ids
+from storage import open_sink
+
+API_ROOT = "https://{}/1.1"
+TIMELINE_PATH = "/statuses/user_timeline.json"
+SEARCH_PATH = "/search/tweets.json"
+
+
+class AsyncTwitterClient:
+    """Signs and sends twitter API requests for a list of credentials over one pooled session"""
+
+    def __init__(self, auth_list, scheduler, session, api_root=None):
+        self.signers = [OAuth1Client(dct['consumer_key'], client_secret=dct['consumer_secret'],
+                                     resource_owner_key=dct['access_token'],
+                                     resource_owner_secret=dct['access_token_secret']) for dct in auth_list]
+        self.scheduler = scheduler
+        self.session = session
+        self.api_root = api_root or API_ROOT.format(api_host())
+
+    async def lease(self, endpoint):
+        loop = asyncio.get_running_loop()
+        while True:
+            credential, wait = await loop.run_in_executor(None, self.scheduler.acquire, endpoint)
+            if wait <= 0:
+                return credential
+            await loop.run_in_executor(None, self.scheduler.record_wait, credential, wait)
+            get_metrics().inc('tweetcrawler_rate_limit_wait_seconds_total', wait, credential=credential)
+            await asyncio.sleep(wait)
+
+    async def get(self, endpoint, path, params):
+        loop = asyncio.get_running_loop()
+        metrics = get_metrics()
+        while True:
+            credential = await self.lease(endpoint)
+            uri = self.api_root + path + "?" + urlencode(params)
+            uri, headers, _ = self.signers[credential].sign(uri, http_method="GET")
+            with metrics.timer('tweetcrawler_api_request_seconds', endpoint=endpoint):
+                async with self.session.get(uri, headers=headers) as resp:
+                    if resp.status in (420, 429):
+                        metrics.inc('tweetcrawler_rate_limited_total', endpoint=endpoint)
+                        await loop.run_in_executor(None, self.scheduler.exhausted, credential, endpoint,
+                                                   resp.headers.get('x-rate-limit-reset'))
+                        continue
+                    await loop.run_in_executor(None, update_from_headers, self.scheduler, credential, endpoint,
+                                               dict(resp.headers))
+                    if resp.status >= 400:
+                        metrics.inc('tweetcrawler_api_errors_total', endpoint=endpoint, status=resp.status)
+                    resp.raise_for_status()
+                    return await resp.json()
+
+
+async def crawl_handle(client, curr_id, pipeline, search=False, backfill=False,
+                       search_windows=DEFAULT_SEARCH_WINDOWS):
+    """Paginate through the timeline (or search results) of one handle, handing every page to the pipeline. Only
+    tweets newer than the last crawl of the handle are fetched unless backfill is set, and an interrupted crawl
+    resumes below its last written page. A high volume search is split into id windows after its first page."""
+    loop = asyncio.get_running_loop()
+    endpoint, path = ('search', SEARCH_PATH) if search else ('user_timeline', TIMELINE_PATH)
+    params = {'tweet_mode': 'extended', 'count': 100, 'include_entities': 'true'}
+    if search:
+        params['q'] = curr_id
+    else:
+        params['screen_name'] = curr_id
+    since_id, max_id = get_state().start(curr_id, search, backfill)
+    if since_id:
+        params['since_id'] = since_id
+    if max_id:
+        params['max_id'] = max_id
+    first_page = True
+    while True:
+        page = await client.get(endpoint, path, params)
+        if search:
+            page = page.get('statuses', [])
+        if not page:
+            break
+        # blocks while the writers are behind, which is what slows the fetchers down
+        await loop.run_in_executor(None, pipeline.submit_page, curr_id, page)
+        params['max_id'] = page[-1]['id'] - 1
+        windows = plan_windows(page, since_id, search_windows) if search and first_page else []
+        if windows:
+            logging.info("Splitting search " + curr_id + " into {} windows".format(len(windows)))
+            await crawl_windows(client, curr_id, pipeline, windows, search_windows)
+            break
+        first_page = False
+
+
+async def crawl_windows(client, curr_id, pipeline, windows, search_windows):
+    """search_windows.crawl_windows on the event loop: search_windows windows of a split search in flight at once"""
+    errors = []
+    pending = set()
+    windows = list(windows)
+    while windows or pending:
+        while windows and len(pending) < search_windows:
+            pending.add(asyncio.ensure_future(crawl_search_window(client, curr_id, pipeline, windows.pop(0),
+                                                                  search_windows)))
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            try:
+                windows.extend(task.result())
+            except Exception as e:
+                logging.error("Search window of " + curr_id + " failed: " + str(e))
+                errors.append(e)
+    if errors:
+        raise errors[0]
+
+
+async def crawl_search_window(client, curr_id, pipeline, window, search_windows):
+    """Page through the (since_id, max_id] window of a split search, or return the windows the rest of it is split
+    into after its first page. Pages of windows don't move the resume cursor."""
+    loop = asyncio.get_running_loop()
+    since_id, max_id = window
+    params = {'tweet_mode': 'extended', 'count': 100, 'include_entities': 'true', 'q': curr_id,
+              'since_id': since_id, 'max_id': max_id}
+    first_page = True
+    while True:
+        page = (await client.get('search', SEARCH_PATH, params)).get('statuses', [])
+        if not page:
+            return []
+        await loop.run_in_executor(None, partial(pipeline.submit_page, curr_id, page, cursor=False))
+        params['max_id'] = page[-1]['id'] - 1
+        if first_page:
+            windows = plan_windows(page, since_id, search_windows)
+            if windows:
+                return windows
+            first_page = False
+
+
+async def crawl_handles(handles, auth_list, scheduler, db_credentials, output_folder, tablename, search, concurrency,
+                        pipeline_conf=DEFAULT_PIPELINE, sink=None, backfill=False, job_worker=None,
+                        search_windows=DEFAULT_SEARCH_WINDOWS):
+    if job_worker:
+        on_handle_done = partial(finish_job, db_credentials=db_credentials, worker=job_worker, search=search)
+    else:
+        on_handle_done = partial(log_handle_crawled, search=search)
+    pipeline_conf = dict(pipeline_conf)
+    store = open_sink(sink, db_credentials, output_folder, tablename, pipeline_conf.pop('row_group_size', None))
+    pipeline = CrawlPipeline(store, on_handle_done, **pipeline_conf,
+                             on_checkpoint=partial(save_checkpoint, search=search), seen=get_seen_ids())
+    # handles are pulled from the (possibly lazy) iterable only as fast as the workers take them
+    queue = asyncio.Queue(maxsize=concurrency)
+
+    async def feed():
+        loop = asyncio.get_running_loop()
+        handles_iter = iter(handles)
+        while True:
+            # claiming jobs hits the database and may wait for other nodes, keep that off the event loop
+            handle = await loop.run_in_executor(None, next, handles_iter, None)
+            if handle is None:
+                break
+            await queue.put(handle)
+        for _ in range(concurrency):
+            await queue.put(None)
+
+    async def worker(client):
+        loop = asyncio.get_running_loop()
+        while True:
+            curr_id = await queue.get()
+            if curr_id is None:
+                return
+            completed = False
+            try:
+                logging.info("Crawling handle " + curr_id)
+                await crawl_handle(client, curr_id, pipeline, search, backfill, search_windows)
+                completed = True
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # one bad handle must not stop the worker, and with it a share of the concurrency, for the whole run
+                logging.error("Can't crawl ID " + str(curr_id) + " exception: " + str(e))
+            finally:
+                # finish_handle blocks while the writer queue is full, so it runs off the event loop. Shielded, so a
+                # cancelled worker still finishes its handle before the cancellation goes on
+                await asyncio.shield(loop.run_in_executor(None, pipeline.finish_handle, curr_id, completed))
+
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=60)) as session:
+        client = AsyncTwitterClient(auth_list, scheduler, session)
+        await asyncio.gather(feed(), *(worker(client) for _ in range(concurrency)))
+    await asyncio.get_running_loop().run_in_executor(None, pipeline.close)
+
+
+def crawl_slice(handles, auth_list, scheduler, db_credentials, output_folder, tablename, search, concurrency,
+                pipeline_conf, sink, backfill, job_worker=None, search_windows=DEFAULT_SEARCH_WINDOWS):
+    """handles is a list of handles or a function returning an iterator over them, which lets a shard of the handles
+    file be streamed inside the worker process"""
+    if callable(handles):
+        handles = handles()
+    asyncio.run(crawl_handles(handles, auth_list, scheduler, db_credentials, output_folder, tablename, search,
+                              concurrency, pipeline_conf, sink, backfill, job_worker, search_windows))
+
+
+def run_async_crawler(no_of_processes, concurrency, auth_list, scheduler, handles, db_credentials, target_folder,
+                      tablename, search=False, pipeline_conf=DEFAULT_PIPELINE, sink=None, backfill=False,
+                      initializer=None, initargs=(), handles_file=None, job_worker=None,
+                      search_windows=DEFAULT_SEARCH_WINDOWS):
+    """Split the handles round robin over a few processes, each crawling up to concurrency handles at once. With
+    handles_file every process streams its own shard of the file instead, and on a node of a distributed crawl
+    (job_worker set) every process claims its own jobs from the database."""
+    no_of_processes = int(no_of_processes)
+    if job_worker:
+        slices = [partial(claim_jobs, db_credentials, job_worker, search) for _ in range(no_of_processes)]
+    elif handles_file:
+        slices = [partial(shard_handles, handles_file, i, no_of_processes) for i in range(no_of_processes)]
+    else:
+        handles = [handle.strip() for handle in handles if handle.strip()]
+        slices = [handles[i::no_of_processes] for i in range(no_of_processes)]
+    with ProcessPoolExecutor(max_workers=no_of_processes, initializer=initializer, initargs=initargs) as executor:
+        for fut in [executor.submit(crawl_slice, s, auth_list, scheduler, db_credentials, target_folder, tablename,
+                                    search, int(concurrency), pipeline_conf, sink, backfill, job_worker,
+                                    search_windows)
+                    for s in slices if s]:
+            fut.result()
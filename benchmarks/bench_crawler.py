@@ -0,0 +1,240 @@
+"""End to end crawler benchmark against the local mock twitter API
+
+    python benchmarks/bench_crawler.py --handles 200 --threads 4 --sink csv postgres --dbname bench --dbuser postgres
+
+Starts benchmarks/mock_twitter.py, then runs init_crawler in a fresh working directory for every sink and reports
+tweets/sec, the peak RSS of the largest crawler process and CPU time per tweet. Every run is appended as one JSON line
+to --results together with the git commit, and compared with the previous run of the same configuration so
+regressions show up between versions.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import socket
+import sqlite3
+import ssl
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+import pandas as pd
+import psycopg2
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+from benchmarks.mock_twitter import make_certificate, serve
+from storage import SQLITE_FILE, SQLITE_TABLE
+
+BENCH_TABLE = "bench_tweet_articles"
+# schema of the README
+BENCH_TABLE_DDL = '''create table {} (
+    id bigint primary key, tweet_from text, created_at character varying, hashtags text, urls text,
+    user_mentions_id text, media text, user_mentions_name text, origin_device text, favorite_count bigint, text text,
+    in_reply_to_screen_name text, in_reply_to_user_id bigint, in_reply_to_status_id bigint, retweet_count bigint,
+    retweeted_status_text text, retweeted_status_url character varying, retweeted_status_id bigint,
+    retweeted_status_user_name text, retweeted_status_user_handle text, sentiment numeric,
+    crawled_at timestamptz not null default now())'''.format(BENCH_TABLE)
+COMPARED = ('tweets_per_sec', 'cpu_us_per_tweet', 'peak_rss_mb')
+
+# runs inside the crawler subprocess, in the benchmark working directory
+RUNNER = '''
+import json, os, sys
+sys.path.insert(0, {repo!r})
+import TweetCrawler
+TweetCrawler.PARENT_PROCESS_PID = os.getpid()
+TweetCrawler.set_log_file()
+kwargs = json.loads(sys.argv[1])
+TweetCrawler.init_crawler(**kwargs)
+'''
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def mock_stats(port, ca_file):
+    with urllib.request.urlopen("https://127.0.0.1:{}/stats".format(port),
+                                context=ssl.create_default_context(cafile=ca_file)) as resp:
+        return json.loads(resp.read())
+
+
+def reset_postgres(db_credentials):
+    with psycopg2.connect(database=db_credentials['dbname'], user=db_credentials['dbuser'],
+                          password=db_credentials['dbpass'], host=db_credentials['dbhost'],
+                          port=db_credentials['dbport']) as conn:
+        with conn.cursor() as cur:
+            cur.execute("drop table if exists " + BENCH_TABLE)
+            cur.execute(BENCH_TABLE_DDL)
+
+
+def count_written(sink, workdir, db_credentials):
+    if sink == "postgres":
+        with psycopg2.connect(database=db_credentials['dbname'], user=db_credentials['dbuser'],
+                              password=db_credentials['dbpass'], host=db_credentials['dbhost'],
+                              port=db_credentials['dbport']) as conn:
+            with conn.cursor() as cur:
+                cur.execute("select count(*) from " + BENCH_TABLE)
+                return cur.fetchone()[0]
+    folder = os.path.join(workdir, "tweets")
+    if sink == "sqlite":
+        with sqlite3.connect(os.path.join(folder, SQLITE_FILE)) as conn:
+            return conn.execute("select count(*) from " + SQLITE_TABLE).fetchone()[0]
+    if sink == "parquet":
+        import pyarrow.parquet as pq
+        return sum(pq.ParquetFile(os.path.join(root, name)).metadata.num_rows
+                   for root, _, names in os.walk(folder) for name in names if name.endswith(".parquet"))
+    total = 0
+    for name in os.listdir(folder) if os.path.exists(folder) else []:
+        # tweets with newlines in their text are quoted over several lines
+        total += len(pd.read_csv(os.path.join(folder, name), header=None, usecols=[0]))
+    return total
+
+
+def run_crawl(args, sink, port, ca_file):
+    """One crawl in a fresh working directory, returns the result record"""
+    workdir = tempfile.mkdtemp(prefix="bench_crawler_")
+    os.makedirs(os.path.join(workdir, "tweetCrawlerLog"))
+    handles_file = os.path.join(workdir, "handles.txt")
+    with open(handles_file, "w") as f:
+        for i in range(args.handles):
+            f.write("benchuser{}\n".format(i))
+    auth_list = [{'consumer_key': 'key{}'.format(i), 'consumer_secret': 'secret{}'.format(i),
+                  'access_token': 'token{}'.format(i), 'access_token_secret': 'tokensecret{}'.format(i)}
+                 for i in range(args.credentials)]
+    db_credentials = None
+    if sink == "postgres":
+        db_credentials = {'dbname': args.dbname, 'dbuser': args.dbuser, 'dbpass': args.dbpass,
+                          'dbhost': args.dbhost, 'dbport': args.dbport, 'tablename': BENCH_TABLE,
+                          'on_conflict': "nothing", 'pool_size': 4}
+        reset_postgres(db_credentials)
+    kwargs = {'no_of_threads': args.threads, 'auth_list': auth_list, 'db_credentials': db_credentials,
+              'handles_file': handles_file, 'target_folder': os.path.join(workdir, "tweets"), 'trending': False,
+              'engine': args.engine, 'concurrency': args.concurrency, 'sink': sink, 'metrics_port': 0}
+    env = dict(os.environ, TWITTER_API_HOST="127.0.0.1:{}".format(port), REQUESTS_CA_BUNDLE=ca_file,
+               SSL_CERT_FILE=ca_file)
+    before = mock_stats(port, ca_file)
+    start = time.time()
+    with open(os.path.join(workdir, "crawler.out"), "w+") as out:
+        proc = subprocess.Popen([sys.executable, "-c", RUNNER.format(repo=REPO), json.dumps(kwargs)], cwd=workdir,
+                                env=env, stdout=out, stderr=subprocess.STDOUT)
+        # the rusage of a reaped process includes the worker processes it reaped
+        _, status, usage = os.wait4(proc.pid, 0)
+        elapsed = time.time() - start
+        # negative signal number when killed, as Popen.returncode
+        exit_status = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+        if status:
+            out.seek(0)
+            print(out.read()[-4000:])
+    after = mock_stats(port, ca_file)
+    written = count_written(sink, workdir, db_credentials)
+    cpu = usage.ru_utime + usage.ru_stime
+    record = {'commit': git_commit(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'config': {'sink': sink, 'engine': args.engine, 'threads': args.threads,
+                         'concurrency': args.concurrency, 'handles': args.handles,
+                         'tweets_per_handle': args.tweets_per_handle, 'latency': args.latency,
+                         'rate_limit': args.rate_limit, 'credentials': args.credentials},
+              'exit_status': exit_status, 'seconds': round(elapsed, 2),
+              'tweets_served': after['tweets'] - before['tweets'], 'tweets_written': written,
+              'requests': after['requests'] - before['requests'],
+              'rate_limited': after['rate_limited'] - before['rate_limited'],
+              'tweets_per_sec': round(written / elapsed, 1),
+              'cpu_us_per_tweet': round(cpu / written * 10 ** 6, 1) if written else None,
+              # kilobytes on linux
+              'peak_rss_mb': round(usage.ru_maxrss / 1024, 1)}
+    if args.keep:
+        record['workdir'] = workdir
+    else:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return record
+
+
+def previous_run(results_file, config):
+    if not os.path.exists(results_file):
+        return None
+    last = None
+    with open(results_file) as f:
+        for line in f:
+            record = json.loads(line)
+            if record.get('config') == config:
+                last = record
+    return last
+
+
+def report(record, previous):
+    print("{sink:>8} {engine:>7} x{threads}: {tweets_written} tweets in {seconds}s".format(
+        **record['config'], tweets_written=record['tweets_written'], seconds=record['seconds']))
+    for key in COMPARED:
+        line = "    {:<18} {:>10}".format(key, record[key])
+        if previous and previous.get(key) and record[key] is not None:
+            line += "   {:+.1f}% vs {}".format((record[key] / previous[key] - 1) * 100, previous['commit'])
+        print(line)
+    if record['rate_limited']:
+        print("    rate limited {} of {} requests".format(record['rate_limited'], record['requests']))
+    if record['tweets_written'] != record['tweets_served'] or record['exit_status']:
+        print("    WARNING: served {} tweets, wrote {}, exit status {}".format(
+            record['tweets_served'], record['tweets_written'], record['exit_status']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--handles", type=int, default=200)
+    parser.add_argument("--tweets-per-handle", type=int, default=800)
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--engine", default="process", choices=["process", "async"])
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--sink", nargs="+", default=["csv"], choices=["csv", "postgres", "parquet", "sqlite"])
+    parser.add_argument("--credentials", type=int, default=4)
+    parser.add_argument("--latency", type=float, default=0.02, help="Seconds added to every mock API response")
+    parser.add_argument("--rate-limit", type=int, default=None,
+                        help="Requests per credential and endpoint per --window before the mock answers 429")
+    parser.add_argument("--window", type=int, default=10)
+    parser.add_argument("--dbname", default="postgres")
+    parser.add_argument("--dbuser", default="postgres")
+    parser.add_argument("--dbpass", default="")
+    parser.add_argument("--dbhost", default="localhost")
+    parser.add_argument("--dbport", default="5432")
+    parser.add_argument("--results", default=os.path.join(REPO, "benchmarks", "results.jsonl"))
+    parser.add_argument("--keep", action="store_true", help="Keep the working directories of the crawls")
+    args = parser.parse_args()
+
+    certdir = tempfile.mkdtemp(prefix="mock_twitter_")
+    certfile, keyfile = make_certificate(certdir)
+    port = free_port()
+    server = multiprocessing.Process(target=serve, args=(port, certfile, keyfile), daemon=True,
+                                     kwargs={'tweets_per_handle': args.tweets_per_handle, 'latency': args.latency,
+                                             'rate_limit': args.rate_limit, 'window': args.window})
+    server.start()
+    for _ in range(100):
+        try:
+            mock_stats(port, certfile)
+            break
+        except OSError:
+            time.sleep(0.1)
+    try:
+        for sink in args.sink:
+            record = run_crawl(args, sink, port, certfile)
+            report(record, previous_run(args.results, record['config']))
+            with open(args.results, "a") as f:
+                f.write(json.dumps(record, sort_keys=True) + "\n")
+    finally:
+        server.terminate()
+        shutil.rmtree(certdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
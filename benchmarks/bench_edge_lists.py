@@ -0,0 +1,101 @@
+"""Benchmark of construct_edge_list, rows per second on one core
+
+    python benchmarks/bench_edge_lists.py [--rows 200000]
+
+Compares edge_lists.construct_edge_lists with the previous per-URL loop over (user_from, user_mention, link) rows
+and checks that both produce the same edges in the same order.
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from edge_lists import construct_edge_lists
+
+SITES = ['ndtv', 'thehindu', 'indiatoday', 'livemint', 'scroll', 'thewire', 'news18', 'opindia', 'medium', 'msn']
+SHORTENERS = ['https://t.co/{}', 'http://bit.ly/{}', 'https://goo.gl/{}', 'https://www.youtube.com/watch?v={}',
+              'https://twitter.com/i/web/status/{}', 'https://www.facebook.com/{}']
+
+
+def legacy_construct_edge_list(cong):
+    usr_to_src = []
+    list_to_exclude = ['twitter', 'youtu', 'fllwrs', 'unfollowspy', 'livetv', 'pscp', 'live', 'ln.is', 'tinyurl',
+                       'facebook', 'bit.ly', 'goo.gl', 'instagram', 'google']
+    for x in cong:
+        if x[2]:
+            for url in x[2].split(','):
+                if not any(y in url for y in list_to_exclude) and x[0] not in url.replace('.', '_'):
+                    if url.endswith('.com') and url.startswith("http://www"):
+                        usr_to_src.append((x[0], url.split('.')[1].lower()))
+                    elif url.endswith('.com') and url.startswith("http://m"):
+                        usr_to_src.append((x[0], url.split('.')[1].lower()))
+                    elif url.endswith('.in') and url.startswith("http://www"):
+                        usr_to_src.append((x[0], url.split('.')[1].lower()))
+                    elif url.startswith("http://") or url.startswith("https://"):
+                        l_url = url.split('/')
+                        if len(l_url) >= 3 and '.' in l_url[2]:
+                            if l_url[2].startswith('www') or l_url[2].startswith('m'):
+                                usr_to_src.append((x[0], l_url[2].split('.')[1].lower()))
+                            else:
+                                usr_to_src.append((x[0], l_url[2].lower()))
+    ll = []
+    for i in cong:
+        if i[1]:
+            for x in i[1].split(','):
+                if (x != '@'):
+                    x = x.replace('@', '')
+                    ll.append((i[0], x))
+    return (ll, usr_to_src)
+
+
+def _url(rng):
+    site = rng.choice(SITES)
+    kind = rng.randrange(6)
+    if kind == 0:
+        return rng.choice(SHORTENERS).format(rng.randrange(10 ** 6))
+    if kind == 1:
+        return "http://www.{}.com".format(site)
+    if kind == 2:
+        return "http://m.{}.in".format(site)
+    if kind == 3:
+        return "https://www.{}.com/story/{}".format(site, rng.randrange(10 ** 4))
+    if kind == 4:
+        return "https://{}.co.in/{}".format(site, rng.randrange(10 ** 4))
+    return "https://blog.{}.com/{}".format(site, rng.randrange(10 ** 6))
+
+
+def make_rows(count, rng):
+    rows = []
+    for _ in range(count):
+        user = "user{}".format(rng.randrange(10 ** 4))
+        mentions = ','.join("@user{}".format(rng.randrange(10 ** 4)) for _ in range(rng.randrange(4)))
+        links = ','.join(_url(rng) for _ in range(rng.randrange(3)))
+        rows.append((user, mentions or None, links or None))
+    return rows
+
+
+def run(rows):
+    cong = make_rows(rows, random.Random(42))
+
+    start = time.process_time()
+    legacy = legacy_construct_edge_list(cong)
+    legacy_time = time.process_time() - start
+
+    start = time.process_time()
+    fast = construct_edge_lists(cong)
+    fast_time = time.process_time() - start
+
+    assert legacy == fast, "construct_edge_lists output differs from the legacy implementation"
+    print("{:>8} rows, {} user edges, {} source edges".format(rows, len(fast[0]), len(fast[1])))
+    print("legacy (per URL loop):          {:>10.0f} rows/sec/core".format(rows / legacy_time))
+    print("construct_edge_lists (cached):  {:>10.0f} rows/sec/core".format(rows / fast_time))
+    print("speedup: {:.1f}x".format(legacy_time / fast_time))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=200000)
+    run(parser.parse_args().rows)
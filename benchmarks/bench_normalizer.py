@@ -0,0 +1,77 @@
+"""Micro benchmark of the tweet normalizer, tweets per second on one core
+
+    python benchmarks/bench_normalizer.py [--tweets 20000]
+
+Compares normalize_tweet with the previous implementation, which built a tweepy Status model for every tweet and
+parsed its source with BeautifulSoup, and checks that both produce the same fields.
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bs4 import BeautifulSoup
+from tweepy.models import Status
+
+from benchmarks.synthetic import make_timeline
+from normalizer import normalize_tweet
+
+
+def legacy_normalize_tweet(post):
+    dc = {}
+    curr_post = post._json
+    dc['tweet_from'] = curr_post['user']['screen_name']
+    dc['created_at'] = curr_post['created_at']
+    ent_status_dct = curr_post.get("entities", False)
+    if ent_status_dct:
+        dc['hashtags'] = [x['text'] for x in curr_post['entities']['hashtags']]
+        dc['urls'] = [x['expanded_url'] for x in curr_post['entities']['urls']]
+        dc['user_mentions_id'] = [x['id'] for x in curr_post['entities']['user_mentions']]
+        if 'media' in ent_status_dct:
+            dc['media'] = [x['media_url_https'] for x in curr_post['entities']['media']]
+        dc['user_mentions_name'] = [x['screen_name'] for x in curr_post['entities']['user_mentions']]
+    origin_raw_html = BeautifulSoup(curr_post['source'], 'html.parser').a
+    dc['origin_device'] = origin_raw_html.string if origin_raw_html else None
+    dc['favorite_count'] = curr_post['favorite_count']
+    dc['text'] = curr_post['full_text']
+    dc['id'] = curr_post['id']
+    dc['in_reply_to_screen_name'] = curr_post['in_reply_to_screen_name']
+    dc['in_reply_to_user_id'] = curr_post['in_reply_to_user_id']
+    dc['in_reply_to_status_id'] = curr_post['in_reply_to_status_id']
+    dc['retweet_count'] = curr_post['retweet_count']
+    rt_status_dct = curr_post.get('retweeted_status', False)
+    if rt_status_dct:
+        dc['retweeted_status_text'] = curr_post['retweeted_status']['full_text']
+        dc['retweeted_status_url'] = [x['expanded_url'] for x in curr_post['retweeted_status']['entities']['urls']]
+        dc['retweeted_status_id'] = curr_post['retweeted_status']['id']
+        dc['retweeted_status_user_name'] = curr_post['retweeted_status']['user']['name']
+        dc['retweeted_status_user_handle'] = curr_post['retweeted_status']['user']['screen_name']
+    return dc
+
+
+def run(tweets):
+    rng = random.Random(42)
+    payload = make_timeline("benchmark", tweets, rng)
+
+    start = time.process_time()
+    legacy = [legacy_normalize_tweet(Status.parse(None, x)) for x in payload]
+    legacy_time = time.process_time() - start
+
+    start = time.process_time()
+    fast = [normalize_tweet(x) for x in payload]
+    fast_time = time.process_time() - start
+
+    assert legacy == fast, "normalize_tweet output differs from the legacy implementation"
+    print("{:>8} tweets".format(tweets))
+    print("legacy (tweepy Status + BeautifulSoup): {:>10.0f} tweets/sec/core".format(tweets / legacy_time))
+    print("normalize_tweet (raw JSON + cache):    {:>10.0f} tweets/sec/core".format(tweets / fast_time))
+    print("speedup: {:.1f}x".format(legacy_time / fast_time))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--tweets", type=int, default=20000)
+    run(parser.parse_args().tweets)
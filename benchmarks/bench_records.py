@@ -0,0 +1,64 @@
+"""Memory of buffered tweets, normalize_tweet dicts against TweetRecords
+
+    python benchmarks/bench_records.py [--tweets 100000]
+
+Decodes synthetic API pages one at a time, as the crawler does, keeps only the normalized tweets and reports the
+memory they hold (tracemalloc) and the time taken, then checks that both hold the same fields.
+"""
+import argparse
+import gc
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.synthetic import make_timeline
+from normalizer import TWEET_FIELDS, normalize_record, normalize_tweet
+from pipeline import DEFAULT_PIPELINE
+
+PAGE_SIZE = 200
+
+
+def buffer_tweets(pages, normalize):
+    """Normalized tweets of the encoded pages and the bytes they hold once the pages are gone"""
+    gc.collect()
+    tracemalloc.start()
+    start = time.process_time()
+    buffered = []
+    for page in pages:
+        buffered.extend(normalize(tweet) for tweet in json.loads(page))
+    elapsed = time.process_time() - start
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return buffered, size, elapsed
+
+
+def run(tweets):
+    payload = make_timeline("benchmark", tweets, random.Random(42))
+    pages = [json.dumps(payload[i:i + PAGE_SIZE]) for i in range(0, len(payload), PAGE_SIZE)]
+    del payload
+
+    dicts, dict_size, dict_time = buffer_tweets(pages, normalize_tweet)
+    records, record_size, record_time = buffer_tweets(pages, normalize_record)
+
+    for dc, record in zip(dicts, records):
+        assert all(record.get(field) == (tuple(dc[field]) if isinstance(dc.get(field), list) else dc.get(field))
+                   for field in TWEET_FIELDS), "TweetRecord fields differ from normalize_tweet"
+    scale = 100000 / tweets
+    print("{:>8} tweets buffered (flush size {} per handle by default)".format(tweets, DEFAULT_PIPELINE['flush_size']))
+    print("dicts (normalize_tweet):     {:>7.1f} MB per 100k tweets, {:>5.0f} bytes/tweet, {:.2f}s".format(
+        dict_size * scale / 2 ** 20, dict_size / tweets, dict_time))
+    print("TweetRecord (slots, tuples): {:>7.1f} MB per 100k tweets, {:>5.0f} bytes/tweet, {:.2f}s".format(
+        record_size * scale / 2 ** 20, record_size / tweets, record_time))
+    print("saved: {:.0f}%".format(100 * (1 - record_size / dict_size)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--tweets", type=int, default=100000)
+    run(parser.parse_args().tweets)
@@ -0,0 +1,110 @@
+"""Benchmark of the seed handle harvest against locally served ranking pages
+
+    python benchmarks/bench_seed_handles.py [--pages 22] [--latency 0.2]
+
+Serves generated pages shaped like the socialbakers rankings (with an ETag and latency seconds of delay per full
+response) and harvests them with the previous one page at a time loop, then with seed_handles.harvest_handles on an
+empty and on a warm page cache. Checks that all of them find the same handles.
+"""
+import argparse
+import hashlib
+import os
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bs4 import BeautifulSoup
+
+from seed_handles import harvest_handles
+
+HANDLES_PER_PAGE = 50
+
+
+def make_page(page):
+    rows = ''.join('<li><h2><span>Politician {0} ({1})</span></h2><p>followers</p></li>'.format(
+        i, "@Leader{}x{}".format(page, i)) for i in range(HANDLES_PER_PAGE))
+    return "<html><body><ul>{}</ul></body></html>".format(rows).encode("utf-8")
+
+
+class RankingHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    latency = 0.2
+    full = 0
+    not_modified = 0
+
+    def do_GET(self):
+        page = int(self.path.split("/page-")[1].split("/")[0])
+        body = make_page(page)
+        etag = '"{}"'.format(hashlib.md5(body).hexdigest())
+        if self.headers.get("If-None-Match") == etag:
+            RankingHandler.not_modified += 1
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        RankingHandler.full += 1
+        time.sleep(self.latency)
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html")
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def legacy_harvest(urls):
+    ls_fin = []
+    for url in urls:
+        html = urllib.request.urlopen(url)
+        soup = BeautifulSoup(html, 'html.parser')
+        intm = soup.find_all('h2')
+        for y in intm:
+            for x in y.find_all('span'):
+                ls_fin.append(x.text.split('(')[-1].replace(')', '').replace('@', ''))
+    return ls_fin
+
+
+def run(pages, latency):
+    RankingHandler.latency = latency
+    server = ThreadingHTTPServer(("127.0.0.1", 0), RankingHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    urls = ["http://127.0.0.1:{}/statistics/page-{}/?json".format(server.server_port, i) for i in range(1, pages + 1)]
+
+    start = time.perf_counter()
+    legacy = legacy_harvest(urls)
+    legacy_time = time.perf_counter() - start
+
+    with tempfile.TemporaryDirectory() as folder:
+        cache_file = os.path.join(folder, "seed_pages.db")
+        start = time.perf_counter()
+        cold = harvest_handles(urls, cache_file)
+        cold_time = time.perf_counter() - start
+        RankingHandler.full = RankingHandler.not_modified = 0
+        start = time.perf_counter()
+        warm = harvest_handles(urls, cache_file)
+        warm_time = time.perf_counter() - start
+    server.shutdown()
+
+    assert legacy == cold == warm, "harvest_handles found different handles than the legacy loop"
+    assert RankingHandler.full == 0 and RankingHandler.not_modified == pages, "the warm run downloaded pages again"
+    print("{} pages, {} handles, {:.0f} ms per page".format(pages, len(cold), latency * 1000))
+    print("legacy (sequential urlopen):   {:>7.2f} s".format(legacy_time))
+    print("harvest_handles (empty cache): {:>7.2f} s".format(cold_time))
+    print("harvest_handles (warm cache):  {:>7.2f} s, every page answered with 304".format(warm_time))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--pages", type=int, default=22)
+    parser.add_argument("--latency", type=float, default=0.2)
+    args = parser.parse_args()
+    run(args.pages, args.latency)
@@ -0,0 +1,100 @@
+"""Benchmark of the URL unshortener against a local redirecting server
+
+    python benchmarks/bench_unshortener.py [--links 500] [--latency 0.05]
+
+Serves short links /s/<n> that redirect (after latency seconds, like a remote shortener) to /story/<n> on a second
+host name, and resolves them with the previous one HEAD request at a time loop, then with Unshortener on an empty and
+on a warm cache. Checks that all of them find the same final URLs.
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import requests
+
+from unshortener import Unshortener, UrlCache
+
+
+class RedirectHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    latency = 0.05
+
+    def _reply(self, body):
+        if self.path.startswith("/s/"):
+            time.sleep(self.latency)
+            self.send_response(301)
+            self.send_header("Location", "http://localhost:{}/story/{}".format(self.server.server_port,
+                                                                             self.path[len("/s/"):]))
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+        elif self.path.startswith("/story/"):
+            payload = b"<html>story</html>"
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            if body:
+                self.wfile.write(payload)
+        else:
+            self.send_error(404)
+
+    def do_HEAD(self):
+        self._reply(False)
+
+    def do_GET(self):
+        self._reply(True)
+
+    def log_message(self, *args):
+        pass
+
+
+def legacy_unshorten_url(url):
+    return requests.head(url, allow_redirects=True).url
+
+
+def run(links, latency):
+    RedirectHandler.latency = latency
+    server = ThreadingHTTPServer(("127.0.0.1", 0), RedirectHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    rng = random.Random(42)
+    # a crawl links the same stories again and again
+    urls = ["http://127.0.0.1:{}/s/{}".format(server.server_port, rng.randrange(links)) for _ in range(links)]
+    distinct = len(set(urls))
+
+    start = time.perf_counter()
+    legacy = {url: legacy_unshorten_url(url) for url in urls}
+    legacy_time = time.perf_counter() - start
+
+    with tempfile.TemporaryDirectory() as folder:
+        unshortener = Unshortener(UrlCache(os.path.join(folder, "url_cache.db")))
+        start = time.perf_counter()
+        cold = unshortener.unshorten(urls)
+        cold_time = time.perf_counter() - start
+        start = time.perf_counter()
+        warm = unshortener.unshorten(urls)
+        warm_time = time.perf_counter() - start
+        unshortener.close()
+    server.shutdown()
+
+    assert legacy == cold == warm, "Unshortener resolved different URLs than the legacy loop"
+    print("{:>6} links, {} distinct, {:.0f} ms per redirect".format(links, distinct, latency * 1000))
+    print("legacy (sequential HEAD):     {:>8.0f} links/sec".format(links / legacy_time))
+    print("Unshortener (empty cache):    {:>8.0f} links/sec".format(links / cold_time))
+    print("Unshortener (warm cache):     {:>8.0f} links/sec".format(links / warm_time))
+    print("speedup: {:.1f}x cold, {:.1f}x warm".format(legacy_time / cold_time, legacy_time / warm_time))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--links", type=int, default=500)
+    parser.add_argument("--latency", type=float, default=0.05)
+    args = parser.parse_args()
+    run(args.links, args.latency)
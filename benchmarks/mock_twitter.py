@@ -0,0 +1,192 @@
+"""Local mock of the twitter v1.1 endpoints used by the crawler
+
+    python benchmarks/mock_twitter.py --port 8443 --tweets-per-handle 800 --latency 0.05
+
+Serves user_timeline, search and trends_place over HTTPS (tweepy always uses https) with a self signed certificate.
+Every handle or query has a deterministic timeline of --tweets-per-handle tweets with payloads shaped like real
+extended mode tweets, paginated by count, max_id and since_id. With --id-step the ids of a timeline are that many
+milliseconds apart, like real snowflake ids, instead of consecutive. Responses carry the x-rate-limit headers and every
+credential gets --rate-limit requests per endpoint per --window seconds before it is answered with 429. Point the
+crawler at it with TWITTER_API_HOST=127.0.0.1:<port> and trust the certificate with REQUESTS_CA_BUNDLE and
+SSL_CERT_FILE.
+"""
+import argparse
+import json
+import os
+import random
+import re
+import ssl
+import subprocess
+import sys
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.synthetic import SNOWFLAKE_START, make_tweet
+from search_windows import SNOWFLAKE_EPOCH_MS
+
+TEMPLATES = 256
+# stand ins replaced in the serialized templates, so a page is built with string operations only
+ID_MARK = "1111111111111111111"
+HANDLE_MARK = "mockhandlemark"
+OAUTH_TOKEN_RE = re.compile(r'oauth_token="([^"]*)"')
+
+
+def make_certificate(folder):
+    """Self signed certificate for 127.0.0.1 and localhost, returns (certfile, keyfile)"""
+    certfile = os.path.join(folder, "mock_twitter.pem")
+    keyfile = os.path.join(folder, "mock_twitter.key")
+    subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "2", "-subj", "/CN=127.0.0.1",
+                    "-addext", "subjectAltName=IP:127.0.0.1,DNS:localhost", "-keyout", keyfile, "-out", certfile],
+                   check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return certfile, keyfile
+
+
+class MockTwitter:
+    """Timelines, rate limits and request counters shared by the handler threads"""
+
+    def __init__(self, tweets_per_handle=800, latency=0.0, rate_limit=None, window=900, trends=50, id_step_ms=0):
+        rng = random.Random(0)
+        self.templates = []
+        for _ in range(TEMPLATES):
+            tweet = make_tweet(int(ID_MARK), HANDLE_MARK, rng)
+            self.templates.append(json.dumps(tweet).replace('"id_str": "{}"'.format(ID_MARK), '"id_str": "@ID@"')
+                                  .replace('"id": {}'.format(ID_MARK), '"id": @ID@'))
+        self.tweets_per_handle = tweets_per_handle
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.window = window
+        self.trends = trends
+        self.id_step = id_step_ms << 22 or 1
+        self.started_ms = int(time.time() * 1000)
+        self._lock = threading.Lock()
+        self._windows = {}
+        self.requests = 0
+        self.tweets = 0
+        self.rate_limited = 0
+
+    def newest_id(self, handle):
+        crc = zlib.crc32(handle.lower().encode("utf-8"))
+        if self.id_step == 1:
+            # far enough apart that timelines of different handles never share ids
+            return SNOWFLAKE_START + crc * 10 ** 6
+        # timelines end at the same millisecond and differ in the sequence bits
+        return (self.started_ms - SNOWFLAKE_EPOCH_MS << 22) + crc % (1 << 22)
+
+    def page(self, handle, count, max_id=None, since_id=None):
+        newest = self.newest_id(handle)
+        # tweet i of the timeline, newest first, has id newest - i * id_step
+        first = max(-(-(newest - max_id) // self.id_step), 0) if max_id else 0
+        end = self.tweets_per_handle
+        if since_id:
+            end = min(end, -(-(newest - since_id) // self.id_step))
+        tweets = [self.templates[tweet_id % TEMPLATES].replace("@ID@", str(tweet_id)).replace(HANDLE_MARK, handle)
+                  for tweet_id in (newest - i * self.id_step for i in range(first, min(end, first + count)))]
+        with self._lock:
+            self.tweets += len(tweets)
+        return "[" + ",".join(tweets) + "]"
+
+    def take(self, token, endpoint):
+        """Count a request of token to endpoint, returns (allowed, remaining, reset)"""
+        now = time.time()
+        with self._lock:
+            self.requests += 1
+            if self.rate_limit is None:
+                return True, 900, int(now + self.window)
+            start, used = self._windows.get((token, endpoint), (now, 0))
+            if now - start >= self.window:
+                start, used = now, 0
+            allowed = used < self.rate_limit
+            self._windows[(token, endpoint)] = (start, used + allowed)
+            if not allowed:
+                self.rate_limited += 1
+            return allowed, max(self.rate_limit - used - 1, 0), int(start + self.window) + 1
+
+    def stats(self):
+        with self._lock:
+            return {'requests': self.requests, 'tweets': self.tweets, 'rate_limited': self.rate_limited}
+
+
+def make_handler(mock):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def _send(self, status, body, headers=()):
+            body = body.encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json;charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            for name, value in headers:
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            args = {k: v[0] for k, v in parse_qs(url.query).items()}
+            if url.path == "/stats":
+                self._send(200, json.dumps(mock.stats()))
+                return
+            endpoint = {"/1.1/statuses/user_timeline.json": "user_timeline", "/1.1/search/tweets.json": "search",
+                        "/1.1/trends/place.json": "trends_place"}.get(url.path)
+            if endpoint is None:
+                self._send(404, '{"errors": [{"code": 34, "message": "Sorry, that page does not exist."}]}')
+                return
+            token = OAUTH_TOKEN_RE.search(self.headers.get("Authorization", ""))
+            allowed, remaining, reset = mock.take(token.group(1) if token else None, endpoint)
+            headers = [("x-rate-limit-limit", str(mock.rate_limit or 900)),
+                       ("x-rate-limit-remaining", str(remaining)), ("x-rate-limit-reset", str(reset))]
+            if mock.latency:
+                time.sleep(mock.latency)
+            if not allowed:
+                self._send(429, '{"errors": [{"code": 88, "message": "Rate limit exceeded"}]}', headers)
+                return
+            if endpoint == "trends_place":
+                trends = [{'name': '#mocktrend{}'.format(i), 'url': 'http://twitter.com/search?q=%23mocktrend{}'
+                           .format(i), 'promoted_content': None, 'query': '%23mocktrend{}'.format(i),
+                           'tweet_volume': 1000 + i} for i in range(mock.trends)]
+                self._send(200, json.dumps([{'trends': trends, 'as_of': time.strftime('%Y-%m-%dT%H:%M:%SZ'),
+                                             'locations': [{'name': 'India', 'woeid': int(args.get('id', 1))}]}]),
+                           headers)
+                return
+            handle = args.get('q') if endpoint == "search" else args.get('screen_name') or args.get('id') or ""
+            page = mock.page(handle, int(args.get('count', 20)), int(args['max_id']) if 'max_id' in args else None,
+                             int(args['since_id']) if 'since_id' in args else None)
+            if endpoint == "search":
+                page = '{"statuses": ' + page + ', "search_metadata": {"count": ' + args.get('count', '15') + '}}'
+            self._send(200, page, headers)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def serve(port, certfile, keyfile, **kwargs):
+    """Run the mock server until the process is killed"""
+    server = ThreadingHTTPServer(("127.0.0.1", port), make_handler(MockTwitter(**kwargs)))
+    server.daemon_threads = True
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(certfile, keyfile)
+    server.socket = context.wrap_socket(server.socket, server_side=True)
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=8443)
+    parser.add_argument("--folder", default=".", help="Where to write the self signed certificate")
+    parser.add_argument("--tweets-per-handle", type=int, default=800)
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every response")
+    parser.add_argument("--rate-limit", type=int, default=None, help="Requests per credential and endpoint per window")
+    parser.add_argument("--window", type=int, default=900, help="Rate limit window in seconds")
+    parser.add_argument("--id-step", type=int, default=0, help="Milliseconds between two tweets of a timeline")
+    args = parser.parse_args()
+    cert, key = make_certificate(args.folder)
+    print("Serving on https://127.0.0.1:{}, certificate {}".format(args.port, cert))
+    serve(args.port, cert, key, tweets_per_handle=args.tweets_per_handle, latency=args.latency,
+          rate_limit=args.rate_limit, window=args.window, id_step_ms=args.id_step)
@@ -0,0 +1,62 @@
+"""Synthetic twitter API payloads shaped like real user_timeline/search responses (tweet_mode=extended)"""
+import random
+import time
+
+SOURCES = ['<a href="http://twitter.com/download/android" rel="nofollow">Twitter for Android</a>',
+           '<a href="http://twitter.com/download/iphone" rel="nofollow">Twitter for iPhone</a>',
+           '<a href="https://mobile.twitter.com" rel="nofollow">Twitter Web App</a>',
+           '<a href="https://about.twitter.com/products/tweetdeck" rel="nofollow">TweetDeck</a>',
+           '<a href="http://twitter.com/#!/download/ipad" rel="nofollow">Twitter for iPad</a>',
+           '<a href="https://buffer.com" rel="nofollow">Buffer</a>',
+           '<a href="https://www.hootsuite.com" rel="nofollow">Hootsuite Inc.</a>',
+           '<a href="http://instagram.com" rel="nofollow">Instagram</a>',
+           '<a href="https://ifttt.com" rel="nofollow">IFTTT</a>',
+           '<a href="https://www.facebook.com/twitter" rel="nofollow">Facebook</a>'] + \
+          ['<a href="https://example.com/app{0}" rel="nofollow">Custom App {0}</a>'.format(i) for i in range(30)]
+WORDS = ("modi rahul election vote india delhi news breaking rally bjp inc congress budget rupee kisan jobs "
+         "farmers protest cricket match live update breaking report watch thread").split()
+SNOWFLAKE_START = 1200000000000000000
+
+
+def _user(rng, handle=None):
+    handle = handle or "user{}".format(rng.randrange(10 ** 6))
+    return {'id': rng.randrange(10 ** 12), 'id_str': str(rng.randrange(10 ** 12)), 'name': handle.title(),
+            'screen_name': handle, 'location': 'India', 'description': ' '.join(rng.choices(WORDS, k=12)),
+            'url': None, 'followers_count': rng.randrange(10 ** 6), 'friends_count': rng.randrange(5000),
+            'listed_count': rng.randrange(100), 'created_at': 'Wed Jan 01 00:00:00 +0000 2014',
+            'favourites_count': rng.randrange(10 ** 4), 'verified': False, 'statuses_count': rng.randrange(10 ** 5),
+            'lang': None, 'profile_image_url_https': 'https://pbs.twimg.com/profile_images/1/a_normal.jpg',
+            'default_profile': False}
+
+
+def _entities(rng):
+    hashtags = [{'text': rng.choice(WORDS), 'indices': [0, 5]} for _ in range(rng.randrange(4))]
+    urls = [{'url': 'https://t.co/abc{}'.format(i), 'expanded_url': 'https://www.{}.com/story/{}'.format(
+        rng.choice(WORDS), rng.randrange(10 ** 6)), 'display_url': 'x', 'indices': [0, 23]}
+            for i in range(rng.randrange(3))]
+    mentions = [{'screen_name': 'user{}'.format(rng.randrange(1000)), 'name': 'x', 'id': rng.randrange(10 ** 9),
+                 'id_str': 'x', 'indices': [0, 5]} for _ in range(rng.randrange(4))]
+    entities = {'hashtags': hashtags, 'symbols': [], 'user_mentions': mentions, 'urls': urls}
+    if rng.random() < 0.2:
+        entities['media'] = [{'id': rng.randrange(10 ** 18), 'media_url_https': 'https://pbs.twimg.com/media/{}.jpg'
+                              .format(rng.randrange(10 ** 9)), 'type': 'photo'}]
+    return entities
+
+
+def make_tweet(tweet_id, handle, rng=random, retweet_ratio=0.4):
+    tweet = {'created_at': time.strftime('%a %b %d %H:%M:%S +0000 %Y'), 'id': tweet_id, 'id_str': str(tweet_id),
+             'full_text': ' '.join(rng.choices(WORDS, k=rng.randrange(5, 40))), 'truncated': False,
+             'display_text_range': [0, 140], 'entities': _entities(rng), 'source': rng.choice(SOURCES),
+             'in_reply_to_status_id': None, 'in_reply_to_user_id': None, 'in_reply_to_screen_name': None,
+             'user': _user(rng, handle), 'geo': None, 'coordinates': None, 'place': None, 'contributors': None,
+             'is_quote_status': False, 'retweet_count': rng.randrange(1000), 'favorite_count': rng.randrange(5000),
+             'favorited': False, 'retweeted': False, 'lang': 'en'}
+    if rng.random() < retweet_ratio:
+        tweet['retweeted_status'] = make_tweet(tweet_id - 1000, None, rng, retweet_ratio=0)
+    return tweet
+
+
+def make_timeline(handle, count, rng=random, newest_id=None):
+    """count tweets of handle, newest first, with strictly decreasing ids"""
+    newest_id = newest_id or SNOWFLAKE_START + rng.randrange(10 ** 12)
+    return [make_tweet(newest_id - i * 7919, handle, rng) for i in range(count)]
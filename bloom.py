@@ -0,0 +1,51 @@
+"""Compact probabilistic set used to drop duplicates from streams too large to keep in a python set"""
+import math
+from hashlib import blake2b
+
+
+class BloomFilter:
+    """Bloom filter over a bytearray
+
+    add never forgets an item, but with probability error_rate (once capacity items were added) an item that was never
+    added is reported as present.
+
+    Args:
+        capacity (int): Expected number of distinct items
+        error_rate (float, optional): Target false positive rate at capacity
+        buffer (optional): Writable buffer of at least size_for(capacity, error_rate) bytes to keep the bits in,
+            e.g. shared memory, a new bytearray by default
+    """
+
+    def __init__(self, capacity, error_rate=1e-4, buffer=None):
+        self.nbits = self.size_for(capacity, error_rate) * 8
+        self.nhashes = max(1, round(self.nbits / max(capacity, 1) * math.log(2)))
+        self.bits = buffer if buffer is not None else bytearray(self.nbits // 8)
+
+    @staticmethod
+    def size_for(capacity, error_rate=1e-4):
+        """Bytes needed for capacity items at error_rate"""
+        nbits = -max(capacity, 1) * math.log(error_rate) / (math.log(2) ** 2)
+        return int(nbits // 8) + 1
+
+    def _positions(self, item):
+        if not isinstance(item, bytes):
+            item = str(item).encode("utf-8")
+        digest = blake2b(item, digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.nbits for i in range(self.nhashes)]
+
+    def __contains__(self, item):
+        bits = self.bits
+        return all(bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(item))
+
+    def add(self, item):
+        """Add item, returns False if it was (probably) already present"""
+        bits = self.bits
+        new = False
+        for pos in self._positions(item):
+            mask = 1 << (pos & 7)
+            if not bits[pos >> 3] & mask:
+                bits[pos >> 3] |= mask
+                new = True
+        return new
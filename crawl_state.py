@@ -0,0 +1,177 @@
+"""Crash safe crawl state
+
+One SQLite database (WAL mode, so every worker process can read while another one writes) keyed on (kind, name)
+where kind is "user" for timelines and "search" for queries. For every handle it records the status of its crawl, the
+pagination cursor of the last page actually written, so an interrupted handle resumes from there instead of starting
+over, the newest tweet id crawled so far which is the since_id of the next incremental crawl, and how many times in a
+row its crawl failed.
+"""
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+STATE_DB = "./crawl_state.db"
+LEGACY_CRAWLED_FILE = "./crawled.txt"
+LEGACY_WATERMARK_FILE = "./watermarks.txt"
+
+PENDING = "pending"
+IN_PROGRESS = "in_progress"
+DONE = "done"
+FAILED = "failed"
+
+STATE = None
+STATE_PID = None
+
+
+class CrawlState:
+    def __init__(self, path=STATE_DB):
+        self.path = path
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        self.conn.execute("pragma journal_mode=wal")
+        self.conn.execute("pragma synchronous=normal")
+        with self._transaction():
+            exists = self.conn.execute("select 1 from sqlite_master where name = 'crawl_state'").fetchone()
+            if not exists:
+                self.conn.execute('''create table crawl_state (
+                    kind text not null,
+                    name text not null,
+                    status text not null default 'pending',
+                    since_id integer,
+                    max_id integer,
+                    pending_newest_id integer,
+                    newest_id integer,
+                    failures integer not null default 0,
+                    updated_at real,
+                    primary key (kind, name)) without rowid''')
+                self._import_legacy()
+            elif not self.conn.execute("select 1 from pragma_table_info('crawl_state') where name = 'failures'"
+                                       ).fetchone():
+                self.conn.execute("alter table crawl_state add column failures integer not null default 0")
+
+    def _transaction(self):
+        return _Transaction(self.conn, self._lock)
+
+    def _import_legacy(self):
+        """Carry over progress from crawled.txt and watermarks.txt the first time the database is created"""
+        now = time.time()
+        if os.path.exists(LEGACY_CRAWLED_FILE):
+            with open(LEGACY_CRAWLED_FILE, encoding="utf-8") as f:
+                # crawled.txt was only ever consulted for trending queries
+                self.conn.executemany("insert or ignore into crawl_state (kind, name, status, updated_at) "
+                                      "values ('search', ?, 'done', ?)",
+                                      ((line.strip(), now) for line in f if line.strip()))
+        if os.path.exists(LEGACY_WATERMARK_FILE):
+            with open(LEGACY_WATERMARK_FILE, encoding="utf-8") as f:
+                for line in f:
+                    key, _, tweet_id = line.rstrip('\n').rpartition('\t')
+                    kind, _, name = key.partition(':')
+                    if name and tweet_id.isdigit():
+                        self.conn.execute("insert into crawl_state (kind, name, status, newest_id, updated_at) "
+                                          "values (?, ?, 'done', ?, ?) on conflict (kind, name) do update set "
+                                          "newest_id = max(coalesce(newest_id, 0), excluded.newest_id)",
+                                          (kind, name, int(tweet_id), now))
+        logging.info("Created crawl state store " + self.path)
+
+    def start(self, curr_id, search=False, backfill=False):
+        """Mark the crawl of curr_id as started
+
+        Returns:
+            tuple: (since_id, max_id) to crawl with. An interrupted crawl resumes below the last written page with
+            its original since_id, otherwise max_id is None and since_id is the newest tweet already crawled
+            (None for a backfill).
+        """
+        kind = _kind(search)
+        with self._transaction():
+            row = self.conn.execute("select status, since_id, max_id, newest_id from crawl_state "
+                                    "where kind = ? and name = ?", (kind, curr_id)).fetchone()
+            if row and row[0] in (IN_PROGRESS, FAILED) and row[2] is not None:
+                since_id, max_id = row[1], row[2]
+            else:
+                since_id, max_id = (None if backfill or not row else row[3]), None
+            self.conn.execute("insert into crawl_state (kind, name, status, since_id, max_id, updated_at) "
+                              "values (?, ?, ?, ?, ?, ?) on conflict (kind, name) do update set "
+                              "status = excluded.status, since_id = excluded.since_id, max_id = excluded.max_id, "
+                              "updated_at = excluded.updated_at",
+                              (kind, curr_id, IN_PROGRESS, since_id, max_id, time.time()))
+        return since_id, max_id
+
+    def checkpoint(self, curr_id, max_id, newest_id, search=False):
+        """Every tweet above max_id has been written"""
+        with self._transaction():
+            self.conn.execute("update crawl_state set max_id = ?, pending_newest_id = max(coalesce("
+                              "pending_newest_id, 0), ?), updated_at = ? where kind = ? and name = ?",
+                              (max_id, newest_id or 0, time.time(), _kind(search), curr_id))
+
+    def finish(self, curr_id, newest_id, search=False):
+        with self._transaction():
+            self.conn.execute("update crawl_state set status = ?, newest_id = max(coalesce(newest_id, 0), "
+                              "coalesce(pending_newest_id, 0), ?), since_id = null, max_id = null, "
+                              "pending_newest_id = null, failures = 0, updated_at = ? where kind = ? and name = ?",
+                              (DONE, newest_id or 0, time.time(), _kind(search), curr_id))
+
+    def fail(self, curr_id, search=False):
+        """Keep the cursor so the next run resumes the handle where it stopped"""
+        with self._transaction():
+            self.conn.execute("update crawl_state set status = ?, failures = failures + 1, updated_at = ? "
+                              "where kind = ? and name = ?", (FAILED, time.time(), _kind(search), curr_id))
+
+    def crawled(self, names, search=False):
+        """Subset of names whose crawl is done"""
+        return self._with_status(names, DONE, search)
+
+    def in_progress(self, names, search=False):
+        """Subset of names whose crawl has started and whose tweets are not all written yet"""
+        return self._with_status(names, IN_PROGRESS, search)
+
+    def failing(self, names, max_failures, search=False):
+        """Subset of names whose last max_failures crawls all failed"""
+        kind = _kind(search)
+        with self._lock:
+            return {name for name in names if self.conn.execute(
+                "select 1 from crawl_state where kind = ? and name = ? and status = ? and failures >= ?",
+                (kind, name, FAILED, max_failures)).fetchone()}
+
+    def _with_status(self, names, status, search):
+        kind = _kind(search)
+        with self._lock:
+            return {name for name in names if self.conn.execute(
+                "select 1 from crawl_state where kind = ? and name = ? and status = ?",
+                (kind, name, status)).fetchone()}
+
+    def counts(self):
+        with self._lock:
+            return dict(self.conn.execute("select status, count(*) from crawl_state group by status").fetchall())
+
+
+class _Transaction:
+    """BEGIN IMMEDIATE so concurrent read-modify-write from several processes is serialised by SQLite"""
+
+    def __init__(self, conn, lock):
+        self.conn = conn
+        self.lock = lock
+
+    def __enter__(self):
+        self.lock.acquire()
+        self.conn.execute("begin immediate")
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            self.conn.execute("rollback" if exc_type else "commit")
+        finally:
+            self.lock.release()
+
+
+def _kind(search):
+    return "search" if search else "user"
+
+
+def get_state(path=STATE_DB):
+    """State store connection of the current process, opened on first use"""
+    global STATE, STATE_PID
+    if STATE is None or STATE_PID != os.getpid():
+        STATE = CrawlState(path)
+        STATE_PID = os.getpid()
+    return STATE
@@ -0,0 +1,128 @@
+"""Batched user->user and user->web source edge lists
+
+construct_edge_list used to walk every URL of every tweet through a scan of the 14 excluded sites and a chain of
+startswith/endswith checks. Most links of a crawl point to the same few hundred sites though, so here a chunk of rows is
+parsed once per distinct URL: the exclusions are matched by one precompiled regex, the host is taken from the URL by
+another, and the result is cached for the rest of the chunk. The edges are the same, in the same order, as before.
+Chunks are streamed from the Postgres table or the Parquet folder so a whole crawl never has to fit in memory.
+"""
+import os
+import re
+
+from storage import pg_get_conn
+
+LIST_TO_EXCLUDE = ('twitter', 'youtu', 'fllwrs', 'unfollowspy', 'livetv', 'pscp', 'live', 'ln.is', 'tinyurl',
+                   'facebook', 'bit.ly', 'goo.gl', 'instagram', 'google')
+EXCLUDE_RE = re.compile('|'.join(re.escape(site) for site in LIST_TO_EXCLUDE))
+# scheme and host of the URL, the host being everything up to the next /
+HOST_RE = re.compile(r'https?://([^/]*)')
+DEFAULT_CHUNK_SIZE = 100000
+
+
+def _items(value):
+    """Items of a user_mention or link field, a comma separated string or a list"""
+    if isinstance(value, str):
+        return value.split(',') if value else ()
+    return value if value is not None and len(value) else ()
+
+
+def url_site(url, exclude=EXCLUDE_RE):
+    """Site a link points to, None for excluded links and links without a host
+
+    http://www.<site>.com, http://m.<site>.com and http://www.<site>.in give <site>, so do the hosts of other URLs
+    starting with www or m, any other host with a dot is the site itself.
+    """
+    if exclude.search(url):
+        return None
+    if url.startswith("http://www") and (url.endswith('.com') or url.endswith('.in')) or \
+            url.startswith("http://m") and url.endswith('.com'):
+        return url.split('.', 2)[1].lower()
+    match = HOST_RE.match(url)
+    if not match or '.' not in match.group(1):
+        return None
+    host = match.group(1)
+    if host.startswith('www') or host.startswith('m'):
+        return host.split('.', 2)[1].lower()
+    return host.lower()
+
+
+def user_edges(rows):
+    """(user, mentioned user) pairs of a chunk of (user_from, user_mention, link) rows, mentions without their @"""
+    return [(row[0], mention.replace('@', '')) for row in rows for mention in _items(row[1]) if mention != '@']
+
+
+def source_edges(rows, exclude=EXCLUDE_RE):
+    """(user, site) pairs of the links of a chunk of (user_from, user_mention, link) rows, see url_site. Links
+    containing the user's own handle are skipped."""
+    # url -> (site, url with dots as underscores), None for the links without a site
+    sites = {}
+    get = sites.get
+    edges = []
+    for row in rows:
+        links = row[2]
+        if not links:
+            continue
+        user = row[0]
+        for url in links.split(',') if isinstance(links, str) else links:
+            parsed = get(url, False)
+            if parsed is False:
+                site = url_site(url, exclude)
+                parsed = sites[url] = (site, url.replace('.', '_')) if site is not None else None
+            if parsed is not None and user not in parsed[1]:
+                edges.append((user, parsed[0]))
+    return edges
+
+
+def edge_rows(posts):
+    """(user_from, user_mention, link) rows of tweet dicts as built by normalize_tweet, e.g. a batch of
+    preproc.iter_crawl_twitter. Take them before preproc_db, which rewrites the lists in place."""
+    return [(post['tweet_from'], post.get('user_mentions_name'), post.get('urls')) for post in posts]
+
+
+def construct_edge_lists(rows):
+    """user->user and user->source edge lists of a chunk, see preproc.construct_edge_list"""
+    if not isinstance(rows, (list, tuple)):
+        rows = list(rows)
+    return user_edges(rows), source_edges(rows)
+
+
+def read_pg_chunks(db_credentials, tablename=None, chunk_size=DEFAULT_CHUNK_SIZE, since_id=None, until_id=None):
+    """Chunks of (user_from, user_mention, link) rows of the tweets in the table with since_id < id <= until_id,
+    streamed through a server side cursor"""
+    tablename = tablename or db_credentials['tablename']
+    # lists are stored as array literals, screen names and urls practically never need quoting in them
+    query = ("select tweet_from, string_to_array(trim(both '{{}}' from user_mentions_name), ','), "
+             "string_to_array(trim(both '{{}}' from urls), ',') from {} where id > %s and id <= %s order by id"
+             .format(tablename))
+    # a psycopg2 connection used as a context manager only ends the transaction, it is closed here
+    conn = pg_get_conn(db_credentials['dbname'], db_credentials['dbuser'], db_credentials['dbpass'],
+                       db_credentials['dbhost'], db_credentials['dbport'])
+    try:
+        # server side cursors only live inside a transaction
+        conn.autocommit = False
+        with conn.cursor(name="edge_list_rows") as cur:
+            cur.itersize = chunk_size
+            cur.execute(query, (since_id or 0, until_id if until_id is not None else 2 ** 63 - 1))
+            while True:
+                rows = cur.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield rows
+    finally:
+        conn.close()
+
+
+def read_parquet_chunks(folder, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Chunks of (user_from, user_mention, link) rows of every Parquet file under folder, one row group at a time"""
+    import pyarrow.parquet as pq
+
+    for root, _, names in sorted(os.walk(folder)):
+        for name in sorted(names):
+            if not name.endswith(".parquet"):
+                continue
+            parquet = pq.ParquetFile(os.path.join(root, name))
+            for group in range(parquet.num_row_groups):
+                table = parquet.read_row_group(group, columns=['tweet_from', 'user_mentions_name', 'urls'])
+                rows = list(zip(*(table.column(i).to_pylist() for i in range(3))))
+                for start in range(0, len(rows), chunk_size):
+                    yield rows[start:start + chunk_size]
@@ -0,0 +1,71 @@
+"""Streaming handle source for very large seed lists
+
+Handles are read lazily from the handles file, normalized and deduplicated with a bloom filter, and handed to the
+workers through a bounded submission window, so memory stays flat no matter how many millions of handles the
+snowballed frontier holds.
+"""
+import logging
+import os
+from concurrent.futures import FIRST_COMPLETED, wait
+from itertools import islice
+
+from bloom import BloomFilter
+
+# twitter handles are 4 to 15 characters (a handful of early ones are shorter), so with its newline a handle takes
+# at least 5 bytes of the file, which bounds the number of distinct handles it can hold
+MIN_BYTES_PER_HANDLE = 5
+
+
+def normalize_handle(line):
+    """Strip whitespace and the leading @ and lowercase, twitter handles are case insensitive"""
+    handle = line.strip().lstrip('@').lower()
+    return handle or None
+
+
+def iter_handles(file, error_rate=1e-5):
+    """Iterator over the distinct normalized handles of file, in file order
+
+    The file is opened right away so a missing file raises FileNotFoundError here rather than on first iteration.
+    The bloom filter is sized from the file size; with probability error_rate a handle is taken for a duplicate and
+    skipped.
+    """
+    f = open(file, encoding="utf-8")
+    return _iter_handles(f, BloomFilter(os.path.getsize(file) // MIN_BYTES_PER_HANDLE + 1, error_rate))
+
+
+def _iter_handles(f, seen):
+    duplicates = 0
+    with f:
+        for line in f:
+            handle = normalize_handle(line)
+            if handle is None:
+                continue
+            if seen.add(handle):
+                yield handle
+            else:
+                duplicates += 1
+    logging.info("Skipped {} duplicate handles in {}".format(duplicates, f.name))
+
+
+def shard_handles(file, index, count):
+    """Every count-th distinct handle of file starting at index. Every shard dedupes the whole file, so the shards
+    of one file never overlap."""
+    return islice(iter_handles(file), index, None, count)
+
+
+def submit_bounded(executor, fn, items, *args, window=64):
+    """executor.map(fn, items, repeat(arg)...) that only keeps window tasks in flight, consuming items lazily, and
+    logs failed tasks instead of collecting results"""
+    pending = set()
+    for item in items:
+        if len(pending) >= window:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            _log_failures(done)
+        pending.add(executor.submit(fn, item, *args))
+    _log_failures(wait(pending).done)
+
+
+def _log_failures(futures):
+    for fut in futures:
+        if fut.exception() is not None:
+            logging.error("Crawl task failed: " + str(fut.exception()))
@@ -0,0 +1,186 @@
+"""Postgres job table shared by crawler nodes
+
+Handles and trending queries are enqueued once into a jobs table in the database the tweets go to. Every node claims
+batches of pending jobs with SELECT ... FOR UPDATE SKIP LOCKED, so nodes never block on or claim each other's jobs,
+and keeps the leases of the jobs it holds alive with a heartbeat. When a node dies its leases run out and the jobs go
+back to pending for another node. A job is marked done once its tweets have been written.
+"""
+import logging
+import os
+import socket
+import threading
+import time
+
+from psycopg2.extras import execute_values
+
+from pipeline import log_handle_crawled
+from storage import get_pg_pool
+
+JOBS_TABLE = "crawl_jobs"
+DEFAULT_LEASE = 300
+DEFAULT_MAX_ATTEMPTS = 3
+DEFAULT_CLAIM_BATCH = 16
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+def node_id():
+    """Worker name of this node in the jobs table, the main process of a node holds the leases of all its workers"""
+    return "{}:{}".format(socket.gethostname(), os.getpid())
+
+
+class JobQueue:
+    """Jobs table in the database of db_credentials
+
+    Args:
+        db_credentials (dict): [Database] section, jobs_table, lease and max_attempts are read from it when set
+    """
+
+    def __init__(self, db_credentials):
+        self.pool = get_pg_pool(db_credentials)
+        self.table = db_credentials.get('jobs_table') or JOBS_TABLE
+        self.lease = int(db_credentials.get('lease') or DEFAULT_LEASE)
+        self.max_attempts = int(db_credentials.get('max_attempts') or DEFAULT_MAX_ATTEMPTS)
+
+    def _execute(self, query, args=None, fetch=False):
+        def execute(conn):
+            with conn.cursor() as cur:
+                cur.execute(query, args)
+                return cur.fetchall() if fetch else cur.rowcount
+        return self.pool.run(execute)
+
+    def create_table(self):
+        self._execute('''create table if not exists {0} (
+            kind text not null,
+            name text not null,
+            status text not null default 'pending',
+            worker text,
+            lease_until timestamptz,
+            attempts integer not null default 0,
+            updated_at timestamptz not null default now(),
+            primary key (kind, name));
+            create index if not exists {0}_status_idx on {0} (status, lease_until)'''.format(self.table))
+
+    def enqueue(self, names, search=False, batch_size=10000):
+        """Queue names for crawling, names may be a lazy iterator. Jobs that are done or failed are queued again so
+        the next crawl picks up the new tweets, running jobs are left alone.
+
+        Returns:
+            int: Number of jobs queued
+        """
+        kind = _kind(search)
+        query = ("insert into {} (kind, name) values %s on conflict (kind, name) do update set status = 'pending', "
+                 "worker = null, lease_until = null, attempts = 0, updated_at = now() "
+                 "where {}.status in ('done', 'failed')").format(self.table, self.table)
+        queued = 0
+        batch = []
+
+        def insert(conn):
+            with conn.cursor() as cur:
+                execute_values(cur, query, batch, page_size=len(batch))
+                return cur.rowcount
+
+        for name in names:
+            batch.append((kind, name))
+            if len(batch) >= batch_size:
+                queued += self.pool.run(insert)
+                batch = []
+        if batch:
+            queued += self.pool.run(insert)
+        return queued
+
+    def requeue_expired(self):
+        """Put the jobs whose lease ran out back to pending, or fail them after max_attempts tries"""
+        rows = self._execute("update {} set status = case when attempts >= %s then 'failed' else 'pending' end, "
+                             "worker = null, lease_until = null, updated_at = now() "
+                             "where status = 'running' and lease_until < now() returning status".format(self.table),
+                             (self.max_attempts,), fetch=True)
+        if rows:
+            logging.warning("Requeued {} jobs of dead workers".format(len(rows)))
+        return len(rows)
+
+    def claim(self, worker, batch=DEFAULT_CLAIM_BATCH, search=False):
+        """Lease up to batch pending jobs to worker
+
+        Returns:
+            list: Names of the claimed jobs
+        """
+        rows = self._execute('''update {0} set status = 'running', worker = %s, attempts = attempts + 1,
+            lease_until = now() + %s * interval '1 second', updated_at = now()
+            where (kind, name) in (select kind, name from {0} where kind = %s and status = 'pending'
+                                   order by updated_at limit %s for update skip locked)
+            returning name'''.format(self.table), (worker, self.lease, _kind(search), batch), fetch=True)
+        return [row[0] for row in rows]
+
+    def heartbeat(self, worker):
+        """Renew the leases of every job held by worker"""
+        return self._execute("update {} set lease_until = now() + %s * interval '1 second' "
+                             "where worker = %s and status = 'running'".format(self.table), (self.lease, worker))
+
+    def complete(self, name, worker, completed, search=False):
+        """Mark a job done, or queue it again for another try if its crawl stopped on an error"""
+        self._execute("update {} set status = case when %s then 'done' when attempts >= %s then 'failed' "
+                      "else 'pending' end, worker = null, lease_until = null, updated_at = now() "
+                      "where kind = %s and name = %s and worker = %s".format(self.table),
+                      (completed, self.max_attempts, _kind(search), name, worker))
+
+    def counts(self, search=False):
+        return dict(self._execute("select status, count(*) from {} where kind = %s group by status"
+                                  .format(self.table), (_kind(search),), fetch=True))
+
+
+def _kind(search):
+    return "search" if search else "user"
+
+
+def claim_jobs(db_credentials, worker, search=False, batch=DEFAULT_CLAIM_BATCH, poll_interval=10):
+    """Iterator over the jobs claimed by worker, claiming a new batch whenever the previous one was handed out
+
+    When nothing is pending it waits for the jobs still running anywhere, as they may be requeued if their node dies,
+    and stops once every job is done or failed.
+    """
+    jobs = JobQueue(db_credentials)
+    while True:
+        jobs.requeue_expired()
+        names = jobs.claim(worker, batch, search)
+        if names:
+            yield from names
+            continue
+        counts = jobs.counts(search)
+        if not counts.get(PENDING) and not counts.get(RUNNING):
+            return
+        time.sleep(poll_interval)
+
+
+def finish_job(curr_id, result, completed, newest_id, db_credentials, worker, search=False):
+    """on_handle_done of a node: what log_handle_crawled does, then release the job"""
+    log_handle_crawled(curr_id, result, completed, newest_id, search)
+    JobQueue(db_credentials).complete(curr_id, worker, completed and not result.failed, search)
+
+
+class Heartbeat:
+    """Renews the leases of worker from a background thread while the with block runs"""
+
+    def __init__(self, db_credentials, worker):
+        self.jobs = JobQueue(db_credentials)
+        self.worker = worker
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.jobs.lease / 3):
+            try:
+                self.jobs.heartbeat(self.worker)
+            except Exception as e:
+                logging.error("Can't renew job leases: " + str(e))
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._stop.set()
+        self._thread.join()
@@ -0,0 +1,275 @@
+"""Crawler metrics
+
+Every process counts into its own Metrics object and a background thread pushes a snapshot of it to one
+MetricsRegistry in the scheduler manager process, which adds the snapshots of all processes up. The main process
+serves the totals in the Prometheus text format over a local HTTP endpoint, and every process writes a JSON summary of
+its own numbers to its log file periodically and when it exits.
+"""
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from multiprocessing.util import Finalize
+
+DEFAULT_METRICS_PORT = 9108
+PUSH_INTERVAL = 5
+# seconds without a push after which the gauges of a process, e.g. a worker of a replaced pool, are left out
+STALE_AFTER = 3 * PUSH_INTERVAL
+SUMMARY_INTERVAL = 300
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+METRICS_INFO = {
+    'tweetcrawler_api_request_seconds': ('histogram', "Latency of twitter API requests per endpoint"),
+    'tweetcrawler_api_errors_total': ('counter', "Failed twitter API requests per endpoint and HTTP status"),
+    'tweetcrawler_rate_limited_total': ('counter', "Requests answered with 420/429 per endpoint"),
+    'tweetcrawler_rate_limit_wait_seconds_total': ('counter', "Seconds spent waiting on rate limits per credential"),
+    'tweetcrawler_pages_total': ('counter', "Pages of tweets fetched"),
+    'tweetcrawler_tweets_fetched_total': ('counter', "Tweets fetched"),
+    'tweetcrawler_tweets_total': ('counter', "Tweets handed to the sink by result, skipped ones never reached it"),
+    'tweetcrawler_sink_write_seconds': ('histogram', "Latency of sink writes per sink"),
+    'tweetcrawler_queue_depth': ('gauge', "Items waiting in the pipeline queues per worker"),
+    'tweetcrawler_handles_total': ('counter', "Handles finished per worker and status"),
+    'tweetcrawler_handles_in_progress': ('gauge', "Handles being fetched or written per worker"),
+    'tweetcrawler_crawl_state_handles': ('gauge', "Handles in the crawl state store per status"),
+    'tweetcrawler_trending_queries_total': ('counter', "New trending queries dispatched by the daemon per WOEID"),
+    'tweetcrawler_pg_pool_connections': ('gauge', "Postgres connections of the pool per worker, open and idle"),
+    'tweetcrawler_pg_pool_connects_total': ('counter', "Postgres connections opened by the pools"),
+    'tweetcrawler_pg_pool_reuses_total': ('counter', "Pooled Postgres connections handed out again"),
+    'tweetcrawler_pg_pool_reconnects_total': ('counter', "Writes retried on a new connection after losing one"),
+    'tweetcrawler_pg_pool_wait_seconds_total': ('counter', "Seconds spent waiting for a free pooled connection"),
+}
+
+METRICS = None
+METRICS_PID = None
+
+
+def _key(name, labels):
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+class Metrics:
+    """Counters, gauges and latency histograms of one process"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._gauges = {}
+        self._gauge_fns = {}
+        self._histograms = {}
+
+    def inc(self, name, value=1, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self._lock:
+            self._gauges[_key(name, labels)] = value
+
+    def gauge_fn(self, name, fn, **labels):
+        """Gauge read from fn() whenever a snapshot is taken"""
+        with self._lock:
+            self._gauge_fns[_key(name, labels)] = fn
+
+    def observe(self, name, seconds, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            hist = self._histograms.get(key)
+            if hist is None:
+                # bucket counts, then sum and count
+                hist = self._histograms[key] = [0] * (len(LATENCY_BUCKETS) + 2)
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    hist[i] += 1
+                    break
+            hist[-2] += seconds
+            hist[-1] += 1
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start, **labels)
+
+    def snapshot(self):
+        with self._lock:
+            gauge_fns = list(self._gauge_fns.items())
+            gauges = dict(self._gauges)
+        for key, fn in gauge_fns:
+            try:
+                gauges[key] = fn()
+            except Exception as e:
+                logging.error("Can't read gauge " + key[0] + ": " + str(e))
+        with self._lock:
+            return {'counters': dict(self._counters), 'gauges': gauges,
+                    'histograms': {key: list(hist) for key, hist in self._histograms.items()}}
+
+
+class MetricsRegistry:
+    """Latest snapshot of every process and when it was pushed, lives in the manager process
+
+    The counters and histograms of processes that stopped pushing still count towards the totals, which must never go
+    down, but their gauges are left out once they are older than stale_after seconds.
+    """
+
+    def __init__(self, stale_after=STALE_AFTER):
+        self.stale_after = stale_after
+        self._lock = threading.Lock()
+        self._snapshots = {}
+
+    def update(self, pid, snapshot):
+        with self._lock:
+            self._snapshots[pid] = (time.time(), snapshot)
+
+    def totals(self):
+        counters, gauges, histograms = {}, {}, {}
+        now = time.time()
+        with self._lock:
+            snapshots = list(self._snapshots.values())
+        for pushed_at, snapshot in snapshots:
+            for key, value in snapshot['counters'].items():
+                counters[key] = counters.get(key, 0) + value
+            if now - pushed_at <= self.stale_after:
+                for key, value in snapshot['gauges'].items():
+                    gauges[key] = gauges.get(key, 0) + value
+            for key, hist in snapshot['histograms'].items():
+                total = histograms.setdefault(key, [0] * len(hist))
+                for i, value in enumerate(hist):
+                    total[i] += value
+        return {'counters': counters, 'gauges': gauges, 'histograms': histograms}
+
+    def render(self):
+        return render(self.totals())
+
+    def summary(self):
+        return summary(self.totals())
+
+
+def _labels(labels, **extra):
+    pairs = list(labels) + sorted(extra.items())
+    if not pairs:
+        return ""
+    escaped = ('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in pairs)
+    return "{" + ",".join(escaped) + "}"
+
+
+def render(totals):
+    """Prometheus text exposition format of a snapshot"""
+    series = {}
+    for kind in ('counters', 'gauges', 'histograms'):
+        for (name, labels), value in totals[kind].items():
+            series.setdefault(name, []).append((labels, value))
+    lines = []
+    for name in sorted(series):
+        kind, description = METRICS_INFO.get(name, ('untyped', name))
+        lines.append("# HELP {} {}".format(name, description))
+        lines.append("# TYPE {} {}".format(name, kind))
+        for labels, value in sorted(series[name]):
+            if kind != 'histogram':
+                lines.append("{}{} {}".format(name, _labels(labels), value))
+                continue
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS, value):
+                cumulative += count
+                lines.append("{}_bucket{} {}".format(name, _labels(labels, le=bound), cumulative))
+            lines.append("{}_bucket{} {}".format(name, _labels(labels, le="+Inf"), value[-1]))
+            lines.append("{}_sum{} {}".format(name, _labels(labels), value[-2]))
+            lines.append("{}_count{} {}".format(name, _labels(labels), value[-1]))
+    return "\n".join(lines) + "\n"
+
+
+def summary(totals):
+    """Flat dict of a snapshot for the log files, histograms as count and mean seconds"""
+    def series(name, labels):
+        return name + ("{" + ",".join("{}={}".format(k, v) for k, v in labels) + "}" if labels else "")
+
+    out = {}
+    for kind in ('counters', 'gauges'):
+        for (name, labels), value in totals[kind].items():
+            out[series(name, labels)] = value
+    for (name, labels), hist in totals['histograms'].items():
+        out[series(name, labels)] = {'count': hist[-1], 'mean': round(hist[-2] / hist[-1], 4) if hist[-1] else 0}
+    return out
+
+
+def get_metrics():
+    """Metrics of the current process"""
+    global METRICS, METRICS_PID
+    if METRICS is None or METRICS_PID != os.getpid():
+        METRICS = Metrics()
+        METRICS_PID = os.getpid()
+    return METRICS
+
+
+class _Pusher:
+    def __init__(self, registry, interval, summary_interval):
+        self.registry = registry
+        self.interval = interval
+        self.summary_interval = summary_interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def push(self):
+        snapshot = get_metrics().snapshot()
+        try:
+            self.registry.update(os.getpid(), snapshot)
+        except Exception as e:
+            logging.error("Can't push metrics: " + str(e))
+        return snapshot
+
+    def _run(self):
+        last_summary = time.time()
+        while not self._stop.wait(self.interval):
+            snapshot = self.push()
+            if time.time() - last_summary >= self.summary_interval:
+                logging.info("Metrics summary " + json.dumps(summary(snapshot), sort_keys=True))
+                last_summary = time.time()
+
+    def close(self):
+        if self._stop.is_set():
+            return
+        self._stop.set()
+        self._thread.join()
+        logging.critical("Metrics summary " + json.dumps(summary(self.push()), sort_keys=True))
+
+
+def start_metrics_push(registry, interval=PUSH_INTERVAL, summary_interval=SUMMARY_INTERVAL):
+    """Push the metrics of this process to registry every interval seconds and once more when it exits, logging a
+    summary every summary_interval seconds and at exit"""
+    pusher = _Pusher(registry, interval, summary_interval)
+    # after the pipeline (exitpriority 10) has written its last tweets
+    Finalize(pusher, pusher.close, exitpriority=5)
+    return pusher
+
+
+def serve_metrics(registry, port=DEFAULT_METRICS_PORT, host="127.0.0.1"):
+    """Serve the totals of registry at http://host:port/metrics from a background thread
+
+    Returns:
+        ThreadingHTTPServer: call shutdown() on it to stop serving
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] not in ("/", "/metrics"):
+                self.send_error(404)
+                return
+            body = registry.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, int(port)), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logging.info("Serving metrics at http://{}:{}/metrics".format(host, port))
+    return server
@@ -1,18 +1,44 @@
 #!/usr/bin/python3
+"""Print the progress of a running crawl from its metrics endpoint: python3 monitor.py [port]"""
+import re
+import sys
 import time
-initial_count=0
-with open('/home/abhishek/Documents/TweetCrawlMultiThreaded/handle_counter.txt','r',encoding="utf8") as f:
-    for t in f:
-        initial_count = int(t.split()[0]);
-handles_crawled = 0
-curr_count = 0
-with open('/home/abhishek/Documents/TweetCrawlMultiThreaded/crawled.txt','r',encoding="utf8") as f:
-    for x in f:
-        curr_count+=1
-if handles_crawled != (curr_count - initial_count):
-    handles_crawled = (curr_count - initial_count)
-    print(f"Crawled {handles_crawled} handles")
-
-   
+import urllib.request
 
+DEFAULT_PORT = 9108
+INTERVAL = 10
 
+
+def scrape(url):
+    """Samples of the endpoint keyed by series, plus their sum over all labels keyed by metric name"""
+    totals = {}
+    with urllib.request.urlopen(url, timeout=10) as resp:
+        for line in resp.read().decode("utf-8").splitlines():
+            match = re.match(r'(\w+)(\{[^}]*\})? (\S+)$', line)
+            if match:
+                name, labels, value = match.groups()
+                totals[name + (labels or "")] = float(value)
+                if labels:
+                    totals[name] = totals.get(name, 0) + float(value)
+    return totals
+
+
+def main(port):
+    url = "http://127.0.0.1:{}/metrics".format(port)
+    before = scrape(url)
+    time.sleep(INTERVAL)
+    after = scrape(url)
+    handles_done = sum(value for key, value in after.items()
+                       if key.startswith('tweetcrawler_handles_total{') and 'status="done"' in key)
+    inserted = after.get('tweetcrawler_tweets_total{result="inserted"}', 0)
+    print(f"Crawled {handles_done:.0f} handles, inserted {inserted:.0f} tweets")
+
+    def rate(name):
+        return (after.get(name, 0) - before.get(name, 0)) / INTERVAL
+
+    print(f"{rate('tweetcrawler_tweets_fetched_total'):.1f} tweets/s, {rate('tweetcrawler_pages_total'):.2f} pages/s, "
+          f"{after.get('tweetcrawler_handles_in_progress', 0):.0f} handles in progress")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1] if len(sys.argv) > 1 else DEFAULT_PORT)
@@ -0,0 +1,283 @@
+"""Fetch -> normalize -> sink pipeline
+
+Fetchers hand raw pages to normalizer threads through a bounded queue, normalizers hand TweetRecords to dedicated
+writer threads through bounded queues, and writers flush per handle by size or age. When the writers fall behind the
+queues fill up and submit_page blocks, so memory stays bounded and a slow database no longer stalls the API calls
+in between flushes (and vice versa). After every successful flush to a durable sink (and when the handle is closed
+for the others) the writer reports how far down the timeline of a handle everything has been written, which is the
+cursor an interrupted crawl resumes from.
+"""
+import logging
+import os
+import queue
+import threading
+import time
+import zlib
+
+from crawl_state import get_state
+from metrics import get_metrics
+from normalizer import normalize_record
+from storage import InsertResult, add_results
+
+_END = object()
+_PAGE = object()
+
+DEFAULT_PIPELINE = {'normalizers': 1, 'writers': 1, 'flush_size': 500, 'flush_interval': 5.0, 'queue_size': 64}
+
+
+def save_checkpoint(curr_id, max_id, newest_id, search=False):
+    """on_checkpoint of the crawler: persist the cursor below the last written page"""
+    get_state().checkpoint(curr_id, max_id, newest_id, search)
+
+
+def log_handle_crawled(curr_id, result, completed, newest_id, search=False):
+    """on_handle_done of the crawler: mark the handle crawled in the state store, remembering the newest tweet id
+    for the next incremental crawl, and log its summary. A handle some tweets of which couldn't be written is marked
+    failed instead, so the next crawl fetches them again rather than starting above them."""
+    if not completed or result.failed:
+        get_state().fail(curr_id, search)
+        if result.failed:
+            logging.error("{} Handle not marked crawled, {} tweets failed to be written".format(curr_id, result.failed))
+        return
+    get_state().finish(curr_id, newest_id, search)
+    logging.critical("{} Handle crawled: Total tweets inserted successfully:{}, duplicates:{}, tweets failed:{} "
+                     .format(curr_id, result.inserted, result.duplicates, result.failed))
+
+
+class _HandleState:
+    __slots__ = ('pages', 'normalized', 'skipped', 'fetch_done', 'completed', 'newest_id')
+
+    def __init__(self):
+        self.pages = 0
+        self.normalized = 0
+        self.skipped = 0
+        self.fetch_done = False
+        self.completed = True
+        self.newest_id = None
+
+
+class CrawlPipeline:
+    """Bounded fetch -> normalize -> write pipeline
+
+    Args:
+        sink: sink from storage.open_sink, written to from the writer threads
+        on_handle_done (callable): on_handle_done(curr_id, result, completed, newest_id) once every tweet of a
+            finished handle has been written, newest_id being the highest tweet id submitted for it
+        on_checkpoint (callable, optional): on_checkpoint(curr_id, max_id, newest_id) whenever all the pages of a
+            handle down to max_id have been written
+        normalizers (int): Number of normalizer threads
+        writers (int): Number of writer threads, every handle is always written by the same writer
+        flush_size (int): Tweets buffered per handle before they are written
+        flush_interval (float): Seconds after which a partially filled buffer is written anyway
+        queue_size (int): Pages waiting to be normalized before fetchers block
+        seen (seen_ids.SeenIds, optional): Shared filter of tweet ids already written, tweets found in it are
+            dropped before normalization and counted as duplicates of their handle. Ids are added to it once the
+            sink wrote all the tweets of a flush, or once the handle is closed for a sink that isn't durable.
+    """
+
+    def __init__(self, sink, on_handle_done, normalizers=1, writers=1, flush_size=500, flush_interval=5.0,
+                 queue_size=64, on_checkpoint=None, seen=None):
+        self.sink = sink
+        self.seen = seen
+        self.on_handle_done = on_handle_done
+        self.on_checkpoint = on_checkpoint
+        self.flush_size = int(flush_size)
+        self.flush_interval = float(flush_interval)
+        self.pages = queue.Queue(maxsize=int(queue_size))
+        self.records = [queue.Queue(maxsize=self.flush_size * 2) for _ in range(int(writers))]
+        self._lock = threading.Lock()
+        self._handles = {}
+        self._normalizers = [threading.Thread(target=self._normalize_loop, daemon=True)
+                             for _ in range(int(normalizers))]
+        self._writers = [threading.Thread(target=self._write_loop, args=(q,), daemon=True) for q in self.records]
+        for t in self._normalizers + self._writers:
+            t.start()
+        self.metrics = get_metrics()
+        worker = os.getpid()
+        self.metrics.gauge_fn('tweetcrawler_queue_depth', self.pages.qsize, queue="pages", worker=worker)
+        self.metrics.gauge_fn('tweetcrawler_queue_depth', lambda: sum(q.qsize() for q in self.records),
+                              queue="records", worker=worker)
+        self.metrics.gauge_fn('tweetcrawler_handles_in_progress', lambda: len(self._handles), worker=worker)
+
+    def submit_page(self, curr_id, page, cursor=True):
+        """Queue a page of raw tweet JSON, blocking while the pipeline is full. Pages submitted with cursor=False
+        (windows of a split search, fetched out of order) are written but never move the resume cursor."""
+        if not page:
+            return
+        ids = [x['id'] for x in page]
+        # a page left empty still goes through, it moves the cursor of the handle
+        new = self.seen.filter_page(page) if self.seen is not None else page
+        with self._lock:
+            state = self._handles.setdefault(curr_id, _HandleState())
+            seq = state.pages
+            state.pages += 1
+            state.skipped += len(page) - len(new)
+            if state.newest_id is None or max(ids) > state.newest_id:
+                state.newest_id = max(ids)
+        self.metrics.inc('tweetcrawler_pages_total')
+        self.metrics.inc('tweetcrawler_tweets_fetched_total', len(page))
+        if len(page) > len(new):
+            self.metrics.inc('tweetcrawler_tweets_total', len(page) - len(new), result="skipped")
+        self.pages.put((curr_id, seq, min(ids) if cursor else None, max(ids), new))
+
+    def finish_handle(self, curr_id, completed=True):
+        """No more pages will be submitted for curr_id. completed is False if the fetch stopped on an error."""
+        with self._lock:
+            state = self._handles.setdefault(curr_id, _HandleState())
+            state.fetch_done = True
+            state.completed = completed
+        self._check_normalized(curr_id)
+
+    def _writer_queue(self, curr_id):
+        return self.records[zlib.crc32(curr_id.encode("utf-8")) % len(self.records)]
+
+    def _check_normalized(self, curr_id):
+        """Tell the handle's writer once every page of a finished handle went through a normalizer. Records are
+        always queued before the counter moves, so the writer sees the marker after the last tweet."""
+        with self._lock:
+            state = self._handles.get(curr_id)
+            if not state or not state.fetch_done or state.normalized < state.pages:
+                return
+            del self._handles[curr_id]
+        self._writer_queue(curr_id).put((curr_id, _END, state))
+
+    def _normalize_loop(self):
+        while True:
+            item = self.pages.get()
+            if item is None:
+                return
+            curr_id, seq, oldest_id, newest_id, page = item
+            out = self._writer_queue(curr_id)
+            for curr_post in page:
+                try:
+                    out.put((curr_id, normalize_record(curr_post), None))
+                except Exception:
+                    continue
+            out.put((curr_id, _PAGE, (seq, oldest_id, newest_id)))
+            with self._lock:
+                self._handles[curr_id].normalized += 1
+            self._check_normalized(curr_id)
+
+    def _flush(self, curr_id, posts, results, progress=None, written=None):
+        """Write posts of curr_id. If any of them fail its cursor stops moving, so an interrupted crawl resumes above
+        the failed page rather than below it. Otherwise their ids go into the seen filter, or into written until the
+        handle is closed for a sink that isn't durable."""
+        try:
+            with self.metrics.timer('tweetcrawler_sink_write_seconds', sink=type(self.sink).__name__):
+                result = self.sink.write(curr_id, posts)
+        except Exception as e:
+            logging.error("Can't write tweets of " + str(curr_id) + " exception: " + str(e))
+            result = InsertResult(0, 0, len(posts))
+        for name, count in result._asdict().items():
+            if count:
+                self.metrics.inc('tweetcrawler_tweets_total', count, result=name)
+        results[curr_id] = add_results(results.get(curr_id, InsertResult(0, 0, 0)), result)
+        if result.failed:
+            if progress is not None:
+                progress.setdefault(curr_id, [0, {}, 0])[0] = None
+        elif self.seen is not None:
+            if self.sink.durable:
+                self.seen.add(post.get('id') for post in posts)
+            elif written is not None:
+                written.setdefault(curr_id, []).extend(post.get('id') for post in posts)
+
+    def _checkpoint(self, curr_id, progress, closed=False):
+        """Advance the cursor over the pages whose tweets have all been flushed. Pages can be normalized out of
+        order, so it only moves over a contiguous run of them. Tweets written to a sink that isn't durable only
+        persist once the handle is closed, so its cursor only moves then."""
+        if self.on_checkpoint is None or curr_id not in progress or not (closed or self.sink.durable):
+            return
+        next_seq, pages, newest_id = progress[curr_id]
+        if next_seq is None:
+            return
+        max_id = None
+        while next_seq in pages:
+            oldest_id, page_newest = pages.pop(next_seq)
+            if oldest_id is not None:
+                max_id = oldest_id - 1
+            newest_id = max(newest_id, page_newest)
+            next_seq += 1
+        progress[curr_id] = [next_seq, pages, newest_id]
+        if max_id is not None:
+            try:
+                self.on_checkpoint(curr_id, max_id, newest_id)
+            except Exception as e:
+                logging.error("Can't save cursor of " + str(curr_id) + " exception: " + str(e))
+
+    def _write_loop(self, records):
+        buffers = {}
+        started = {}
+        results = {}
+        # pages whose tweets are all buffered or written, per handle: [next page to checkpoint, pages, newest id],
+        # the next page being None once a write of the handle failed
+        progress = {}
+        # ids of the tweets written to a sink that isn't durable, added to the seen filter once their handle is closed
+        written = {}
+        while True:
+            try:
+                item = records.get(timeout=self.flush_interval)
+            except queue.Empty:
+                item = False
+            if item is None:
+                break
+            if item:
+                curr_id, dc, state = item
+                if dc is _PAGE:
+                    seq, oldest_id, newest_id = state
+                    progress.setdefault(curr_id, [0, {}, 0])[1][seq] = (oldest_id, newest_id)
+                    if curr_id not in buffers:
+                        self._checkpoint(curr_id, progress)
+                    continue
+                if dc is _END:
+                    if curr_id in buffers:
+                        self._flush(curr_id, buffers.pop(curr_id), results, progress, written)
+                        del started[curr_id]
+                    written_ids = written.pop(curr_id, ())
+                    result = add_results(results.pop(curr_id, InsertResult(0, 0, 0)), InsertResult(0, state.skipped, 0))
+                    completed = state.completed
+                    try:
+                        self.sink.close_handle(curr_id)
+                    except Exception as e:
+                        logging.error("Can't close handle " + str(curr_id) + " exception: " + str(e))
+                        completed = False
+                    else:
+                        if self.seen is not None:
+                            self.seen.add(written_ids)
+                        if not completed:
+                            # resume the fetch that stopped below everything written
+                            self._checkpoint(curr_id, progress, closed=True)
+                    progress.pop(curr_id, None)
+                    self.metrics.inc('tweetcrawler_handles_total', worker=os.getpid(),
+                                     status="done" if completed and not result.failed else "failed")
+                    try:
+                        self.on_handle_done(curr_id, result, completed, state.newest_id)
+                    except Exception as e:
+                        logging.error("Can't finish handle " + str(curr_id) + " exception: " + str(e))
+                    continue
+                if curr_id not in buffers:
+                    buffers[curr_id] = []
+                    started[curr_id] = time.time()
+                buffers[curr_id].append(dc)
+                if len(buffers[curr_id]) >= self.flush_size:
+                    self._flush(curr_id, buffers.pop(curr_id), results, progress, written)
+                    del started[curr_id]
+                    self._checkpoint(curr_id, progress)
+            now = time.time()
+            for curr_id in [x for x, t in started.items() if now - t >= self.flush_interval]:
+                self._flush(curr_id, buffers.pop(curr_id), results, progress, written)
+                del started[curr_id]
+                self._checkpoint(curr_id, progress)
+        for curr_id, posts in buffers.items():
+            self._flush(curr_id, posts, results)
+
+    def close(self):
+        """Drain every queue and stop the threads"""
+        for _ in self._normalizers:
+            self.pages.put(None)
+        for t in self._normalizers:
+            t.join()
+        for q in self.records:
+            q.put(None)
+        for t in self._writers:
+            t.join()
+        self.sink.close()
@@ -1,15 +1,17 @@
 import logging
-import os
 import pickle
-import sqlite3
-import urllib.request
 from collections import OrderedDict
 
-import networkx as nx
 import psycopg2
-import requests
 import tweepy
-from bs4 import BeautifulSoup
+
+from edge_lists import construct_edge_lists
+from graph_builder import GraphBuilder
+from normalizer import normalize_tweet
+from scraper_jobs import DONE, run_scraper_jobs
+from seed_handles import LOCAL_HANDLE_FILES, get_seed_handles
+from storage import SQLITE_TABLE, create_sqlite_table, insert_into_sqlite, sqlite_connect
+from unshortener import URL_CACHE_DB, unshorten
 
 
 def get_pickle(file):
@@ -26,37 +28,53 @@ def get_pickle(file):
     return ls
 
 
-def get_political_handles(list_file=['files/inc_handles.txt', 'files/bjp_handles.txt'], get_online=True):
-    """Get the political handles from files as well as socialbakers site
+def get_political_handles(list_file=list(LOCAL_HANDLE_FILES), get_online=True):
+    """Get the political handles from files as well as socialbakers site, see seed_handles
     Returns:
-        list: list of twitter handles
+        list: list of twitter handles, normalized and without duplicates
     Args:
         list_file (list, optional): List of files from which to get handles
         get_online (bool, optional): Whether or not to get info online
     """
-    ls_fin = []
-    for i in range(1, 23):
-        url = "https://www.socialbakers.com/statistics/twitter/profiles/india/society/politics/page-" + \
-              str(i) + "/?showMoreList-from=1&do=platformList-renderAjax&json"
-        html = urllib.request.urlopen(url)
-        soup = BeautifulSoup(html, 'html.parser')
-        intm = soup.find_all('h2')
-        for y in intm:
-            for x in y.find_all('span'):
-                ls_fin.append(x.text.split(
-                    '(')[-1].replace(')', '').replace('@', ''))
-    for file in list_file:
-        with open(file) as f:
-            for i in f:
-                if i:
-                    ls_fin.append(i.strip())
-    logging.info(str(len(ls_fin)) + " IDs crawled")
-    return (ls_fin)
+    return get_seed_handles(list_file, get_online)
+
+
+def iter_crawl_twitter(list_ids, api, batch_size=200, wait_on_rate_limit=False, errors=None):
+    """Crawl the timelines of list_ids, yielding the tweets as they come in batches
+
+    A handle that fails (protected, suspended, network error...) is logged and skipped, the batches already yielded
+    for it and the other handles are kept. Every batch can go straight to preproc_db, insert_into_db_list or, through
+    edge_lists.edge_rows, to construct_edge_list, so the whole crawl never has to be held in memory.
+
+    Args:
+        list_ids (iterable): Twitter handles to be crawled
+        api (tweepyAPI object): Tweepy api object initialized appropriately
+        batch_size (int, optional): Tweets per batch, a batch never mixes handles
+        wait_on_rate_limit (bool, optional): wait on exhaustion of quota and continue once replenished
+        errors (dict, optional): Filled with handle -> exception for the handles that failed
 
+    Yields:
+        tuple: (handle, list of tweet dicts as built by normalize_tweet)
+    """
+    for curr_id in list_ids:
+        batch = []
+        try:
+            for post in tweepy.Cursor(api.user_timeline, id=curr_id, count=200, summary=False, tweet_mode="extended",
+                                      wait_on_rate_limit=wait_on_rate_limit).items():
+                batch.append(OrderedDict(normalize_tweet(post._json, tweet_from=curr_id)))
+                if len(batch) >= batch_size:
+                    yield curr_id, batch
+                    batch = []
+        except Exception as e:
+            logging.error("Can't crawl " + str(curr_id) + " exception: " + str(e))
+            if errors is not None:
+                errors[curr_id] = e
+        if batch:
+            yield curr_id, batch
 
 
 def crawl_twitter(list_ids, api, wait_on_rate_limit=False):
-    """Crawl twitter using official twitter API. Inserts into postgres database
+    """Crawl twitter using official twitter API. Use iter_crawl_twitter for crawls that don't fit in memory.
 
     Args:
         list_ids (list): List of twitter handles to be crawled
@@ -64,61 +82,15 @@ def crawl_twitter(list_ids, api, wait_on_rate_limit=False):
         wait_on_rate_limit (bool, optional): wait on exhaustion of quota and continue once replenished
 
     Returns:
-        list: list of dictionaries representing tweets
+        list: list of dictionaries representing tweets, of every handle that could be crawled
 
     Deleted Parameters:
         db (bool, optional): Insert into database
     """
-
     ldc = []
-    count = 0
-    try:
-        for curr_id in list_ids:
-            for post in tweepy.Cursor(api.user_timeline, id=curr_id, summary=False, tweet_mode="extended",
-                                      wait_on_rate_limit=wait_on_rate_limit).items():
-                dc = OrderedDict()
-                curr_post = post._json
-                dc['tweet_from'] = curr_id
-                dc['created_at'] = curr_post['created_at']
-                dc['hashtags'] = [x['text']
-                                  for x in curr_post['entities']['hashtags']]
-                dc['urls'] = [x['expanded_url']
-                              for x in curr_post['entities']['urls']]
-                dc['user_mentions_id'] = [x['id']
-                                          for x in curr_post['entities']['user_mentions']]
-                if 'media' in curr_post['entities']:
-                    dc['media'] = [x['media_url_https']
-                                   for x in curr_post['entities']['media']]
-                dc['user_mentions_name'] = [x['screen_name']
-                                            for x in curr_post['entities']['user_mentions']]
-                dc['origin_device'] = BeautifulSoup(
-                    curr_post['source'], 'html.parser').a.string
-                dc['favorite_count'] = curr_post['favorite_count']
-                dc['text'] = curr_post['full_text']
-                dc['id'] = curr_post['id']
-                dc['in_reply_to_screen_name'] = curr_post[
-                    'in_reply_to_screen_name']
-                dc['in_reply_to_user_id'] = curr_post['in_reply_to_user_id']
-                dc['in_reply_to_status_id'] = curr_post[
-                    'in_reply_to_status_id']
-                dc['retweet_count'] = curr_post['retweet_count']
-                #         adding retweet information because it is important.
-                if ('retweeted_status' in curr_post):
-                    dc['retweeted_status_text'] = curr_post[
-                        'retweeted_status']['full_text']
-                    dc['retweeted_status_url'] = [x['expanded_url']
-                                                  for x in curr_post['retweeted_status']['entities']['urls']]
-                    dc['retweeted_status_id'] = curr_post[
-                        'retweeted_status']['id']
-                    dc['retweeted_status_user_name'] = curr_post[
-                        'retweeted_status']['user']['name']
-                    dc['retweeted_status_user_handle'] = curr_post[
-                        'retweeted_status']['user']['screen_name']
-                ldc.append(dc)
-                count += 1
-    except Exception as twe:
-        print(str(twe))
-    print("Total count : " + str(count))
+    for _, batch in iter_crawl_twitter(list_ids, api, wait_on_rate_limit=wait_on_rate_limit):
+        ldc.extend(batch)
+    print("Total count : " + str(len(ldc)))
     return (ldc)
 
 
@@ -131,8 +103,7 @@ def initialize_sqlite(file='twitter.db'):
     Returns:
         sqlite connection: Sqlite connection object
     """
-    conn = sqlite3.connect(file)
-    return conn
+    return sqlite_connect(file)
 
 
 def preproc_db(ldc):
@@ -177,57 +148,59 @@ def preproc_db(ldc):
     return (ldc)
 
 
-def insert_into_db_list(ldc):
-    count = 0
-    for dc in ldc:
-        try:
-            columns = ', '.join(dc.keys())
-            placeholders = ':' + ', :'.join(dc.keys())
-            query = 'INSERT INTO TWITTER (%s) VALUES (%s)' % (
-                columns, placeholders)
-            conn.execute(query, dc)
-        except sqlite3.IntegrityError as e:
-            count += 1
-    print("Duplicates: " + str(count))
-    conn.commit()
+def insert_into_db_list(ldc, conn):
+    """Insert crawled tweets into the TWITTER table in one transaction, skipping the ones already stored. List fields
+    are stored comma separated, there is no need to run preproc_db first.
+
+    Args:
+        ldc (list): List of dicts containing crawled data from twitter
+        conn: Connection from initialize_sqlite
+
+    Returns:
+        InsertResult: number of tweets inserted, skipped as already present and failed
+    """
+    result = insert_into_sqlite(ldc, conn, SQLITE_TABLE)
+    print("Duplicates: " + str(result.duplicates))
+    return result
 
 
 def create_table_db(conn):
-    conn.execute('''CREATE TABLE TWITTER
-         (
-         id INT PRIMARY KEY NOT NULL,
-         tweet_from TEXT    NOT NULL,
-         created_at            BLOB     NOT NULL,
-         hashtags        TEXT,
-         urls         TEXT,
-         user_mentions_id TEXT,
-         media TEXT,
-         user_mentions_name TEXT,
-         origin_device TEXT,
-         favorite_count INT,
-         text TEXT,
-
-         in_reply_to_screen_name TEXT,
-         in_reply_to_user_id INT,
-         in_reply_to_status_id INT,
-         retweet_count INT,
-         retweeted_status_text TEXT,
-         retweeted_status_url BLOB,
-         retweeted_status_id INT,
-         retweeted_status_user_name TEXT,
-         retweeted_status_user_handle TEXT
-
-         );''')
-
-
-def construct_graph(edge_list, G=nx.DiGraph()):
-    for t in edge_list:
-        if (len(t) == 2):
-            if (G.has_edge(t[0], t[1])):
-                G[t[0]][t[1]]['weight'] += 1
-            else:
-                G.add_edge(t[0], t[1], weight=1)
-    return (G)
+    create_sqlite_table(conn, SQLITE_TABLE)
+
+
+def construct_graph(edge_list, G=None):
+    """Weighted networkx.DiGraph of edge_list
+
+    Args:
+        edge_list (list): (source, target) pairs, every pair adds 1 to the weight of its edge
+        G (networkx.DiGraph, optional): Graph whose weights to add to, a new one by default
+
+    Returns:
+        networkx.DiGraph: G with the edges of edge_list
+    """
+    builder = GraphBuilder()
+    builder.add_edges(edge_list)
+    return builder.to_networkx(G)
+
+
+def construct_graphs(batches, batch_size=None):
+    """Mention and web source graphs of a large crawl, built batch by batch without networkx
+
+    Args:
+        batches (iterable): Lists of (user_from, user_mention, link) tuples as taken by construct_edge_list, e.g.
+            edge_lists.read_pg_chunks(db_credentials) or edge_lists.read_parquet_chunks(folder)
+        batch_size (int, optional): Edges kept as plain arrays before they are summed, see GraphBuilder
+
+    Returns:
+        tuple: user->user and user->source GraphBuilder, call to_networkx() on them for a networkx graph
+    """
+    kwargs = {'batch_size': batch_size} if batch_size else {}
+    users, sources = GraphBuilder(**kwargs), GraphBuilder(**kwargs)
+    for cong in batches:
+        user_edges, source_edges = construct_edge_list(cong)
+        users.add_edges(user_edges)
+        sources.add_edges(source_edges)
+    return users, sources
 
 
 def get_list_ids_to_crawl_next(combined_id, list_ids=[], idx=1):
@@ -241,21 +214,19 @@ def get_list_ids_to_crawl_next(combined_id, list_ids=[], idx=1):
     return (new_list_to_crawl)
 
 
-def crawl(combined_id):
-    for index, x in enumerate(combined_id):
-        if (x):
-            combined_id[index] = "from:" + x
-    if not combined_id[0]:
-        combined_id.pop(0)
-    succ_cnt = 0
-    for c in combined_id:
-        print("Current id -> " + c + "\n Success Count -> " + str(succ_cnt))
-        rs = os.system(
-            "cd ../TweetScraper; scrapy crawl TweetScraper -a query=\"" + c + "\"")
-        if (rs == 0):
-            id_crawled.append(c)
-            succ_cnt += 1
-    return (succ_cnt)
+def crawl(combined_id, workers=None, timeout=None):
+    """Scrape the tweets of every handle with TweetScraper, workers handles at a time, see scraper_jobs
+
+    Args:
+        combined_id (list): Handles to scrape, empty entries are skipped
+        workers (int, optional): Scrapers running at once, the number of cores by default
+        timeout (float, optional): Seconds after which a scraper is killed
+
+    Returns:
+        int: Number of handles scraped successfully, handles scraped by an earlier run are skipped
+    """
+    results = run_scraper_jobs(("from:" + x for x in combined_id if x), workers, timeout)
+    return sum(result.status == DONE for result in results)
 
 
 def construct_edge_list(cong):
@@ -263,58 +234,22 @@ def construct_edge_list(cong):
     Constructs edge lists with two mappings user->user mapping and user-websource mapping
 
     Paramaters:
-        cong - list of tuples with 3 fields(user_from,user_mention,link)
+        cong - list of tuples with 3 fields(user_from,user_mention,link), or a chunk of
+            edge_lists.read_pg_chunks / read_parquet_chunks
     returns:
         user-user edge list, user-source edge
     """
-    usr_to_src = []
-    list_to_exclude = [
-        'twitter',
-        'youtu',
-        'fllwrs',
-        'unfollowspy',
-        'livetv',
-        'pscp',
-        'live',
-        'ln.is',
-        'tinyurl',
-        'facebook',
-        'bit.ly',
-        'goo.gl',
-        'instagram',
-        'google'
-    ]
-    for x in cong:
-        if x[2]:
-            for url in x[2].split(','):
-                if not any(y in url for y in list_to_exclude) and x[0] not in url.replace('.', '_'):
-                    if url.endswith('.com') and url.startswith("http://www"):
-                        usr_to_src.append((x[0], url.split('.')[1].lower()))
-                    elif url.endswith('.com') and url.startswith("http://m"):
-                        usr_to_src.append((x[0], url.split('.')[1].lower()))
-                    elif url.endswith('.in') and url.startswith("http://www"):
-                        usr_to_src.append((x[0], url.split('.')[1].lower()))
-                    elif url.startswith("http://") or url.startswith("https://"):
-                        l_url = url.split('/')
-                        if len(l_url) >= 3 and '.' in l_url[2]:
-                            if l_url[2].startswith('www') or l_url[2].startswith('m'):
-                                usr_to_src.append(
-                                    (x[0], l_url[2].split('.')[1].lower()))
-                            else:
-                                usr_to_src.append((x[0], l_url[2].lower()))
-
-    ll = []
-    for i in cong:
-        if i[1]:
-            for x in i[1].split(','):
-                if (x != '@'):
-                    x = x.replace('@', '')
-                    ll.append((i[0], x))
-    return (ll, usr_to_src)
-
-
-def unshorten_url(url):
-    return requests.head(url, allow_redirects=True).url
+    return construct_edge_lists(cong)
+
+
+def unshorten_url(url, cache_file=URL_CACHE_DB):
+    """Final URL of a short link, None if it can't be fetched. Use unshortener.unshorten to resolve many links at once.
+
+    Args:
+        url (str): Link to resolve
+        cache_file (str, optional): SQLite cache of the links already resolved, None to always fetch
+    """
+    return unshorten([url], cache_file)[url]
 
 
 def pg_get_conn(database="fakenews", user="fakenews", password="fnd"):
@@ -0,0 +1,145 @@
+"""Shared per-credential rate limit scheduler
+
+Every API call leases a credential from a single RateLimitScheduler which tracks the remaining quota and reset time
+of every credential per endpoint, so work always goes to a token that still has quota left instead of each tweepy
+object sleeping on its own exhausted token. The scheduler lives in a manager process and is shared by all workers.
+"""
+import copy
+import os
+import threading
+import time
+from multiprocessing.managers import BaseManager
+
+import tweepy
+
+from metrics import MetricsRegistry, get_metrics
+
+DEFAULT_API_HOST = "api.twitter.com"
+RATE_LIMIT_WINDOW = 15 * 60
+# requests per 15 minute window for user auth, https://developer.twitter.com/en/docs/basics/rate-limits
+ENDPOINT_LIMITS = {'user_timeline': 900, 'search': 180, 'trends_place': 75}
+_THREAD_APIS = threading.local()
+
+
+class RateLimitScheduler:
+    def __init__(self, no_of_credentials, limits=None):
+        self.limits = dict(limits or ENDPOINT_LIMITS)
+        self.no_of_credentials = no_of_credentials
+        self._lock = threading.Lock()
+        self._remaining = {endpoint: [limit] * no_of_credentials for endpoint, limit in self.limits.items()}
+        self._reset = {endpoint: [0] * no_of_credentials for endpoint in self.limits}
+        self._waited = [0.0] * no_of_credentials
+
+    def acquire(self, endpoint):
+        """Lease a credential for one call to endpoint
+
+        Returns:
+            tuple: (credential, 0) if a credential has quota left, otherwise (credential, seconds) where credential
+            is the one whose window resets first and seconds is the time left until then
+        """
+        with self._lock:
+            now = time.time()
+            remaining = self._remaining[endpoint]
+            reset = self._reset[endpoint]
+            for credential in range(self.no_of_credentials):
+                if reset[credential] <= now:
+                    remaining[credential] = self.limits[endpoint]
+                    reset[credential] = now + RATE_LIMIT_WINDOW
+            credential = max(range(self.no_of_credentials), key=lambda x: remaining[x])
+            if remaining[credential] > 0:
+                remaining[credential] -= 1
+                return credential, 0
+            credential = min(range(self.no_of_credentials), key=lambda x: reset[x])
+            return credential, reset[credential] - now
+
+    def update(self, credential, endpoint, remaining, reset):
+        """Overwrite the local estimate with the quota reported by twitter in the response headers"""
+        with self._lock:
+            self._remaining[endpoint][credential] = int(remaining)
+            self._reset[endpoint][credential] = int(reset)
+
+    def exhausted(self, credential, endpoint, reset=None):
+        with self._lock:
+            self._remaining[endpoint][credential] = 0
+            self._reset[endpoint][credential] = int(reset) if reset else time.time() + RATE_LIMIT_WINDOW
+
+    def record_wait(self, credential, seconds):
+        with self._lock:
+            self._waited[credential] += seconds
+
+    def wait_report(self):
+        """Seconds spent waiting on rate limits, per credential"""
+        with self._lock:
+            return list(self._waited)
+
+
+class SchedulerManager(BaseManager):
+    pass
+
+
+SchedulerManager.register('RateLimitScheduler', RateLimitScheduler)
+SchedulerManager.register('MetricsRegistry', MetricsRegistry)
+
+
+def api_host():
+    """Host of the twitter API, the TWITTER_API_HOST environment variable points every process of the crawler at
+    another server, e.g. the mock API of the benchmarks"""
+    return os.environ.get("TWITTER_API_HOST", DEFAULT_API_HOST)
+
+
+def update_from_headers(scheduler, credential, endpoint, headers):
+    remaining = headers.get('x-rate-limit-remaining')
+    reset = headers.get('x-rate-limit-reset')
+    if remaining is not None and reset is not None:
+        scheduler.update(credential, endpoint, remaining, reset)
+
+
+def thread_api(api):
+    """Copy of the tweepy API object owned by the calling thread. tweepy keeps the last response on the API object,
+    so threads sharing one, e.g. the windows of a split search, would read each other's rate limit headers."""
+    apis = getattr(_THREAD_APIS, 'apis', None)
+    if apis is None:
+        apis = _THREAD_APIS.apis = {}
+    entry = apis.get(id(api))
+    if entry is None or entry[0] is not api:
+        entry = apis[id(api)] = (api, copy.copy(api))
+    return entry[1]
+
+
+def lease_credential(scheduler, endpoint):
+    """Block until a credential with quota left for endpoint is available and return it"""
+    while True:
+        credential, wait = scheduler.acquire(endpoint)
+        if wait <= 0:
+            return credential
+        scheduler.record_wait(credential, wait)
+        get_metrics().inc('tweetcrawler_rate_limit_wait_seconds_total', wait, credential=credential)
+        time.sleep(wait)
+
+
+def call_api(scheduler, api_list, endpoint, **kwargs):
+    """Call endpoint on whichever tweepy API object the scheduler leases, retrying on another one when rate limited
+
+    Args:
+        scheduler (RateLimitScheduler): scheduler or its proxy shared by all workers
+        api_list (list): tweepy API objects, one per credential, created with wait_on_rate_limit=False
+        endpoint (str): name of the tweepy API method, one of ENDPOINT_LIMITS
+    """
+    metrics = get_metrics()
+    while True:
+        credential = lease_credential(scheduler, endpoint)
+        api = thread_api(api_list[credential])
+        try:
+            with metrics.timer('tweetcrawler_api_request_seconds', endpoint=endpoint):
+                result = getattr(api, endpoint)(**kwargs)
+        except tweepy.error.TweepError as e:
+            response = getattr(e, 'response', None)
+            if response is not None and response.status_code in (420, 429):
+                metrics.inc('tweetcrawler_rate_limited_total', endpoint=endpoint)
+                scheduler.exhausted(credential, endpoint, response.headers.get('x-rate-limit-reset'))
+                continue
+            metrics.inc('tweetcrawler_api_errors_total', endpoint=endpoint,
+                        status=response.status_code if response is not None else "none")
+            raise
+        update_from_headers(scheduler, credential, endpoint, api.last_response.headers)
+        return result
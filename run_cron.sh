@@ -1,8 +1,6 @@
 #!/bin/bash
-pkill -f trending;
-wc -l /home/abhishek/Documents/TweetCrawlMultiThreaded/crawled.txt > handle_counter.txt;
+# the trending crawler runs as a daemon, cron only starts it again when it is not running
 cd /home/abhishek/Documents/TweetCrawlMultiThreaded;
 source /home/abhishek/Documents/TweetCrawlMultiThreaded/venv/bin/activate;
-python3 /home/abhishek/Documents/TweetCrawlMultiThreaded/TweetCrawler.py -trending &;
-
-
+pgrep -f "TweetCrawler.py -trending --daemon" > /dev/null ||
+    nohup python3 /home/abhishek/Documents/TweetCrawlMultiThreaded/TweetCrawler.py -trending --daemon > /dev/null 2>&1 &
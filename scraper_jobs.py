@@ -0,0 +1,191 @@
+"""Parallel TweetScraper runs
+
+preproc.crawl used to run one `scrapy crawl TweetScraper` per query through the shell, one after the other, so a
+single slow query held up the rest and the only record of what was done was a list in memory. Here every query is its
+own subprocess, started without a shell in the TweetScraper folder, with up to workers of them running at once and a
+timeout after which the whole process group is killed. The exit status and run time of every query are kept in an
+SQLite store, and queries that completed before are skipped, so an interrupted backfill picks up where it stopped.
+"""
+import logging
+import os
+import signal
+import sqlite3
+import subprocess
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+SCRAPER_DIR = "../TweetScraper"
+SCRAPER_COMMAND = ("scrapy", "crawl", "TweetScraper", "-a")
+SCRAPER_STATE_DB = "./scraper_jobs.db"
+# seconds a timed out job gets to exit after SIGTERM before it is killed
+KILL_GRACE = 10
+
+DONE = "done"
+FAILED = "failed"
+TIMED_OUT = "timed_out"
+
+JobResult = namedtuple('JobResult', ['query', 'status', 'returncode', 'elapsed'])
+
+
+class JobStore:
+    """Outcome of the last run of every query"""
+
+    def __init__(self, path=SCRAPER_STATE_DB):
+        self.path = path
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        self.conn.execute("pragma journal_mode=wal")
+        self.conn.execute("create table if not exists scraper_jobs (query text primary key, status text not null, "
+                          "returncode integer, elapsed real, attempts integer not null default 1, "
+                          "updated_at real not null) without rowid")
+
+    def record(self, result):
+        with self._lock:
+            self.conn.execute("insert into scraper_jobs (query, status, returncode, elapsed, updated_at) "
+                              "values (?, ?, ?, ?, ?) on conflict (query) do update set status = excluded.status, "
+                              "returncode = excluded.returncode, elapsed = excluded.elapsed, "
+                              "attempts = attempts + 1, updated_at = excluded.updated_at",
+                              (result.query, result.status, result.returncode, result.elapsed, time.time()))
+
+    def completed(self, queries):
+        """Subset of queries whose last run succeeded"""
+        with self._lock:
+            return {query for query in queries if self.conn.execute(
+                "select 1 from scraper_jobs where query = ? and status = ?", (query, DONE)).fetchone()}
+
+    def counts(self):
+        with self._lock:
+            return dict(self.conn.execute("select status, count(*) from scraper_jobs group by status").fetchall())
+
+    def close(self):
+        self.conn.close()
+
+
+class ScraperRunner:
+    """Runs scraper jobs as subprocesses, any number of threads can call run at once
+
+    Args:
+        scraper_dir (str): Working directory of the jobs, the TweetScraper project
+        command (tuple): Command the query is appended to as "query=<query>"
+        timeout (float, optional): Seconds after which a job is killed, None to wait for ever
+        log_folder (str, optional): Folder for the output of every job, discarded when None
+    """
+
+    def __init__(self, scraper_dir=SCRAPER_DIR, command=SCRAPER_COMMAND, timeout=None, log_folder=None):
+        self.scraper_dir = scraper_dir
+        self.command = tuple(command)
+        self.timeout = timeout
+        self.log_folder = log_folder
+        self._lock = threading.Lock()
+        self._running = set()
+        self.stopped = False
+        if log_folder:
+            os.makedirs(log_folder, exist_ok=True)
+
+    def _log_file(self, query):
+        if not self.log_folder:
+            return subprocess.DEVNULL
+        name = "".join(c if c.isalnum() or c in "-_" else "_" for c in query)
+        return open(os.path.join(self.log_folder, name + ".log"), "ab")
+
+    def run(self, query):
+        """Run the job of query, returns its JobResult"""
+        start = time.time()
+        out = self._log_file(query)
+        try:
+            # a session of its own, so a timeout can kill the job together with anything it started
+            proc = subprocess.Popen(self.command + ("query=" + query,), cwd=self.scraper_dir, stdin=subprocess.DEVNULL,
+                                    stdout=out, stderr=subprocess.STDOUT, start_new_session=True)
+        except OSError as e:
+            logging.error("Can't start the scraper for " + query + " exception: " + str(e))
+            return JobResult(query, FAILED, None, time.time() - start)
+        finally:
+            if out is not subprocess.DEVNULL:
+                out.close()
+        with self._lock:
+            self._running.add(proc)
+        try:
+            try:
+                returncode = proc.wait(timeout=self.timeout)
+                status = DONE if returncode == 0 else FAILED
+            except subprocess.TimeoutExpired:
+                returncode = _kill(proc)
+                status = TIMED_OUT
+        finally:
+            with self._lock:
+                self._running.discard(proc)
+        if self.stopped and status != DONE:
+            status = FAILED
+        return JobResult(query, status, returncode, time.time() - start)
+
+    def stop(self):
+        """Kill the running jobs, e.g. on Ctrl-C, as they run in sessions of their own and don't get the signal"""
+        self.stopped = True
+        with self._lock:
+            running = list(self._running)
+        for proc in running:
+            _kill(proc)
+
+
+def _kill(proc):
+    """SIGTERM the process group of proc, SIGKILL it if it doesn't exit within KILL_GRACE seconds"""
+    for sig in (signal.SIGTERM, signal.SIGKILL):
+        try:
+            os.killpg(proc.pid, sig)
+        except ProcessLookupError:
+            pass
+        try:
+            return proc.wait(timeout=KILL_GRACE)
+        except subprocess.TimeoutExpired:
+            continue
+    return proc.wait()
+
+
+def run_scraper_jobs(queries, workers=None, timeout=None, scraper_dir=SCRAPER_DIR, command=SCRAPER_COMMAND,
+                     state_file=SCRAPER_STATE_DB, log_folder=None, rerun=False):
+    """Run a scraper job for every query, workers at a time
+
+    Args:
+        queries (iterable): TweetScraper queries, e.g. "from:handle"
+        workers (int, optional): Jobs running at once, the number of cores by default
+        timeout (float, optional): Seconds after which a job is killed and recorded as timed out
+        scraper_dir (str, optional): TweetScraper project folder
+        command (tuple, optional): Command the query is appended to as "query=<query>"
+        state_file (str, optional): SQLite store of the job outcomes, None to keep none
+        log_folder (str, optional): Folder for the output of every job
+        rerun (bool, optional): Run queries that completed before again
+
+    Returns:
+        list: JobResult of every job run, in the order they finished
+    """
+    queries = list(dict.fromkeys(query for query in queries if query))
+    store = JobStore(state_file) if state_file else None
+    if store is not None and not rerun:
+        completed = store.completed(queries)
+        if completed:
+            logging.info("Skipping {} queries scraped before".format(len(completed)))
+        queries = [query for query in queries if query not in completed]
+    runner = ScraperRunner(scraper_dir, command, timeout, log_folder)
+    results = []
+    try:
+        with ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1) as executor:
+            futures = [executor.submit(runner.run, query) for query in queries]
+            try:
+                for future in as_completed(futures):
+                    result = future.result()
+                    results.append(result)
+                    if store is not None:
+                        store.record(result)
+                    logging.info("{} {} with exit status {} in {:.1f}s ({}/{})".format(
+                        result.query, result.status, result.returncode, result.elapsed, len(results), len(queries)))
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                runner.stop()
+                raise
+    finally:
+        if store is not None:
+            store.close()
+    return results
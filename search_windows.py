@@ -0,0 +1,81 @@
+"""Splitting high volume searches into tweet id windows
+
+Tweet ids are snowflakes whose upper bits are the millisecond the tweet was created, so a range of time is a range of
+ids. The first page of a search tells how many tweets per millisecond the query gets. When paging through the rest of
+it one max_id step at a time would take many pages, the id range below that page, down to since_id or to the 7 days
+the search API covers, is cut into disjoint (since_id, max_id] windows which are crawled at the same time on
+whichever credentials the scheduler leases. Trending tweets are rarely spread evenly over that range, so the first page
+of every window is used to split it again where the tweets actually are. The windows never overlap and together
+cover the whole range, so the merged result has neither gaps nor duplicates.
+"""
+import logging
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+SNOWFLAKE_EPOCH_MS = 1288834974657
+TIMESTAMP_SHIFT = 22
+# the standard search API only returns tweets of the last 7 days
+SEARCH_HORIZON_MS = 7 * 24 * 3600 * 1000
+PAGE_SIZE = 100
+DEFAULT_SEARCH_WINDOWS = 4
+# pages a window is expected to hold at least, smaller queries are not worth splitting
+MIN_WINDOW_PAGES = 10
+# more windows than crawled at once, so that the busy recent windows don't leave the others idle
+WINDOWS_PER_SLOT = 4
+
+
+def id_to_ms(tweet_id):
+    """Unix time in milliseconds a tweet id was created at"""
+    return (tweet_id >> TIMESTAMP_SHIFT) + SNOWFLAKE_EPOCH_MS
+
+
+def ms_to_id(ms):
+    """Lowest tweet id created at unix time ms"""
+    return max(ms - SNOWFLAKE_EPOCH_MS, 0) << TIMESTAMP_SHIFT
+
+
+def plan_windows(page, since_id=None, parallel=DEFAULT_SEARCH_WINDOWS, min_window_pages=MIN_WINDOW_PAGES):
+    """Windows to crawl the rest of a search in, given its first page
+
+    Args:
+        page (list): First page of the search, raw tweet JSON, newest first
+        since_id (int, optional): Lower bound of the crawl, exclusive
+        parallel (int): Windows crawled at once, 1 or less turns splitting off
+
+    Returns:
+        list: (since_id, max_id) pairs covering every id below the page down to since_id, newest first. Empty when
+        the query is small enough to page through in order.
+    """
+    if parallel <= 1 or len(page) < PAGE_SIZE:
+        # a short page is the last one
+        return []
+    ids = [tweet['id'] for tweet in page]
+    newest, oldest = max(ids), min(ids)
+    low = since_id or ms_to_id(id_to_ms(newest) - SEARCH_HORIZON_MS)
+    high = oldest - 1
+    if high <= low:
+        return []
+    tweets_per_ms = len(page) / max(id_to_ms(newest) - id_to_ms(oldest), 1)
+    expected_pages = tweets_per_ms * (id_to_ms(high) - id_to_ms(low)) / PAGE_SIZE
+    count = min(int(expected_pages // min_window_pages), parallel * WINDOWS_PER_SLOT)
+    if count < 2:
+        return []
+    bounds = [high - (high - low) * i // count for i in range(count + 1)]
+    return [(bounds[i + 1], bounds[i]) for i in range(count)]
+
+
+def crawl_windows(crawl_window, windows, parallel=DEFAULT_SEARCH_WINDOWS):
+    """Run crawl_window(window) for every window on parallel threads. crawl_window returns the windows the rest of
+    its window was split into, which are crawled in turn. Raises the first error once every window stopped."""
+    errors = []
+    with ThreadPoolExecutor(max_workers=parallel) as executor:
+        pending = {executor.submit(crawl_window, window) for window in windows}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    pending |= {executor.submit(crawl_window, window) for window in future.result()}
+                except Exception as e:
+                    logging.error("Search window failed: " + str(e))
+                    errors.append(e)
+    if errors:
+        raise errors[0]
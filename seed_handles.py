@@ -0,0 +1,142 @@
+"""Seed handles harvested from the socialbakers politics rankings and the local handle lists
+
+get_political_handles used to download the 22 ranking pages one after the other, without a timeout, on every call.
+Here the pages are fetched on a small thread pool and kept in an SQLite cache together with their ETag and
+Last-Modified headers, so later runs only send conditional requests and reparse the cached page on a 304. When a
+page can't be fetched its cached copy, however old, is used instead. The handles of the pages and of the local lists
+are merged in order, without duplicates.
+"""
+import logging
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+
+from handle_source import normalize_handle
+
+SOCIALBAKERS_URL = ("https://www.socialbakers.com/statistics/twitter/profiles/india/society/politics/page-{}/"
+                    "?showMoreList-from=1&do=platformList-renderAjax&json")
+SOCIALBAKERS_PAGES = 22
+LOCAL_HANDLE_FILES = ('files/inc_handles.txt', 'files/bjp_handles.txt')
+PAGE_CACHE_DB = "./seed_pages.db"
+DEFAULT_WORKERS = 4
+DEFAULT_TIMEOUT = 20
+
+
+def socialbakers_urls(pages=SOCIALBAKERS_PAGES):
+    return [SOCIALBAKERS_URL.format(i) for i in range(1, pages + 1)]
+
+
+class PageCache:
+    """Pages last fetched from every URL with their validators, safe to share between threads"""
+
+    def __init__(self, path=PAGE_CACHE_DB):
+        self.path = path
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        self.conn.execute("pragma journal_mode=wal")
+        self.conn.execute("create table if not exists page_cache (url text primary key, etag text, "
+                          "last_modified text, body blob not null, fetched_at real not null) without rowid")
+
+    def get(self, url):
+        """(etag, last_modified, body) of url, None if it was never fetched"""
+        with self._lock:
+            return self.conn.execute("select etag, last_modified, body from page_cache where url = ?",
+                                     (url,)).fetchone()
+
+    def put(self, url, etag, last_modified, body):
+        with self._lock:
+            self.conn.execute("insert into page_cache (url, etag, last_modified, body, fetched_at) "
+                              "values (?, ?, ?, ?, ?) on conflict (url) do update set etag = excluded.etag, "
+                              "last_modified = excluded.last_modified, body = excluded.body, "
+                              "fetched_at = excluded.fetched_at", (url, etag, last_modified, body, time.time()))
+
+    def close(self):
+        self.conn.close()
+
+
+def fetch_page(session, url, cache=None, timeout=DEFAULT_TIMEOUT):
+    """Body of url, revalidating the cached copy with If-None-Match/If-Modified-Since. None if it can't be fetched
+    and isn't cached."""
+    cached = cache.get(url) if cache is not None else None
+    headers = {}
+    if cached:
+        if cached[0]:
+            headers['If-None-Match'] = cached[0]
+        if cached[1]:
+            headers['If-Modified-Since'] = cached[1]
+    try:
+        resp = session.get(url, headers=headers, timeout=timeout)
+        if resp.status_code == 304 and cached:
+            return cached[2]
+        resp.raise_for_status()
+    except requests.RequestException as e:
+        if cached:
+            logging.warning("Can't fetch " + url + ", using the cached page: " + str(e))
+            return cached[2]
+        logging.error("Can't fetch " + url + " exception: " + str(e))
+        return None
+    if cache is not None:
+        cache.put(url, resp.headers.get('ETag'), resp.headers.get('Last-Modified'), resp.content)
+    return resp.content
+
+
+def parse_handles(html):
+    """Handles of a ranking page, every profile is an h2 holding "Name (@handle)" spans"""
+    soup = BeautifulSoup(html, 'html.parser')
+    return [span.text.split('(')[-1].replace(')', '').replace('@', '')
+            for h2 in soup.find_all('h2') for span in h2.find_all('span')]
+
+
+def harvest_handles(urls=None, cache_file=PAGE_CACHE_DB, workers=DEFAULT_WORKERS, timeout=DEFAULT_TIMEOUT):
+    """Handles of the ranking pages at urls (the socialbakers pages by default) in page order
+
+    Args:
+        urls (list, optional): Pages to harvest
+        cache_file (str, optional): SQLite page cache, None to always download the pages
+        workers (int): Pages fetched at once
+        timeout (float): Connect and read timeout of every request in seconds
+    """
+    urls = urls or socialbakers_urls()
+    cache = PageCache(cache_file) if cache_file else None
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_maxsize=workers)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pages = list(executor.map(lambda url: fetch_page(session, url, cache, timeout), urls))
+    finally:
+        session.close()
+        if cache is not None:
+            cache.close()
+    return [handle for page in pages if page for handle in parse_handles(page)]
+
+
+def read_handle_files(files):
+    """Handles listed one per line in files, missing files are skipped"""
+    handles = []
+    for file in files:
+        try:
+            with open(file, encoding="utf-8") as f:
+                handles.extend(line.strip() for line in f if line.strip())
+        except FileNotFoundError:
+            logging.warning("Handle list " + file + " not found")
+    return handles
+
+
+def merge_handles(*lists):
+    """Normalized handles of lists in order, without duplicates"""
+    return list(dict.fromkeys(handle for handles in lists for handle in map(normalize_handle, handles) if handle))
+
+
+def get_seed_handles(files=LOCAL_HANDLE_FILES, get_online=True, **kwargs):
+    """Handles harvested online, see harvest_handles for the keyword arguments, merged with the local lists in files"""
+    online = harvest_handles(**kwargs) if get_online else []
+    handles = merge_handles(online, read_handle_files(files))
+    logging.info("{} seed handles, {} of them found online".format(len(handles), len(set(online))))
+    return handles
@@ -0,0 +1,96 @@
+"""Tweet ids already crawled, shared by every worker process
+
+Overlapping trending queries and timelines of users who retweet each other return the same tweets again and again.
+A bloom filter over shared memory, seeded with the newest ids already in the sink, lets the fetchers drop those
+tweets before they are normalized and written. Bits are set without a lock, so two processes setting bits of the same
+byte at once can lose one of them; that only lets a duplicate through to the sink, which skips it anyway.
+"""
+import logging
+from multiprocessing import RawArray, Value
+
+from bloom import BloomFilter
+
+DEFAULT_CAPACITY = 10000000
+# a false positive drops a tweet that was never crawled, so keep them much rarer than for handles
+DEFAULT_ERROR_RATE = 1e-7
+
+SEEN_IDS = None
+
+
+class SeenIds:
+    """Shared tweet id filter, hand it to the worker processes through the pool initializer
+
+    Once capacity ids were added the false positive rate climbs, so the filter stops dropping tweets.
+
+    Args:
+        capacity (int): Number of ids the filter holds, it takes about 4.2 bytes per id at the default error rate
+        error_rate (float, optional): Chance of dropping a tweet that was never seen while below capacity
+    """
+
+    def __init__(self, capacity=DEFAULT_CAPACITY, error_rate=DEFAULT_ERROR_RATE):
+        self.capacity = int(capacity)
+        self.bloom = BloomFilter(self.capacity, error_rate,
+                                 buffer=RawArray('B', BloomFilter.size_for(self.capacity, error_rate)))
+        self._added = Value('q', 0)
+        self._skipped = Value('q', 0)
+        self._warned = False
+
+    @property
+    def full(self):
+        return self._added.value >= self.capacity
+
+    def seed(self, ids):
+        """Add batches of ids already stored, stopping at half the capacity to leave room for the crawl
+
+        Returns:
+            int: Number of ids added
+        """
+        limit = self.capacity // 2
+        added = 0
+        for batch in ids:
+            for tweet_id in batch[:limit - added]:
+                self.bloom.add(tweet_id)
+            added = min(added + len(batch), limit)
+            if added >= limit:
+                break
+        with self._added.get_lock():
+            self._added.value += added
+        return added
+
+    def filter_page(self, page):
+        """Tweets of page whose id wasn't written before. They only count as seen once add is called for them, so a
+        tweet whose write fails is fetched and written again by a later page or crawl."""
+        if self.full:
+            if not self._warned:
+                logging.warning("Tweet id filter is full, no longer dropping duplicate tweets")
+                self._warned = True
+            return page
+        bloom = self.bloom
+        new = [tweet for tweet in page if tweet['id'] not in bloom]
+        with self._skipped.get_lock():
+            self._skipped.value += len(page) - len(new)
+        return new
+
+    def add(self, ids):
+        """Remember the ids of tweets the sink has written"""
+        if self.full:
+            return
+        added = sum(1 for tweet_id in ids if self.bloom.add(tweet_id))
+        with self._added.get_lock():
+            self._added.value += added
+
+    @property
+    def skipped(self):
+        """Tweets dropped as duplicates by every process so far"""
+        return self._skipped.value
+
+
+def set_seen_ids(seen_ids):
+    """Pool initializer part: keep the filter handed down by the parent for the pipelines of this process"""
+    global SEEN_IDS
+    SEEN_IDS = seen_ids
+
+
+def get_seen_ids():
+    """Filter of the current worker process, None when deduplication is off"""
+    return SEEN_IDS
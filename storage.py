@@ -0,0 +1,600 @@
+import io
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+import uuid
+from collections import namedtuple
+from operator import attrgetter
+from urllib.parse import quote
+
+import pandas as pd
+import psycopg2
+
+from metrics import get_metrics
+from normalizer import TWEET_FIELDS, TweetRecord, dict_fields
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+TWEET_COLUMNS = list(TWEET_FIELDS)
+
+if pa is not None:
+    PARQUET_SCHEMA = pa.schema([
+        ('id', pa.int64()), ('tweet_from', pa.string()), ('created_at', pa.string()),
+        ('hashtags', pa.list_(pa.string())), ('urls', pa.list_(pa.string())),
+        ('user_mentions_id', pa.list_(pa.int64())), ('media', pa.list_(pa.string())),
+        ('user_mentions_name', pa.list_(pa.string())), ('origin_device', pa.string()),
+        ('favorite_count', pa.int64()), ('text', pa.string()), ('in_reply_to_screen_name', pa.string()),
+        ('in_reply_to_user_id', pa.int64()), ('in_reply_to_status_id', pa.int64()), ('retweet_count', pa.int64()),
+        ('retweeted_status_text', pa.string()), ('retweeted_status_url', pa.list_(pa.string())),
+        ('retweeted_status_id', pa.int64()), ('retweeted_status_user_name', pa.string()),
+        ('retweeted_status_user_handle', pa.string())])
+
+PARQUET_ROW_GROUP_SIZE = 10000
+
+SQLITE_FILE = "tweets.db"
+# table of preproc.create_table_db
+SQLITE_TABLE = "TWITTER"
+SQLITE_COLUMNS = '''id INT PRIMARY KEY NOT NULL,
+    tweet_from TEXT NOT NULL,
+    created_at BLOB NOT NULL,
+    hashtags TEXT,
+    urls TEXT,
+    user_mentions_id TEXT,
+    media TEXT,
+    user_mentions_name TEXT,
+    origin_device TEXT,
+    favorite_count INT,
+    text TEXT,
+    in_reply_to_screen_name TEXT,
+    in_reply_to_user_id INT,
+    in_reply_to_status_id INT,
+    retweet_count INT,
+    retweeted_status_text TEXT,
+    retweeted_status_url BLOB,
+    retweeted_status_id INT,
+    retweeted_status_user_name TEXT,
+    retweeted_status_user_handle TEXT'''
+
+PG_POOL = None
+PG_POOL_PID = None
+
+InsertResult = namedtuple('InsertResult', ['inserted', 'duplicates', 'failed'])
+
+
+def pg_get_conn(database, user, password, host, port):
+    """Get Postgres connection for fakenews
+
+    Returns:
+        Connection object : returns Post gres connection object
+
+    Args:
+        database (str, optional): Name of database
+        user (str, optional): Name of User
+        password (str, optional): Password of user
+        :param host:
+        :type host:
+    """
+    try:
+        conn = psycopg2.connect(database=database,
+                                user=user, password=password, host=host, port=port)
+        conn.autocommit = True
+        return conn
+    except psycopg2.DatabaseError as e:
+        logging.error("Problem Connecting to database:  " + str(e))
+
+
+class PgPool:
+    """Postgres connections opened once and reused for the life of a worker process
+
+    Idle connections are checked with a cheap query before reuse and replaced when the server went away.
+    getconn blocks while all maxconn connections are in use. The counters of stats are also exported as metrics.
+    """
+
+    def __init__(self, db_credentials, maxconn=4, check_after=30):
+        self.db_credentials = db_credentials
+        self.maxconn = maxconn
+        self.check_after = check_after
+        self._idle = queue.LifoQueue()
+        self._slots = threading.Semaphore(maxconn)
+        self._lock = threading.Lock()
+        self.size = 0
+        self.created = 0
+        self.reused = 0
+        self.reconnects = 0
+        self.wait_time = 0.0
+        self.metrics = get_metrics()
+        worker = os.getpid()
+        self.metrics.gauge_fn('tweetcrawler_pg_pool_connections', lambda: self.size, state="open", worker=worker)
+        self.metrics.gauge_fn('tweetcrawler_pg_pool_connections', self._idle.qsize, state="idle", worker=worker)
+
+    def _connect(self):
+        conn = psycopg2.connect(database=self.db_credentials["dbname"], user=self.db_credentials["dbuser"],
+                                password=self.db_credentials["dbpass"], host=self.db_credentials.get("dbhost"),
+                                port=self.db_credentials.get("dbport"))
+        conn.autocommit = True
+        with self._lock:
+            self.size += 1
+            self.created += 1
+        self.metrics.inc('tweetcrawler_pg_pool_connects_total')
+        return conn
+
+    def _healthy(self, conn, idle_since):
+        if conn.closed:
+            return False
+        if time.time() - idle_since < self.check_after:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("select 1")
+            return True
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            return False
+
+    def getconn(self):
+        start = time.time()
+        self._slots.acquire()
+        waited = time.time() - start
+        with self._lock:
+            self.wait_time += waited
+        self.metrics.inc('tweetcrawler_pg_pool_wait_seconds_total', waited)
+        try:
+            while True:
+                try:
+                    conn, idle_since = self._idle.get_nowait()
+                except queue.Empty:
+                    return self._connect()
+                if self._healthy(conn, idle_since):
+                    with self._lock:
+                        self.reused += 1
+                    self.metrics.inc('tweetcrawler_pg_pool_reuses_total')
+                    return conn
+                self._close(conn)
+        except Exception:
+            self._slots.release()
+            raise
+
+    def putconn(self, conn):
+        if conn.closed:
+            self._close(conn)
+        else:
+            self._idle.put((conn, time.time()))
+        self._slots.release()
+
+    def discard(self, conn):
+        self._close(conn)
+        self._slots.release()
+
+    def _close(self, conn):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+        with self._lock:
+            self.size -= 1
+
+    def run(self, fn):
+        """Call fn(conn) with a pooled connection, retrying once on a fresh connection if the old one was lost"""
+        for attempt in range(2):
+            conn = self.getconn()
+            try:
+                result = fn(conn)
+            except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+                self.discard(conn)
+                if attempt:
+                    raise
+                with self._lock:
+                    self.reconnects += 1
+                self.metrics.inc('tweetcrawler_pg_pool_reconnects_total')
+                logging.warning("Lost Postgres connection, reconnecting: " + str(e))
+                continue
+            self.putconn(conn)
+            return result
+
+    def closeall(self):
+        while True:
+            try:
+                conn, _ = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            self._close(conn)
+
+    def stats(self):
+        with self._lock:
+            return {'size': self.size, 'created': self.created, 'reused': self.reused,
+                    'reconnects': self.reconnects, 'wait_time': self.wait_time}
+
+
+def get_pg_pool(db_credentials):
+    """Connection pool of the current process, created on first use. A pool inherited from the parent through fork
+    is never reused since its sockets are shared with the parent."""
+    global PG_POOL, PG_POOL_PID
+    if PG_POOL is None or PG_POOL_PID != os.getpid():
+        PG_POOL = PgPool(db_credentials, maxconn=int(db_credentials.get('pool_size', 4)))
+        PG_POOL_PID = os.getpid()
+    return PG_POOL
+
+
+def tweet_values(item):
+    """Column values of a TweetRecord or of a tweet dict as built by normalize_tweet, in TWEET_COLUMNS order"""
+    if isinstance(item, TweetRecord):
+        return item.values()
+    return [item.get(col) for col in TWEET_COLUMNS]
+
+
+def _pg_array_element(value):
+    value = str(value)
+    if value == '' or value.upper() == 'NULL' or any(c in value for c in '{}",\\ \t\n\r'):
+        return '"' + value.replace('\\', '\\\\').replace('"', '\\"') + '"'
+    return value
+
+
+def _copy_value(value):
+    """Format a value for COPY text format. Lists are written as array literals, the same text postgres stores when
+    a python list is inserted into a text column."""
+    if value is None:
+        return '\\N'
+    if isinstance(value, (list, tuple)):
+        value = '{' + ','.join(_pg_array_element(x) for x in value) + '}'
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+def _conflict_clause(on_conflict):
+    if on_conflict == "update":
+        return "ON CONFLICT (id) DO UPDATE SET " + ", ".join(
+            "{0} = EXCLUDED.{0}".format(col) for col in TWEET_COLUMNS if col != 'id')
+    return "ON CONFLICT (id) DO NOTHING"
+
+
+def _insert_rows(posts, cur, tablename, on_conflict):
+    """Row by row fallback used when a batch cannot be copied, so that only the bad rows are counted as failed"""
+    inserted = duplicates = failed = 0
+    query = "insert into {} ({}) values ({}) {} returning (xmax = 0)".format(
+        tablename, ','.join(TWEET_COLUMNS), ','.join(['%s'] * len(TWEET_COLUMNS)), _conflict_clause(on_conflict))
+    for item in posts:
+        try:
+            # psycopg2 adapts lists to arrays but tuples to rows
+            cur.execute(query, [list(value) if isinstance(value, tuple) else value for value in tweet_values(item)])
+            row = cur.fetchone()
+            if row and row[0]:
+                inserted += 1
+            else:
+                duplicates += 1
+        except psycopg2.DatabaseError:
+            failed += 1
+    return InsertResult(inserted, duplicates, failed)
+
+
+def insert_into_postgres(posts, conn, tablename, curr_id, on_conflict="nothing"):
+    """Bulk load posts with COPY into a temporary staging table and merge it into tablename on id
+
+    Args:
+        posts (list): TweetRecords or tweet dicts as built by normalize_tweet
+        conn: Postgres connection in autocommit mode as returned by pg_get_conn
+        tablename (str): Target table
+        curr_id (str): Handle or query the posts were crawled for
+        on_conflict (str, optional): "nothing" keeps the stored tweet, "update" overwrites it
+
+    Returns:
+        InsertResult: number of tweets inserted, skipped as already present and failed
+    """
+    if not posts:
+        return InsertResult(0, 0, 0)
+    stage = "stage_" + tablename.split('.')[-1]
+    buf = io.StringIO()
+    for item in posts:
+        buf.write('\t'.join(_copy_value(value) for value in tweet_values(item)) + '\n')
+    buf.seek(0)
+    cur = conn.cursor()
+    try:
+        cur.execute("BEGIN")
+        cur.execute("create temp table if not exists {} (like {} including defaults) on commit delete rows".format(
+            stage, tablename))
+        cur.copy_expert("copy {} ({}) from stdin".format(stage, ','.join(TWEET_COLUMNS)), buf)
+        cur.execute("insert into {0} ({1}) select distinct on (id) {1} from {2} order by id {3} "
+                    "returning (xmax = 0)".format(tablename, ','.join(TWEET_COLUMNS), stage,
+                                                  _conflict_clause(on_conflict)))
+        inserted = sum(1 for row in cur.fetchall() if row[0])
+        cur.execute("COMMIT")
+        return InsertResult(inserted, len(posts) - inserted, 0)
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        raise
+    except psycopg2.DatabaseError as e:
+        cur.execute("ROLLBACK")
+        logging.warning("Bulk load failed for {}, inserting row by row: {}".format(curr_id, e))
+        return _insert_rows(posts, cur, tablename, on_conflict)
+    finally:
+        cur.close()
+
+
+def sqlite_connect(path):
+    """SQLite connection in WAL mode, so readers never block the writer and several processes can write in turn.
+    Transactions are begun and committed explicitly."""
+    conn = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+    conn.execute("pragma journal_mode=wal")
+    conn.execute("pragma synchronous=normal")
+    return conn
+
+
+def create_sqlite_table(conn, tablename=SQLITE_TABLE):
+    conn.execute("create table if not exists {} ({})".format(tablename, SQLITE_COLUMNS))
+
+
+def _sqlite_value(value):
+    """Lists are stored comma separated as preproc_db did"""
+    if isinstance(value, (list, tuple)):
+        return ','.join(str(x) for x in value)
+    return value
+
+
+def insert_into_sqlite(posts, conn, tablename=SQLITE_TABLE):
+    """Insert posts in one transaction with a prepared INSERT OR IGNORE, so tweets already stored are skipped
+
+    Args:
+        posts (list): TweetRecords or tweet dicts as built by normalize_tweet
+        conn: connection from sqlite_connect
+        tablename (str, optional): Target table
+
+    Returns:
+        InsertResult: number of tweets inserted, skipped as already present and failed
+    """
+    if not posts:
+        return InsertResult(0, 0, 0)
+    query = "insert or ignore into {} ({}) values ({})".format(tablename, ','.join(TWEET_COLUMNS),
+                                                              ','.join(['?'] * len(TWEET_COLUMNS)))
+    rows = [[_sqlite_value(value) for value in tweet_values(item)] for item in posts]
+    changes = conn.total_changes
+    try:
+        conn.execute("begin immediate")
+        conn.executemany(query, rows)
+        conn.execute("commit")
+        inserted = conn.total_changes - changes
+        return InsertResult(inserted, len(posts) - inserted, 0)
+    except sqlite3.OperationalError:
+        if conn.in_transaction:
+            conn.execute("rollback")
+        raise
+    except sqlite3.Error as e:
+        conn.execute("rollback")
+        logging.warning("Bulk insert into {} failed, inserting row by row: {}".format(tablename, e))
+    # row by row so that only the bad rows are counted as failed
+    inserted = duplicates = failed = 0
+    conn.execute("begin immediate")
+    try:
+        for row in rows:
+            changes = conn.total_changes
+            try:
+                conn.execute(query, row)
+            except sqlite3.Error:
+                failed += 1
+                continue
+            if conn.total_changes > changes:
+                inserted += 1
+            else:
+                duplicates += 1
+    finally:
+        conn.execute("commit")
+    return InsertResult(inserted, duplicates, failed)
+
+
+def add_results(result, other):
+    return InsertResult(*(x + y for x, y in zip(result, other)))
+
+
+class PostgresSink:
+    durable = True
+
+    def __init__(self, db_credentials, tablename):
+        self.pool = get_pg_pool(db_credentials)
+        self.tablename = tablename
+        self.on_conflict = db_credentials.get('on_conflict', "nothing")
+
+    def write(self, curr_id, posts):
+        return self.pool.run(lambda conn: insert_into_postgres(posts, conn, self.tablename, curr_id,
+                                                               self.on_conflict))
+
+    def close_handle(self, curr_id):
+        pass
+
+    def existing_ids(self, limit, batch_size=100000):
+        """Batches of the newest limit tweet ids already in the table, read through a server side cursor"""
+        conn = self.pool.getconn()
+        # named cursors only live inside a transaction
+        conn.autocommit = False
+        try:
+            with conn.cursor(name="existing_ids") as cur:
+                cur.execute("select id from {} order by id desc limit %s".format(self.tablename), (limit,))
+                while True:
+                    rows = cur.fetchmany(batch_size)
+                    if not rows:
+                        break
+                    yield [row[0] for row in rows]
+        finally:
+            conn.rollback()
+            conn.autocommit = True
+            self.pool.putconn(conn)
+
+    def close(self):
+        logging.info("Postgres pool: {}".format(self.pool.stats()))
+        self.pool.closeall()
+
+
+class CsvSink:
+    durable = True
+
+    def __init__(self, output_folder):
+        self.output_folder = output_folder
+
+    def write(self, curr_id, posts):
+        write_to_csv(self.output_folder, curr_id, posts)
+        return InsertResult(len(posts), 0, 0)
+
+    def close_handle(self, curr_id):
+        pass
+
+    def existing_ids(self, limit):
+        """The CSV files have no header and optional columns, so the id column can't be found reliably"""
+        return iter(())
+
+    def close(self):
+        pass
+
+
+class ParquetSink:
+    """Writes tweets as Parquet with real list columns, partitioned as
+    <output_folder>/crawl_date=YYYY-MM-DD/handle=<handle>/part-<pid>-<uid>.parquet
+
+    Tweets are buffered per handle and written as row groups of row_group_size; the file of a handle is closed when
+    the handle is finished. Until then its footer is missing and none of its tweets can be read back, so it is written
+    as a hidden .part-*.inprogress file that dataset readers skip and only renamed to its final name once complete.
+    """
+    durable = False
+
+    def __init__(self, output_folder, row_group_size=PARQUET_ROW_GROUP_SIZE, compression="zstd"):
+        if pq is None:
+            raise ImportError("pyarrow is required for the parquet sink")
+        self.output_folder = output_folder
+        self.row_group_size = int(row_group_size)
+        self.compression = compression
+        self._lock = threading.Lock()
+        self._buffers = {}
+        self._writers = {}
+
+    def _writer(self, curr_id):
+        if curr_id not in self._writers:
+            folder = os.path.join(self.output_folder, "crawl_date=" + time.strftime("%Y-%m-%d"),
+                                  "handle=" + quote(curr_id, safe=''))
+            os.makedirs(folder, exist_ok=True)
+            name = "part-{}-{}.parquet".format(os.getpid(), uuid.uuid4().hex[:12])
+            tmp_path = os.path.join(folder, "." + name + ".inprogress")
+            self._writers[curr_id] = (pq.ParquetWriter(tmp_path, PARQUET_SCHEMA, compression=self.compression),
+                                      tmp_path, os.path.join(folder, name))
+        return self._writers[curr_id][0]
+
+    def _write_row_group(self, curr_id, posts):
+        columns = dict(zip(TWEET_COLUMNS, map(list, zip(*map(tweet_values, posts)))))
+        self._writer(curr_id).write_table(pa.Table.from_pydict(columns, schema=PARQUET_SCHEMA))
+
+    def write(self, curr_id, posts):
+        with self._lock:
+            buffer = self._buffers.setdefault(curr_id, [])
+        buffer.extend(posts)
+        if len(buffer) >= self.row_group_size:
+            self._write_row_group(curr_id, buffer)
+            buffer.clear()
+        return InsertResult(len(posts), 0, 0)
+
+    def close_handle(self, curr_id):
+        with self._lock:
+            buffer = self._buffers.pop(curr_id, None)
+        if buffer:
+            self._write_row_group(curr_id, buffer)
+        with self._lock:
+            writer = self._writers.pop(curr_id, None)
+        if writer:
+            writer[0].close()
+            os.replace(writer[1], writer[2])
+
+    def existing_ids(self, limit):
+        """Batches of the tweet ids already written, newest files first, up to limit ids"""
+        paths = [os.path.join(root, name) for root, _, names in os.walk(self.output_folder)
+                 for name in names if name.endswith(".parquet")]
+        for path in sorted(paths, key=os.path.getmtime, reverse=True):
+            if limit <= 0:
+                return
+            try:
+                ids = pq.read_table(path, columns=['id']).column('id').to_pylist()[:limit]
+            except (pa.ArrowException, OSError) as e:
+                # e.g. a file left without its footer by a crash
+                logging.warning("Skipping unreadable Parquet file " + path + ": " + str(e))
+                continue
+            limit -= len(ids)
+            yield ids
+
+    def close(self):
+        for curr_id in list(self._buffers) + list(self._writers):
+            self.close_handle(curr_id)
+
+
+class SqliteSink:
+    """Writes tweets to a local SQLite database with the schema of preproc.create_table_db, for single machine crawls
+    without a Postgres server. Every worker process has its own connection, WAL mode lets them write in turn."""
+    durable = True
+
+    def __init__(self, path, tablename=SQLITE_TABLE):
+        self.path = path
+        self.tablename = tablename
+        self._lock = threading.Lock()
+        self.conn = sqlite_connect(path)
+        create_sqlite_table(self.conn, tablename)
+
+    def write(self, curr_id, posts):
+        with self._lock:
+            return insert_into_sqlite(posts, self.conn, self.tablename)
+
+    def close_handle(self, curr_id):
+        pass
+
+    def existing_ids(self, limit, batch_size=100000):
+        """Batches of the newest limit tweet ids already in the table"""
+        with self._lock:
+            cur = self.conn.execute("select id from {} order by id desc limit ?".format(self.tablename), (limit,))
+        while True:
+            with self._lock:
+                rows = cur.fetchmany(batch_size)
+            if not rows:
+                return
+            yield [row[0] for row in rows]
+
+    def close(self):
+        with self._lock:
+            self.conn.close()
+
+
+def open_sink(sink, db_credentials, output_folder, tablename, row_group_size=None):
+    """Sink writing crawled tweets to Postgres, per handle CSV files, Parquet or SQLite
+
+    Args:
+        sink (str): "postgres", "csv", "parquet" or "sqlite" (<output_folder>/tweets.db), None picks postgres when
+            db_credentials are set and csv otherwise
+        row_group_size (int, optional): Tweets per row group of the Parquet sink
+
+    Returns:
+        object with write(curr_id, posts) -> InsertResult, close_handle(curr_id), existing_ids(limit) yielding
+        batches of the tweet ids already stored, close(), and durable: whether written tweets persist before
+        close_handle
+    """
+    sink = sink or ("postgres" if db_credentials else "csv")
+    if sink == "postgres":
+        return PostgresSink(db_credentials, tablename)
+    if sink == "parquet":
+        return ParquetSink(output_folder, row_group_size or PARQUET_ROW_GROUP_SIZE)
+    if sink == "sqlite":
+        os.makedirs(output_folder, exist_ok=True)
+        return SqliteSink(os.path.join(output_folder, SQLITE_FILE), tablename or SQLITE_TABLE)
+    return CsvSink(output_folder)
+
+
+def write_to_csv(output_folder, curr_id, posts):
+    if not os.path.exists(output_folder):
+        os.mkdir(output_folder)
+    csv_file = os.path.join(output_folder, curr_id + ".csv")
+    df = _csv_frame(posts)
+    df.to_csv(csv_file, mode='a', header=False)
+
+
+def _csv_frame(posts):
+    """DataFrame of posts with the columns, in the order, that pd.DataFrame of their normalize_tweet dicts has, the
+    files have no header so that is what tells the columns apart"""
+    if not posts or not isinstance(posts[0], TweetRecord):
+        return pd.DataFrame(posts)
+    # a column is added the first time a tweet has it
+    columns = dict.fromkeys(col for fields in dict.fromkeys(map(dict_fields, posts)) for col in fields)
+    return pd.DataFrame({col: [list(value) if isinstance(value, tuple) else value
+                               for value in map(attrgetter(col), posts)] for col in columns}, columns=list(columns))
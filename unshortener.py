@@ -0,0 +1,166 @@
+"""Concurrent URL unshortening with a persistent cache
+
+unshorten_url used to make one blocking HEAD request per link, without a timeout, and to resolve the same bit.ly
+links over and over. Unshortener resolves a batch of links on a thread pool sharing one pooled requests session, with
+at most per_host requests in flight to any one shortener (they rate limit aggressively) and a timeout on every
+request. Resolved links are kept in an SQLite database with a TTL, so each distinct short link is only resolved once
+across runs; links that could not be resolved are not cached and are tried again next time.
+"""
+import logging
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+URL_CACHE_DB = "./url_cache.db"
+DEFAULT_TTL = 30 * 24 * 3600
+DEFAULT_WORKERS = 32
+DEFAULT_PER_HOST = 8
+DEFAULT_TIMEOUT = 10
+MAX_REDIRECTS = 10
+
+
+class UrlCache:
+    """Short -> final URL store with a TTL, safe to share between threads
+
+    Args:
+        path (str): SQLite database, created if needed
+        ttl (float): Seconds after which a resolved link is resolved again
+    """
+
+    def __init__(self, path=URL_CACHE_DB, ttl=DEFAULT_TTL):
+        self.path = path
+        self.ttl = float(ttl)
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        self.conn.execute("pragma journal_mode=wal")
+        self.conn.execute("pragma synchronous=normal")
+        self.conn.execute("create table if not exists url_cache (short_url text primary key, final_url text not null, "
+                          "resolved_at real not null) without rowid")
+
+    def get_many(self, urls):
+        """dict of the urls resolved less than ttl seconds ago to their final URL"""
+        oldest = time.time() - self.ttl
+        found = {}
+        with self._lock:
+            for url in urls:
+                row = self.conn.execute("select final_url from url_cache where short_url = ? and resolved_at >= ?",
+                                        (url, oldest)).fetchone()
+                if row:
+                    found[url] = row[0]
+        return found
+
+    def put_many(self, resolved):
+        """Store a dict of short -> final URL"""
+        if not resolved:
+            return
+        now = time.time()
+        with self._lock:
+            self.conn.execute("begin immediate")
+            try:
+                self.conn.executemany("insert into url_cache (short_url, final_url, resolved_at) values (?, ?, ?) "
+                                      "on conflict (short_url) do update set final_url = excluded.final_url, "
+                                      "resolved_at = excluded.resolved_at",
+                                      ((url, final, now) for url, final in resolved.items()))
+                self.conn.execute("commit")
+            except Exception:
+                self.conn.execute("rollback")
+                raise
+
+    def purge(self):
+        """Delete the expired links"""
+        with self._lock:
+            self.conn.execute("delete from url_cache where resolved_at < ?", (time.time() - self.ttl,))
+
+    def close(self):
+        self.conn.close()
+
+
+class Unshortener:
+    """Batch URL unshortener
+
+    Args:
+        cache (UrlCache, optional): Persistent cache, None resolves every link every time
+        workers (int): Requests in flight at once
+        per_host (int): Requests in flight at once to the same host, also the connections pooled per host
+        timeout (float): Connect and read timeout of every request in seconds
+        batch_size (int): Links resolved between two writes to the cache, so an interrupted run keeps its progress
+    """
+
+    def __init__(self, cache=None, workers=DEFAULT_WORKERS, per_host=DEFAULT_PER_HOST, timeout=DEFAULT_TIMEOUT,
+                 batch_size=1000):
+        self.cache = cache
+        self.workers = int(workers)
+        self.per_host = int(per_host)
+        self.timeout = float(timeout)
+        self.batch_size = int(batch_size)
+        self.session = requests.Session()
+        self.session.max_redirects = MAX_REDIRECTS
+        adapter = HTTPAdapter(pool_connections=self.workers, pool_maxsize=self.per_host)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._lock = threading.Lock()
+        self._hosts = {}
+
+    def _host_slot(self, url):
+        host = urlsplit(url).netloc.lower()
+        with self._lock:
+            if host not in self._hosts:
+                self._hosts[host] = threading.BoundedSemaphore(self.per_host)
+            return self._hosts[host]
+
+    def resolve(self, url):
+        """Final URL of url after following its redirects, None if it could not be fetched"""
+        try:
+            with self._host_slot(url):
+                resp = self.session.head(url, allow_redirects=True, timeout=self.timeout)
+                if resp.status_code in (403, 405, 501):
+                    # some shorteners refuse HEAD, only read the headers of the GET
+                    resp = self.session.get(url, allow_redirects=True, timeout=self.timeout, stream=True)
+                    resp.close()
+            return resp.url
+        except (requests.RequestException, ValueError) as e:
+            logging.debug("Can't unshorten " + url + " exception: " + str(e))
+            return None
+
+    def unshorten(self, urls):
+        """Resolve a batch of links
+
+        Args:
+            urls (iterable): Links to resolve, duplicates are resolved once
+
+        Returns:
+            dict: url -> final URL, None for the links that could not be resolved
+        """
+        urls = list(dict.fromkeys(urls))
+        result = self.cache.get_many(urls) if self.cache is not None else {}
+        todo = [url for url in urls if url not in result]
+        if todo:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                for start in range(0, len(todo), self.batch_size):
+                    batch = todo[start:start + self.batch_size]
+                    resolved = dict(zip(batch, executor.map(self.resolve, batch)))
+                    if self.cache is not None:
+                        self.cache.put_many({url: final for url, final in resolved.items() if final is not None})
+                    result.update(resolved)
+        logging.info("Unshortened {} links, {} from the cache, {} failed".format(
+            len(urls), len(urls) - len(todo), sum(final is None for final in result.values())))
+        return result
+
+    def close(self):
+        self.session.close()
+        if self.cache is not None:
+            self.cache.close()
+
+
+def unshorten(urls, cache_file=URL_CACHE_DB, ttl=DEFAULT_TTL, **kwargs):
+    """Resolve a batch of links through the cache in cache_file, see Unshortener for the keyword arguments"""
+    unshortener = Unshortener(UrlCache(cache_file, ttl) if cache_file else None, **kwargs)
+    try:
+        return unshortener.unshorten(urls)
+    finally:
+        unshortener.close()